@@ -0,0 +1,254 @@
+"""
+Reproducible benchmark of the page conversion against the local MediaWiki and Confluence stand-ins.
+
+Every scenario runs for every backend in its own process, so the peak memory of one does not hide another:
+- transform: the pages are fetched first, then only the parsing and the rewriting is timed,
+  as in the transform processes of the pipeline, without downloading the attachments;
+- end-to-end: the pipeline fetches, transforms and uploads all the pages into the Confluence stand-in.
+The pages per second, the median and the 99th percentile of the per-page latency and the peak RSS are reported.
+The transform outputs of the backends are compared, as they are expected to be the same up to the whitespace.
+
+python benchmark/run_benchmark.py --pages 200 --repeat 4 --latency 0.01 --error-rate 0.01 --output result.json
+"""
+import os
+import re
+import sys
+import json
+import logging
+import argparse
+import subprocess
+from time import perf_counter
+from hashlib import sha256
+from tempfile import TemporaryDirectory
+
+BENCHMARK_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from stub_server import StubServer  # noqa: E402
+from wiki_handler import WikiHandler  # noqa: E402
+from lxml_wiki_handler import LxmlWikiHandler  # noqa: E402
+from confluence_handler import ConfluenceHandler  # noqa: E402
+from pipeline_handler import PipelineHandler  # noqa: E402
+from metrics import metrics  # noqa: E402
+from constants import LOGGING_TEMPLATE  # noqa: E402
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+SCENARIOS = ("transform", "end-to-end")
+# Points the handlers of the worker process to the secret file of the stand-ins
+SECRET_ENVIRONMENT_VARIABLE = "WIKI_BENCHMARK_SECRET"
+
+
+class BenchmarkMixin:
+    def update_secret(self, file: str = None):
+        super().update_secret(os.environ[SECRET_ENVIRONMENT_VARIABLE])
+
+
+class BenchmarkWikiHandler(BenchmarkMixin, WikiHandler):
+    pass
+
+
+class BenchmarkLxmlWikiHandler(BenchmarkMixin, LxmlWikiHandler):
+    pass
+
+
+class BenchmarkConfluenceHandler(BenchmarkMixin, ConfluenceHandler):
+    pass
+
+
+WIKI_HANDLERS = {
+    "bs4": BenchmarkWikiHandler,
+    "lxml": BenchmarkLxmlWikiHandler,
+}
+
+
+def get_percentile(values: list, percentile: float):
+    # Nearest rank, so the result is one of the measured values
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, int(round(percentile / 100 * len(values) + 0.5)) - 1))]
+
+
+def get_peak_rss():
+    """
+    Return the peak RSS in megabytes of this process and of the largest of its finished child processes
+    """
+    if resource is None:
+        return None, None
+    # Kilobytes on Linux, bytes on macOS
+    unit = 1 if sys.platform == "darwin" else 1024
+    return tuple(
+        round(resource.getrusage(i).ru_maxrss * unit / 2 ** 20, 1)
+        for i in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)
+    )
+
+
+def summarize(latencies: list, seconds: float, pages: int, **kwargs):
+    peak_rss, children_peak_rss = get_peak_rss()
+    return dict(
+        pages=pages,
+        seconds=round(seconds, 3),
+        pages_per_second=round(pages / seconds, 2) if seconds > 0 else None,
+        p50_seconds=round(get_percentile(latencies, 50) or 0.0, 4),
+        p99_seconds=round(get_percentile(latencies, 99) or 0.0, 4),
+        peak_rss_mb=peak_rss,
+        children_peak_rss_mb=children_peak_rss,
+        **kwargs
+    )
+
+
+def run_transform(job: dict):
+    handler = WIKI_HANDLERS[job["backend"]]()
+    handler.connect()
+    # The pages are fetched beforehand and the attachments are left as markers, so only the parser is timed
+    contents = [handler.get_page(url) for url in job["urls"]]
+    handler.is_deferred = True
+    latencies = list()
+    digests = dict()
+    started = perf_counter()
+    for url, content in zip(job["urls"], contents):
+        page_started = perf_counter()
+        processed_page_dict = handler.process_content(content)
+        latencies.append(perf_counter() - page_started)
+        # The backends may differ in the whitespace between tags only
+        page_body = re.sub(r">\s+<", "><", processed_page_dict["page_body"])
+        digests[url] = sha256(page_body.encode("utf-8")).hexdigest()
+    return summarize(latencies, perf_counter() - started, len(contents), digests=digests)
+
+
+def run_end_to_end(job: dict):
+    c_handler = BenchmarkConfluenceHandler()
+    c_handler.connect()
+    pipeline = PipelineHandler(
+        c_handler,
+        wiki_handler_class=WIKI_HANDLERS[job["backend"]],
+        transform_processes=job["transform_processes"],
+        source=job["source"],
+    )
+    started = perf_counter()
+    succeeded, failed = pipeline.run(job["urls"])
+    seconds = perf_counter() - started
+    # The latency of a page is the time spent on it by all the stages, without waiting in the queues
+    report = metrics.get_report()
+    latencies = [sum(i["seconds"] for i in report["pages"].get(url, dict()).values()) for url in succeeded]
+    return summarize(
+        latencies,
+        seconds,
+        len(succeeded),
+        failed=len(failed),
+        requests=sum(i["requests"] for i in report["stages"].values()),
+        retries=sum(i["retries"] for i in report["stages"].values()),
+    )
+
+
+def run_worker(job_file: str):
+    with open(job_file, encoding="utf-8") as f:
+        job = json.load(f)
+    logging.basicConfig(level=job["logging_level"], format=LOGGING_TEMPLATE)
+    os.environ[SECRET_ENVIRONMENT_VARIABLE] = job["secret_file"]
+    if job["scenario"] == "transform":
+        result = run_transform(job)
+    else:
+        result = run_end_to_end(job)
+    with open(job["result_file"], "w", encoding="utf-8") as f:
+        json.dump(result, f)
+
+
+def compare_outputs(results: list):
+    # The backends must produce the same storage format for every page
+    digests = [i.pop("digests") for i in results if i.get("scenario") == "transform" and "digests" in i]
+    if len(digests) < 2:
+        return None
+    mismatches = sorted({url for i in digests[1:] for url in digests[0] if i.get(url) != digests[0][url]})
+    for url in mismatches:
+        logging.warning(f"The backends produced different output for '{url}'")
+    return len(mismatches) == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the page conversion against local stand-ins")
+    parser.add_argument("--pages", type=int, default=50, help="number of the Wiki pages")
+    parser.add_argument("--repeat", type=int, default=1, help="times the content of every fixture is repeated")
+    parser.add_argument("--latency", type=float, default=0.0, help="mean response latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of the requests failed with 503")
+    parser.add_argument("--file-size", type=int, default=64 << 10, help="attachment size in bytes")
+    parser.add_argument("--large-file-size", type=int, default=8 << 20, help="size of the 'Large' attachments")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the latency and the errors")
+    parser.add_argument("--backends", nargs="+", choices=sorted(WIKI_HANDLERS.keys()), default=["bs4", "lxml"])
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--transform-processes", type=int, default=0, help="transform processes of the pipeline")
+    parser.add_argument("--source", choices=("html", "api"), default="html", help="source of the pipeline")
+    parser.add_argument("--output", help="JSON file to write the results to")
+    parser.add_argument("--logging-level", default="WARNING")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        return run_worker(args.worker)
+
+    logging.basicConfig(level=args.logging_level, format=LOGGING_TEMPLATE)
+    stub = StubServer(
+        pages=args.pages,
+        repeat=args.repeat,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        file_size=args.file_size,
+        large_file_size=args.large_file_size,
+        seed=args.seed,
+    ).start()
+    results = list()
+    try:
+        with TemporaryDirectory(prefix="wiki_benchmark_") as temp_dir:
+            secret_file = os.path.join(temp_dir, "secret.json")
+            with open(secret_file, "w", encoding="utf-8") as f:
+                json.dump(stub.get_secret(), f, ensure_ascii=False)
+            for scenario in args.scenarios:
+                for backend in args.backends:
+                    # Every run creates the pages and uploads the attachments anew
+                    stub.reset_confluence()
+                    job = dict(
+                        scenario=scenario,
+                        backend=backend,
+                        urls=stub.get_page_urls(),
+                        transform_processes=args.transform_processes,
+                        source=args.source,
+                        secret_file=secret_file,
+                        result_file=os.path.join(temp_dir, f"{scenario}_{backend}.json"),
+                        logging_level=args.logging_level,
+                    )
+                    job_file = os.path.join(temp_dir, f"{scenario}_{backend}.job.json")
+                    with open(job_file, "w", encoding="utf-8") as f:
+                        json.dump(job, f, ensure_ascii=False)
+                    logging.info(f"Run scenario '{scenario}' with backend '{backend}'")
+                    subprocess.run([sys.executable, os.path.realpath(__file__), "--worker", job_file], check=True)
+                    with open(job["result_file"], encoding="utf-8") as f:
+                        results.append(dict(scenario=scenario, backend=backend, **json.load(f)))
+    finally:
+        stub.stop()
+    output = dict(
+        parameters={k: v for k, v in vars(args).items() if k not in ("output", "worker", "logging_level")},
+        outputs_match=compare_outputs(results),
+        results=results,
+    )
+    for result in results:
+        print("{:<12} {:<5} {:>8} pages/s  p50 {:>8.4f} s  p99 {:>8.4f} s  peak RSS {} MB".format(
+            result["scenario"],
+            result["backend"],
+            result["pages_per_second"],
+            result["p50_seconds"],
+            result["p99_seconds"],
+            result["peak_rss_mb"],
+        ))
+    if output["outputs_match"] is not None:
+        print("Backend outputs match: {}".format(output["outputs_match"]))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(output, f, ensure_ascii=False, indent=4)
+    return output
+
+
+if __name__ == '__main__':
+    main()
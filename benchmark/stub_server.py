@@ -0,0 +1,430 @@
+"""
+Local stand-in of MediaWiki and Confluence for the benchmark.
+
+The Wiki serves the recorded pages of 'fixtures' under generated titles, their file description pages,
+the files themselves, and MediaWiki API ('action=query' for revisions and imageinfo, 'action=parse').
+Confluence keeps the pages, the content properties and the attachments in memory
+and serves the REST endpoints used by 'ConfluenceHandler'.
+Both add the configured latency to every response and fail the given share of requests with 503,
+Confluence fails only the uploads, as the listings made on connection are not retried.
+"""
+import os
+import re
+import sys
+import json
+import random
+from copy import deepcopy
+from hashlib import sha256
+from threading import Lock, Thread
+from urllib import parse as urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+from lxml import html as lxml_html
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "fixtures")
+TITLE_PREFIX = "Benchmark page"
+SPACE_KEY = "BENCH"
+SPACE_NAME = "Benchmark"
+PARENT_PAGE_NAME = "Benchmark parent"
+FILE_PREFIXES = ("Файл:", "Медиа:")
+FILE_PATHS = ("/images/", "/img_auth.php/")
+# The files having these words in the name are served with the large size or not found
+LARGE_FILE_MARKER = "Large"
+MISSING_FILE_MARKER = "missing"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, as the real servers
+
+    def log_message(self, *args):
+        pass
+
+    def send_bytes(self, code: int, content: bytes, content_type: str = "application/octet-stream", headers=None):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        for key, value in (headers or dict()).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_json(self, code: int, obj):
+        self.send_bytes(code, json.dumps(obj, ensure_ascii=False).encode("utf-8"), "application/json")
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def is_failed(self):
+        # The body is read anyway, so the connection stays usable
+        self.body = self.read_body()
+        sleep(self.server.stub.get_latency())
+        if self.is_error_injected() and self.server.stub.is_error():
+            self.send_json(503, dict(message="Injected error"))
+            return True
+        return False
+
+    def is_error_injected(self):
+        return True
+
+    def do_GET(self):
+        if not self.is_failed():
+            self.handle_get(urlparse.urlsplit(self.path))
+
+    def do_POST(self):
+        if not self.is_failed():
+            self.handle_post(urlparse.urlsplit(self.path))
+
+    def do_PUT(self):
+        if not self.is_failed():
+            self.handle_put(urlparse.urlsplit(self.path))
+
+    def handle_get(self, parts):
+        self.send_json(404, dict(message="Not found"))
+
+    def handle_post(self, parts):
+        self.send_json(404, dict(message="Not found"))
+
+    def handle_put(self, parts):
+        self.send_json(404, dict(message="Not found"))
+
+    @staticmethod
+    def get_query(parts) -> dict:
+        return {k: v[0] for k, v in urlparse.parse_qs(parts.query).items()}
+
+
+class WikiStubHandler(StubHandler):
+    def handle_get(self, parts):
+        stub = self.server.stub
+        path = urlparse.unquote(parts.path)
+        if path == "/api.php":
+            return self.handle_api(self.get_query(parts))
+        if path.startswith(FILE_PATHS):
+            name = path.rsplit("/", 1)[-1]
+            if MISSING_FILE_MARKER in name:
+                return self.send_bytes(404, b"Not found", "text/plain")
+            return self.send_bytes(200, stub.get_file_content(name))
+        if path.startswith("/index.php/"):
+            title = path[len("/index.php/"):].replace("_", " ")
+            if title.startswith(FILE_PREFIXES):
+                name = title.split(":", 1)[1].replace(" ", "_")
+                return self.send_bytes(200, stub.get_description_page(name).encode("utf-8"), "text/html; charset=UTF-8")
+            content = stub.get_page(title)
+            if content is not None:
+                return self.send_bytes(200, content.encode("utf-8"), "text/html; charset=UTF-8")
+        return self.send_bytes(404, b"Not found", "text/plain")
+
+    def handle_api(self, query: dict):
+        stub = self.server.stub
+        if query.get("action") == "parse":
+            page_dict = stub.get_parsed_page(query.get("page") or stub.get_title_by_revision(query.get("oldid")))
+            if page_dict is None:
+                return self.send_json(200, dict(error=dict(code="missingtitle")))
+            return self.send_json(200, dict(parse=page_dict))
+        if query.get("action") == "query":
+            titles = query.get("titles", "").split("|")
+            normalized = [dict(to=i.replace("_", " "), **{"from": i}) for i in titles if "_" in i]
+            pages = list()
+            for title in (i.replace("_", " ") for i in titles):
+                if query.get("prop") == "revisions":
+                    revision = stub.get_revision(title)
+                    if revision is not None:
+                        pages.append(dict(title=title, revisions=[dict(revid=revision)]))
+                        continue
+                elif query.get("prop") == "imageinfo" and title.startswith(FILE_PREFIXES):
+                    name = title.split(":", 1)[1].replace(" ", "_")
+                    pages.append(dict(title=title, imageinfo=[dict(
+                        url=urlparse.urljoin(stub.wiki_url, stub.get_file_path(name)),
+                        size=stub.get_file_size(name),
+                        sha1="",
+                    )]))
+                    continue
+                pages.append(dict(title=title, missing=True))
+            return self.send_json(200, dict(query=dict(normalized=normalized, pages=pages)))
+        return self.send_json(200, dict(error=dict(code="badvalue")))
+
+
+class ConfluenceStubHandler(StubHandler):
+    def is_error_injected(self):
+        # The listings made on connection are not retried by the handler, only the uploads are
+        return self.command != "GET"
+
+    def handle_get(self, parts):
+        stub = self.server.stub
+        query = self.get_query(parts)
+        start = int(query.get("start", 0))
+        limit = int(query.get("limit", 25))
+        path = parts.path
+        if path == "/rest/api/space":
+            return self.send_listing([dict(key=SPACE_KEY, name=SPACE_NAME)], start, limit)
+        if path == "/rest/api/content":
+            with stub.lock:
+                pages = [
+                    stub.get_page_dict(title) for title in sorted(stub.confluence_pages.keys())
+                    if "title" not in query or query["title"] == title
+                ]
+            return self.send_listing(pages, start, limit)
+        match = re.fullmatch(r"/rest/api/content/(\d+)/child/attachment", path)
+        if match is not None:
+            with stub.lock:
+                attachments = [
+                    dict(id=v["id"], title=k, metadata=dict(comment=v["comment"]))
+                    for k, v in stub.attachments.get(match.group(1), dict()).items()
+                ]
+            return self.send_listing(attachments, start, limit)
+        return self.send_json(404, dict(message="Not found"))
+
+    def send_listing(self, results: list, start: int, limit: int):
+        links = dict(next="next") if start + limit < len(results) else dict()
+        results = results[start:start + limit]
+        return self.send_json(200, dict(results=results, size=len(results), _links=links))
+
+    def handle_post(self, parts):
+        stub = self.server.stub
+        # A new attachment, or a new version of the attachment by its id
+        match = re.fullmatch(r"/rest/api/content/(\d+)/child/attachment(?:/\w+/data)?", parts.path)
+        if match is not None:
+            return self.send_json(200, dict(results=[stub.put_attachment(match.group(1), self.body)]))
+        if parts.path.rstrip("/") == "/rest/api/content":
+            data = json.loads(self.body)
+            with stub.lock:
+                if data["title"] in stub.confluence_pages:
+                    return self.send_json(400, dict(message="A page with this title already exists"))
+                stub.confluence_pages[data["title"]] = dict(
+                    id=str(1000 + len(stub.confluence_pages)),
+                    version=1,
+                    properties=stub.get_properties(data),
+                )
+                return self.send_json(200, stub.get_page_dict(data["title"]))
+        return self.send_json(404, dict(message="Not found"))
+
+    def handle_put(self, parts):
+        stub = self.server.stub
+        match = re.fullmatch(r"/rest/api/content/(\w+)", parts.path)
+        if match is None:
+            return self.send_json(404, dict(message="Not found"))
+        if self.headers.get("Content-Type", "").startswith("multipart/"):
+            # An attachment updated by its id
+            with stub.lock:
+                page_ids = [k for k, v in stub.attachments.items() if any(
+                    i["id"] == match.group(1) for i in v.values()
+                )]
+            if len(page_ids) == 0:
+                return self.send_json(404, dict(message="Not found"))
+            return self.send_json(200, stub.put_attachment(page_ids[0], self.body))
+        data = json.loads(self.body)
+        with stub.lock:
+            page = stub.confluence_pages.get(data["title"])
+            if page is None or page["id"] != match.group(1):
+                return self.send_json(404, dict(message="Not found"))
+            if data["version"]["number"] != page["version"] + 1:
+                return self.send_json(409, dict(message="Version conflict"))
+            page["version"] += 1
+            page["properties"] = stub.get_properties(data)
+            return self.send_json(200, stub.get_page_dict(data["title"]))
+
+
+class StubHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # The clients drop the kept-alive connections when they finish
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class StubServer:
+    def __init__(
+        self,
+        pages: int = 50,
+        repeat: int = 1,
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        file_size: int = 64 << 10,
+        large_file_size: int = 8 << 20,
+        seed: int = 0,
+        fixtures_dir: str = FIXTURES_DIR,
+    ):
+        self.pages = int(pages)
+        self.latency = float(latency)
+        self.error_rate = float(error_rate)
+        self.file_size = int(file_size)
+        self.large_file_size = int(large_file_size)
+        self.lock = Lock()
+        self._random = random.Random(seed)
+        self._random_lock = Lock()
+        self._file_contents = dict()
+        self.templates = [self.load_template(os.path.join(fixtures_dir, i), repeat) for i in sorted(
+            os.listdir(fixtures_dir)
+        ) if i.endswith(".html")]
+        self.confluence_pages = dict()
+        self.attachments = dict()
+        self.reset_confluence()
+        self.servers = list()
+        self.wiki_url = ""
+        self.confluence_url = ""
+
+    @staticmethod
+    def load_template(file: str, repeat: int):
+        # The title is replaced and the content of the page is repeated to get larger pages
+        with open(file, "rb") as f:
+            document = lxml_html.document_fromstring(f.read())
+        container = document.find_class("mw-parser-output")[0]
+        children = list(container)
+        for _ in range(max(1, int(repeat)) - 1):
+            for child in children:
+                container.append(deepcopy(child))
+        document.get_element_by_id("firstHeading").text = "{title}"
+        return dict(
+            page=lxml_html.tostring(document, encoding="unicode", doctype="<!DOCTYPE html>"),
+            text=lxml_html.tostring(container, encoding="unicode"),
+        )
+
+    def get_latency(self):
+        if self.latency <= 0:
+            return 0.0
+        with self._random_lock:
+            return self.latency * self._random.uniform(0.5, 1.5)
+
+    def is_error(self):
+        with self._random_lock:
+            return self._random.random() < self.error_rate
+
+    # Wiki
+
+    def get_titles(self):
+        return [f"{TITLE_PREFIX} {i}" for i in range(self.pages)]
+
+    def get_page_urls(self):
+        return [urlparse.urljoin(self.wiki_url, "index.php/{}".format(
+            urlparse.quote(i.replace(" ", "_"))
+        )) for i in self.get_titles()]
+
+    def get_index(self, title: str):
+        if not title.startswith(f"{TITLE_PREFIX} "):
+            return None
+        index = title[len(TITLE_PREFIX) + 1:]
+        if not index.isdigit() or int(index) >= self.pages:
+            return None
+        return int(index)
+
+    def get_page(self, title: str):
+        index = self.get_index(title)
+        if index is None:
+            return None
+        return self.templates[index % len(self.templates)]["page"].replace("{title}", title)
+
+    def get_revision(self, title: str):
+        index = self.get_index(title)
+        return None if index is None else 1000 + index
+
+    def get_title_by_revision(self, revision):
+        if revision is None or not str(revision).isdigit():
+            return None
+        return f"{TITLE_PREFIX} {int(revision) - 1000}"
+
+    def get_parsed_page(self, title: str):
+        index = self.get_index(title or "")
+        if index is None:
+            return None
+        return dict(
+            title=title,
+            revid=1000 + index,
+            displaytitle=f"<span class=\"mw-page-title-main\">{title}</span>",
+            text=self.templates[index % len(self.templates)]["text"],
+        )
+
+    @staticmethod
+    def get_file_path(name: str):
+        return f"images/0/00/{urlparse.quote(name)}"
+
+    def get_description_page(self, name: str):
+        return "<html><body><div id=\"file\"><a href=\"/{}\" class=\"internal\">{}</a></div></body></html>".format(
+            self.get_file_path(name), name
+        )
+
+    def get_file_size(self, name: str):
+        return self.large_file_size if LARGE_FILE_MARKER in name else self.file_size
+
+    def get_file_content(self, name: str):
+        with self.lock:
+            content = self._file_contents.get(name)
+            if content is None:
+                size = self.get_file_size(name)
+                seed = name.encode("utf-8") + b"\n"
+                content = self._file_contents[name] = (seed * (size // len(seed) + 1))[:size]
+            return content
+
+    # Confluence
+
+    def reset_confluence(self):
+        """
+        Remove all the pages but the parent one, so the next run creates the pages and uploads the attachments anew
+        """
+        with self.lock:
+            self.confluence_pages = {PARENT_PAGE_NAME: dict(id="1", version=1, properties=dict())}
+            self.attachments = dict()
+
+    @staticmethod
+    def get_properties(data: dict):
+        return {
+            k: dict(key=k, value=v["value"])
+            for k, v in data.get("metadata", dict()).get("properties", dict()).items()
+        }
+
+    def get_page_dict(self, title: str):
+        page = self.confluence_pages[title]
+        return dict(
+            id=page["id"],
+            type="page",
+            title=title,
+            version=dict(number=page["version"]),
+            metadata=dict(properties=page["properties"]),
+        )
+
+    def put_attachment(self, page_id: str, body: bytes):
+        name = re.search(rb"filename=\"([^\"]+)\"", body).group(1).decode("utf-8")
+        comment = re.search(rb"name=\"comment\"\r\n\r\n([^\r]*)", body)
+        with self.lock:
+            attachments = self.attachments.setdefault(page_id, dict())
+            attachment = attachments.setdefault(name, dict(id=f"att{page_id}{len(attachments)}"))
+            attachment["comment"] = comment.group(1).decode("utf-8") if comment is not None else ""
+            # The digest of the uploaded content rather than the content, so the uploads do not stay in memory
+            content = re.search(rb"filename=\"[^\"]+\"\r\n(?:[^\r\n]+\r\n)*\r\n(.*)\r\n--[^\r\n]+--\r\n$", body, re.DOTALL)
+            attachment["digest"] = sha256(content.group(1)).hexdigest() if content is not None else ""
+            return dict(id=attachment["id"], title=name)
+
+    # Servers
+
+    def start(self):
+        for handler_class in (WikiStubHandler, ConfluenceStubHandler):
+            server = StubHTTPServer(("127.0.0.1", 0), handler_class)
+            server.stub = self
+            Thread(target=server.serve_forever, daemon=True).start()
+            self.servers.append(server)
+        self.wiki_url = "http://127.0.0.1:{}/".format(self.servers[0].server_address[1])
+        self.confluence_url = "http://127.0.0.1:{}/".format(self.servers[1].server_address[1])
+        return self
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.servers = list()
+
+    def get_secret(self):
+        """
+        Return the secret dict pointing the handlers to the stub
+        """
+        return dict(
+            wiki_root_url=self.wiki_url,
+            wiki_ntlm_username="benchmark",
+            wiki_ntlm_password="benchmark",
+            confluence_root_url=self.confluence_url,
+            confluence_username="benchmark",
+            confluence_password="benchmark",
+            confluence_space_name=SPACE_NAME,
+            confluence_space_key="",
+            confluence_parent_page_name=PARENT_PAGE_NAME,
+            confluence_table_of_contents_header="Table of Contents",
+            wiki_cache_dir="",
+        )
@@ -0,0 +1,237 @@
+import os
+import json
+import shutil
+import logging
+import zipfile
+import warnings
+from time import localtime, time
+from hashlib import sha256
+from threading import Lock
+from tempfile import SpooledTemporaryFile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from utils import get_file_digest
+from metrics import metrics
+from constants import ATTACHMENT_SPOOL_SIZE, DOWNLOAD_CHUNK_SIZE, PIPELINE_UPLOAD_WORKERS
+
+BUNDLE_PAGES_DIR = "pages"
+BUNDLE_BLOBS_DIR = "blobs"
+BUNDLE_BODY_FILE = "body.xml"
+BUNDLE_META_FILE = "page.json"
+
+
+class BundleHandler:
+    """
+    Local bundle of processed pages, a directory or a ZIP file if the path ends with '.zip'.
+    Every page is stored as 'pages/<key>/body.xml' with the storage format body and 'pages/<key>/page.json'
+    with the title and the attachment list, the attachments are stored once per content as 'blobs/<sha256>'.
+    The metadata is written after the body and the attachments of the page,
+    so a page is complete once its metadata is present and the bundle may be read while being written.
+    Has the same 'push_page' as 'ConfluenceHandler', so the pipeline exports pages instead of uploading them.
+    """
+    def __init__(self, path: str):
+        self.path = os.path.realpath(path)
+        self.is_zip = self.path.lower().endswith(".zip")
+        self._zip = None
+        self._blobs = set()
+        self._lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            if self._zip is not None:
+                self._zip.close()
+                self._zip = None
+
+    @staticmethod
+    def get_page_key(page_title: str):
+        # The title is the identity of the page in Confluence space
+        return sha256(page_title.encode("utf-8")).hexdigest()[:16]
+
+    def open_zip(self, mode: str):
+        if self._zip is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # An existing ZIP bundle is appended to, so the pages skipped by the manifest are kept
+            self._zip = zipfile.ZipFile(self.path, mode, compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+            if mode != "r":
+                # The attachments of the previous exports are not written again
+                prefix = f"{BUNDLE_BLOBS_DIR}/"
+                self._blobs.update(i[len(prefix):] for i in self._zip.namelist() if i.startswith(prefix))
+        return self._zip
+
+    # Export
+
+    def write_file(self, name: str, file, compress_type: int = zipfile.ZIP_STORED):
+        file.seek(0)
+        if self.is_zip:
+            zip_info = zipfile.ZipInfo(name, date_time=localtime()[:6])
+            zip_info.compress_type = compress_type
+            with self._lock, warnings.catch_warnings():
+                # A page exported again is appended, the last copy is the one read
+                warnings.filterwarnings("ignore", "Duplicate name", UserWarning)
+                with self.open_zip("a").open(zip_info, "w", force_zip64=True) as f:
+                    shutil.copyfileobj(file, f, DOWNLOAD_CHUNK_SIZE)
+            return
+        path = os.path.join(self.path, *name.split("/"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Replaced at once, so an interrupted export leaves no partial files
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            shutil.copyfileobj(file, f, DOWNLOAD_CHUNK_SIZE)
+        os.replace(temp_path, path)
+
+    def write_bytes(self, name: str, content: bytes):
+        with SpooledTemporaryFile(max_size=ATTACHMENT_SPOOL_SIZE) as file:
+            file.write(content)
+            self.write_file(name, file, zipfile.ZIP_DEFLATED)
+
+    def write_blob(self, file, file_digest: str):
+        name = f"{BUNDLE_BLOBS_DIR}/{file_digest}"
+        with self._lock:
+            if self.is_zip:
+                self.open_zip("a")
+            is_written = file_digest in self._blobs or (
+                not self.is_zip and os.path.isfile(os.path.join(self.path, BUNDLE_BLOBS_DIR, file_digest))
+            )
+            self._blobs.add(file_digest)
+        if is_written:
+            return False
+        # The attachments are mostly compressed already
+        self.write_file(name, file)
+        return True
+
+    def push_page(self, page_title: str, page_body: str, page_attachments: list):
+        logging.debug(f"Export page {page_title} with {len(page_attachments)} attachments")
+        key = self.get_page_key(page_title)
+        attachments = dict()
+        skipped = list()
+        try:
+            for attachment_dict in page_attachments:
+                basename = attachment_dict["file_basename"]
+                if basename in attachments:
+                    continue
+                file_digest = attachment_dict.get("file_digest") or get_file_digest(attachment_dict["file_content"])
+                if not self.write_blob(attachment_dict["file_content"], file_digest):
+                    skipped.append(basename)
+                attachments[basename] = file_digest
+        finally:
+            for attachment_dict in page_attachments:
+                attachment_dict["file_content"].close()
+        self.write_bytes(f"{BUNDLE_PAGES_DIR}/{key}/{BUNDLE_BODY_FILE}", page_body.encode("utf-8"))
+        meta_dict = dict(
+            page_title=page_title,
+            attachments=[dict(file_basename=k, file_digest=v) for k, v in attachments.items()],
+            exported=time(),
+        )
+        self.write_bytes(
+            f"{BUNDLE_PAGES_DIR}/{key}/{BUNDLE_META_FILE}",
+            json.dumps(meta_dict, ensure_ascii=False, indent=4).encode("utf-8")
+        )
+        return dict(
+            succeeded=[i for i in attachments.keys() if i not in skipped],
+            failed=list(),
+            skipped=skipped,
+            is_page_updated=True,
+            page_id=key,
+            page_version=None,
+            attachments=attachments,
+        )
+
+    # Import
+
+    def list_pages(self):
+        """
+        Return the keys of the complete pages in the order of export
+        """
+        if self.is_zip:
+            with self._lock:
+                names = self.open_zip("r").namelist()
+            suffix = f"/{BUNDLE_META_FILE}"
+            keys = dict()
+            for name in names:
+                if name.startswith(f"{BUNDLE_PAGES_DIR}/") and name.endswith(suffix):
+                    key = name[len(BUNDLE_PAGES_DIR) + 1:-len(suffix)]
+                    keys.pop(key, None)
+                    keys[key] = None
+            return list(keys.keys())
+        pages_dir = os.path.join(self.path, BUNDLE_PAGES_DIR)
+        if not os.path.isdir(pages_dir):
+            return list()
+        keys = [i for i in os.listdir(pages_dir) if os.path.isfile(os.path.join(pages_dir, i, BUNDLE_META_FILE))]
+        return sorted(keys, key=lambda i: os.path.getmtime(os.path.join(pages_dir, i, BUNDLE_META_FILE)))
+
+    def open_file(self, name: str):
+        if not self.is_zip:
+            return open(os.path.join(self.path, *name.split("/")), "rb")
+        # The uploads read the attachments concurrently, so each one gets its own copy
+        file = SpooledTemporaryFile(max_size=ATTACHMENT_SPOOL_SIZE)
+        with self._lock, self.open_zip("r").open(name) as f:
+            shutil.copyfileobj(f, file, DOWNLOAD_CHUNK_SIZE)
+        file.seek(0)
+        return file
+
+    def read_page(self, key: str):
+        """
+        Return the processed page dict like the one of 'WikiHandler.process_content'
+        """
+        with self.open_file(f"{BUNDLE_PAGES_DIR}/{key}/{BUNDLE_META_FILE}") as f:
+            meta_dict = json.loads(f.read().decode("utf-8"))
+        with self.open_file(f"{BUNDLE_PAGES_DIR}/{key}/{BUNDLE_BODY_FILE}") as f:
+            page_body = f.read().decode("utf-8")
+        return dict(
+            page_title=meta_dict["page_title"],
+            page_body=page_body,
+            page_attachments=[
+                dict(
+                    file_content=self.open_file(f"{BUNDLE_BLOBS_DIR}/{i['file_digest']}"),
+                    file_basename=i["file_basename"],
+                    file_digest=i["file_digest"],
+                )
+                for i in meta_dict["attachments"]
+            ],
+        )
+
+    def upload(self, confluence_handler, upload_workers: int = PIPELINE_UPLOAD_WORKERS):
+        """
+        Push all the pages of the bundle into Confluence, return the lists of the succeeded and the failed titles.
+        The unchanged pages and attachments are skipped by 'ConfluenceHandler',
+        so the same bundle may be uploaded again to complete a failed upload.
+        """
+        keys = self.list_pages()
+        logging.info(f"Upload {len(keys)} pages from bundle '{self.path}'")
+        succeeded = list()
+        failed = list()
+
+        def push(key: str):
+            page_title = key
+            try:
+                processed_page_dict = self.read_page(key)
+                page_title = processed_page_dict["page_title"]
+                with metrics.measure("upload", key):
+                    result = confluence_handler.push_page(**processed_page_dict)
+            except Exception as e:
+                logging.exception(f"Failed to upload page '{page_title}': '{e}'")
+                return page_title, False
+            return page_title, len(result["failed"]) == 0
+
+        upload_workers = max(1, int(upload_workers))
+        with ThreadPoolExecutor(max_workers=upload_workers) as executor:
+            # Only a few pages are read ahead, so their attachments are not opened all at once
+            pending = set()
+            for idx, key in enumerate(keys):
+                logging.info(f"Upload page {idx + 1} of {len(keys)}")
+                if len(pending) >= upload_workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        page_title, is_succeeded = future.result()
+                        (succeeded if is_succeeded else failed).append(page_title)
+                pending.add(executor.submit(push, key))
+            for future in wait(pending).done:
+                page_title, is_succeeded = future.result()
+                (succeeded if is_succeeded else failed).append(page_title)
+        logging.info(f"{len(succeeded)} of {len(keys)} pages were uploaded, {len(failed)} failed")
+        return succeeded, failed
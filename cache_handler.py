@@ -0,0 +1,196 @@
+import os
+import logging
+import sqlite3
+from time import time
+from hashlib import sha256
+from shutil import copyfileobj
+from threading import Lock
+from tempfile import NamedTemporaryFile
+from constants import DOWNLOAD_CHUNK_SIZE, WIKI_CACHE_SIZE_LIMIT
+
+
+class CacheHandler:
+    """
+    Persistent HTTP cache: the response bodies are stored by their SHA-256 digests,
+    the index maps URLs to digests and the validators (ETag, Last-Modified) of the responses.
+    The least recently used entries are evicted when the total size exceeds the limit.
+    The URLs stored or revalidated in this run are fresh, they are served without requests.
+    The URLs found missing in this run, e.g. with 404, are not requested again either.
+    Both are forgotten by 'reset_instances' at the end of the run.
+    """
+    _instances = dict()
+    _instances_lock = Lock()
+
+    def __init__(self, directory: str, size_limit: int = WIKI_CACHE_SIZE_LIMIT):
+        self.directory = os.path.realpath(directory)
+        self.size_limit = int(size_limit)
+        self.fresh_urls = set()
+        self.missing_urls = set()
+        self._lock = Lock()
+        os.makedirs(os.path.join(self.directory, "blobs"), exist_ok=True)
+        self._db = sqlite3.connect(
+            os.path.join(self.directory, "index.sqlite"),
+            timeout=30,
+            check_same_thread=False
+        )
+        with self._lock, self._db:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    url TEXT PRIMARY KEY,
+                    digest TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    accessed REAL NOT NULL
+                )
+            """)
+            self._db.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        logging.debug(f"Cache opened: '{self.directory}'")
+
+    @classmethod
+    def get_instance(cls, directory: str, size_limit: int = WIKI_CACHE_SIZE_LIMIT):
+        # The handlers of the same directory share the instance, so they share the fresh URLs
+        with cls._instances_lock:
+            instance = cls._instances.get(os.path.realpath(directory))
+            if instance is None:
+                instance = cls(directory, size_limit)
+                cls._instances[instance.directory] = instance
+            return instance
+
+    @classmethod
+    def reset_instances(cls):
+        # The fresh and the missing URLs are known for the run only
+        with cls._instances_lock:
+            instances = list(cls._instances.values())
+        for instance in instances:
+            with instance._lock:
+                instance.fresh_urls.clear()
+                instance.missing_urls.clear()
+
+    @classmethod
+    def close_instance(cls, directory: str):
+        with cls._instances_lock:
+            instance = cls._instances.pop(os.path.realpath(directory), None)
+        if instance is not None:
+            with instance._lock:
+                instance._db.close()
+
+    def _get_blob_path(self, digest: str):
+        return os.path.join(self.directory, "blobs", digest[:2], digest)
+
+    def get(self, url: str):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT digest, size, etag, last_modified FROM entries WHERE url = ?", (url,)
+            ).fetchone()
+        if row is None:
+            return None
+        if not os.path.isfile(self._get_blob_path(row[0])):
+            logging.debug(f"The cached body is missing for '{url}'")
+            return None
+        return dict(digest=row[0], size=row[1], etag=row[2], last_modified=row[3])
+
+    @staticmethod
+    def get_conditional_headers(entry: dict):
+        headers = dict()
+        if entry is None:
+            return headers
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def read_into(self, url: str, file):
+        entry = self.get(url)
+        if entry is None:
+            return False
+        file.seek(0)
+        file.truncate()
+        try:
+            with open(self._get_blob_path(entry["digest"]), mode="rb") as f:
+                copyfileobj(f, file, DOWNLOAD_CHUNK_SIZE)
+        except OSError:
+            logging.debug(f"Unable to read the cached body for '{url}'")
+            return False
+        self.touch(url)
+        return True
+
+    def set_fresh(self, url: str):
+        with self._lock:
+            self.fresh_urls.add(url)
+
+    def is_fresh(self, url: str):
+        with self._lock:
+            return url in self.fresh_urls
+
+    def set_missing(self, url: str):
+        with self._lock:
+            self.missing_urls.add(url)
+
+    def is_missing(self, url: str):
+        with self._lock:
+            return url in self.missing_urls
+
+    def touch(self, url: str):
+        with self._lock, self._db:
+            self._db.execute("UPDATE entries SET accessed = ? WHERE url = ?", (time(), url))
+
+    def put(self, url: str, file, headers: dict = None):
+        """
+        Store the content of the readable binary file object, the file position is kept
+        """
+        if headers is None:
+            headers = dict()
+        position = file.tell()
+        file.seek(0)
+        os.makedirs(os.path.join(self.directory, "blobs", "tmp"), exist_ok=True)
+        hasher = sha256()
+        size = 0
+        with NamedTemporaryFile(dir=os.path.join(self.directory, "blobs", "tmp"), delete=False) as f:
+            temp_path = f.name
+            for chunk in iter(lambda: file.read(DOWNLOAD_CHUNK_SIZE), b""):
+                hasher.update(chunk)
+                size += len(chunk)
+                f.write(chunk)
+        file.seek(position)
+        digest = hasher.hexdigest()
+        path = self._get_blob_path(digest)
+        if os.path.isfile(path):
+            os.remove(temp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                (url, digest, size, headers.get("ETag"), headers.get("Last-Modified"), time())
+            )
+        logging.debug(f"Cached {size} bytes for '{url}'")
+        self.set_fresh(url)
+        self.evict()
+
+    def evict(self):
+        with self._lock, self._db:
+            total = self._db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT digest, size FROM entries)"
+            ).fetchone()[0]
+            if total <= self.size_limit:
+                return
+            for url, digest, size in self._db.execute(
+                "SELECT url, digest, size FROM entries ORDER BY accessed"
+            ).fetchall():
+                if total <= self.size_limit:
+                    break
+                self._db.execute("DELETE FROM entries WHERE url = ?", (url,))
+                self.fresh_urls.discard(url)
+                is_shared = self._db.execute(
+                    "SELECT 1 FROM entries WHERE digest = ? LIMIT 1", (digest,)
+                ).fetchone() is not None
+                if not is_shared:
+                    total -= size
+                    try:
+                        os.remove(self._get_blob_path(digest))
+                    except OSError:
+                        pass
+                logging.debug(f"Evicted from cache: '{url}'")
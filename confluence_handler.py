@@ -1,78 +1,464 @@
 
+import os
 import logging
 import atlassian
+from io import BytesIO
+from time import sleep
+from uuid import uuid4
+from typing import BinaryIO
+from threading import BoundedSemaphore, Lock
+from concurrent.futures import ThreadPoolExecutor
+from atlassian.errors import ApiNotFoundError, ApiPermissionError
+from requests import HTTPError, Session
+from requests import exceptions as requests_exceptions
 from connection_handler import ConnectionHandler
+from rate_limiter import mount_rate_limiter
+from metrics import metrics
+from utils import get_backoff_seconds, get_body_fingerprint
+from constants import (
+    CONFLUENCE_ATTACHMENT_DIGEST_COMMENT,
+    CONFLUENCE_CONNECT_RETRIES,
+    CONFLUENCE_FINGERPRINT_PROPERTY,
+    CONFLUENCE_LISTING_LIMIT,
+    CONFLUENCE_UPLOAD_LIMIT,
+    CONFLUENCE_UPLOAD_RETRIES,
+    CONFLUENCE_UPLOAD_WORKERS,
+    DOWNLOAD_CHUNK_SIZE,
+    RETRY_STATUS_CODES,
+)
+
+
+class MultipartStream:
+    """
+    Multipart form body of the fields and the file, read from the file chunk by chunk while it is sent,
+    so an upload does not hold the attachment in memory. The length is known beforehand,
+    so the body is sent with 'Content-Length' rather than chunked
+    """
+    def __init__(self, fields: dict, file_name: str, file: BinaryIO, content_type: str = "application/binary"):
+        boundary = uuid4().hex
+        head = b"".join(
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"{k}\"\r\n\r\n{v}\r\n".encode("utf-8")
+            for k, v in fields.items()
+        ) + (
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{file_name}\"\r\n"
+            f"Content-Type: {content_type}\r\n\r\n"
+        ).encode("utf-8")
+        tail = f"\r\n--{boundary}--\r\n".encode("utf-8")
+        size = file.seek(0, os.SEEK_END)
+        file.seek(0)
+        self.length = len(head) + size + len(tail)
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        self._parts = [BytesIO(head), file, BytesIO(tail)]
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size: int = -1):
+        chunks = list()
+        while len(self._parts) > 0 and size != 0:
+            chunk = self._parts[0].read(size)
+            if len(chunk) == 0:
+                self._parts.pop(0)
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b"".join(chunks)
+
+    def __iter__(self):
+        return iter(lambda: self.read(DOWNLOAD_CHUNK_SIZE), b"")
 
 
 class ConfluenceHandler(ConnectionHandler):
-    def __init__(self):
+    def __init__(
+        self,
+        upload_workers: int = None,
+        upload_limit: int = None,
+        upload_retries: int = None,
+    ):
         super().__init__()
         self.space_key = ""
         self.parent_page_id = ""
+        # The limits not given are taken from 'secret.json'
+        if upload_workers is None:
+            upload_workers = self._secret_dict.get("confluence_upload_workers", CONFLUENCE_UPLOAD_WORKERS)
+        if upload_limit is None:
+            upload_limit = self._secret_dict.get("confluence_upload_limit", CONFLUENCE_UPLOAD_LIMIT)
+        if upload_retries is None:
+            upload_retries = self._secret_dict.get("confluence_upload_retries", CONFLUENCE_UPLOAD_RETRIES)
+        self.upload_workers = max(1, int(upload_workers))
+        self.upload_retries = max(1, int(upload_retries))
+        # Limits the uploads of all the pages pushed concurrently, e.g. by the pipeline
+        self._upload_semaphore = BoundedSemaphore(max(1, int(upload_limit)))
+        # Page title -> dict(id=..., version=..., fingerprint=...) for the pages of the space, filled on connection
+        self.page_index = dict()
+        self._lock = Lock()
+        self._connect_lock = Lock()
+        # The connection failure that does not go away, e.g. of wrong credentials, fails the following pushes at once
+        self._connect_error = None
 
     def connect(self):
+        # The attachments are uploaded over the same authenticated session, see 'push_blob'
+        self.session = mount_rate_limiter(Session())
         self.client = atlassian.Confluence(
             url=self._secret_dict["confluence_root_url"],
             username=self._secret_dict["confluence_username"],
-            password=self._secret_dict["confluence_password"]
+            password=self._secret_dict["confluence_password"],
+            session=self.session,
         )
-        self.space_key = [
-            i for i in self.client.get_all_spaces()["results"]
-            if i["name"] == self._secret_dict["confluence_space_name"]
-        ][0]["key"]
-        self.parent_page_id = self.client.get_page_id(
-            self.space_key,
-            self._secret_dict["confluence_parent_page_name"]
+        self.space_key = self._secret_dict.get("confluence_space_key") or self.find_space_key(
+            self._secret_dict["confluence_space_name"]
         )
+        self.build_page_index()
+        parent_page_name = self._secret_dict["confluence_parent_page_name"]
+        parent_page = self.get_indexed_page(parent_page_name)
+        if parent_page is not None:
+            self.parent_page_id = parent_page["id"]
+        else:
+            self.parent_page_id = self.client.get_page_id(self.space_key, parent_page_name)
+        if len(parent_page_name) > 0 and not self.parent_page_id:
+            raise ValueError(f"Confluence parent page not found: '{parent_page_name}'")
         logging.debug("Confluence client connected")
         super().connect()
 
+    def ensure_connected(self):
+        # The space and the pages are looked up by the first push rather than on start,
+        # so the pages are fetched and transformed meanwhile
+        with self._connect_lock:
+            if self._connect_error is not None:
+                raise ValueError(f"Confluence is not connected: '{self._connect_error}'")
+            for retry in range(1, CONFLUENCE_CONNECT_RETRIES + 1):
+                if self.is_connected:
+                    return
+                retry_after = None
+                try:
+                    self.connect()
+                except HTTPError as e:
+                    code = e.response.status_code if e.response is not None else None
+                    if code in (401, 403):
+                        self._connect_error = e
+                    if code not in RETRY_STATUS_CODES or retry == CONFLUENCE_CONNECT_RETRIES:
+                        logging.critical(f"Unable to connect to Confluence: '{e}'")
+                        raise
+                    logging.warning(f"Got response with status {code} while connecting to Confluence")
+                    retry_after = e.response.headers.get("Retry-After")
+                except (requests_exceptions.ConnectionError, requests_exceptions.Timeout) as e:
+                    # The next push tries to connect again
+                    if retry == CONFLUENCE_CONNECT_RETRIES:
+                        logging.critical(f"Unable to connect to Confluence: '{e}'")
+                        raise
+                    logging.warning(f"Got network error while connecting to Confluence: '{e}'")
+                except (ApiPermissionError, ApiNotFoundError, ValueError) as e:
+                    # Wrong credentials, space or parent page
+                    self._connect_error = e
+                    logging.critical(f"Unable to connect to Confluence: '{e}'")
+                    raise
+                seconds = get_backoff_seconds(retry, retry_after)
+                logging.info(f"Wait {seconds:.1f} seconds before the next attempt")
+                sleep(seconds)
+
+    def find_space_key(self, space_name: str):
+        start = 0
+        while True:
+            response = self.client.get_all_spaces(start=start, limit=CONFLUENCE_LISTING_LIMIT)
+            results = response.get("results", list())
+            for space_dict in results:
+                if space_dict["name"] == space_name:
+                    return space_dict["key"]
+            if len(results) == 0 or "next" not in response.get("_links", dict()):
+                break
+            start += len(results)
+        raise ValueError(f"Confluence space not found: '{space_name}'")
+
+    def build_page_index(self):
+        page_index = dict()
+        start = 0
+        while True:
+            response = self.client.get_all_pages_from_space_raw(
+                self.space_key,
+                start=start,
+                limit=CONFLUENCE_LISTING_LIMIT,
+                status="current",
+                expand=f"version,metadata.properties.{CONFLUENCE_FINGERPRINT_PROPERTY}",
+                content_type="page"
+            )
+            results = response.get("results", list())
+            for page_dict in results:
+                page_index[page_dict["title"]] = self.get_page_entry(page_dict)
+            if len(results) == 0 or "next" not in response.get("_links", dict()):
+                break
+            start += len(results)
+        with self._lock:
+            self.page_index = page_index
+        logging.debug(f"Indexed {len(page_index)} pages of the space with the key '{self.space_key}'")
+
+    @staticmethod
+    def get_page_entry(page_dict: dict):
+        # The fingerprint is valid only for the version it was pushed with, otherwise the page was edited since
+        value = (
+            page_dict.get("metadata", dict()).get("properties", dict())
+            .get(CONFLUENCE_FINGERPRINT_PROPERTY, dict()).get("value")
+        ) or dict()
+        version = page_dict["version"]["number"]
+        return dict(
+            id=page_dict["id"],
+            version=version,
+            fingerprint=value.get("fingerprint") if value.get("version") == version else None
+        )
+
+    def get_indexed_page(self, page_title: str):
+        with self._lock:
+            return self.page_index.get(page_title)
+
+    def set_indexed_page(self, page_title: str, page_dict: dict, fingerprint: str = None):
+        entry = self.get_page_entry(page_dict)
+        if fingerprint is not None:  # The responses of create and update do not expand the properties
+            entry["fingerprint"] = fingerprint
+        with self._lock:
+            self.page_index[page_title] = entry
+
+    def refresh_indexed_page(self, page_title: str):
+        # The page was created or changed by someone else after the index had been built
+        page_dict = self.client.get_page_by_title(
+            self.space_key,
+            page_title,
+            expand=f"version,metadata.properties.{CONFLUENCE_FINGERPRINT_PROPERTY}"
+        )
+        if page_dict is not None and "results" in page_dict:  # The listing instead of the page in newer clients
+            page_dict = (page_dict["results"] or [None])[0]
+        if page_dict is None:
+            with self._lock:
+                self.page_index.pop(page_title, None)
+            return None
+        self.set_indexed_page(page_title, page_dict)
+        return self.get_indexed_page(page_title)
+
+    def get_page_data(self, page_title: str, page_body: str, version: int):
+        # Same request body as of 'Confluence.create_page' and 'Confluence.update_page',
+        # the fingerprint of the body is stored along with the page
+        data = {
+            "type": "page",
+            "title": page_title,
+            "space": {"key": self.space_key},
+            "body": {"storage": {"value": page_body, "representation": "storage"}},
+            "metadata": {"properties": {
+                "content-appearance-draft": {"value": "fixed-width"},
+                "content-appearance-published": {"value": "fixed-width"},
+                CONFLUENCE_FINGERPRINT_PROPERTY: {"value": {
+                    "fingerprint": get_body_fingerprint(page_body),
+                    "version": version,
+                }},
+            }},
+        }
+        if self.parent_page_id:
+            data["ancestors"] = [{"type": "page", "id": self.parent_page_id}]
+        return data
+
+    def create_page(self, page_title: str, page_body: str):
+        logging.debug("Create the page with the name '{}' into the space with the key '{}'".format(
+            page_title, self.space_key
+        ))
+        data = self.get_page_data(page_title, page_body, 1)
+        data["status"] = "current"
+        data["metadata"]["properties"]["editor"] = {"value": "v2"}
+        return self.client.post("rest/api/content/", data=data)
+
+    def update_page(self, page_title: str, page_body: str, page: dict):
+        # The version is taken from the index instead of requesting the page history
+        logging.debug("Update the page with the name '{}' into the space with the key '{}'".format(
+            page_title, self.space_key
+        ))
+        data = self.get_page_data(page_title, page_body, page["version"] + 1)
+        data["id"] = page["id"]
+        data["version"] = {"number": page["version"] + 1, "minorEdit": False}
+        return self.client.put(f"rest/api/content/{page['id']}", data=data, params={"status": "current"})
+
     def push_html(self, page_title: str, page_body: str):
+        """
+        Create or update the page, return False if the page has the same body already
+        """
         if not self.is_connected:
             logging.warning("Confluence client is not connected")
-            return
-        if self.client.page_exists(self.space_key, page_title, type=None):
-            logging.debug("Update the page with the name '{}' into the space with the key '{}'".format(
-                page_title, self.space_key
-            ))
-            o = self.client.update_page(
-                page_id=self.client.get_page_id(self.space_key, page_title),
-                title=page_title,
-                body=page_body,
-                parent_id=self.parent_page_id,
-                type="page",
-                representation="storage",
-                minor_edit=False,
-                full_width=False
-            )
-        else:
-            logging.debug("Create the page with the name '{}' into the space with the key '{}'".format(
-                page_title, self.space_key
-            ))
-            o = self.client.create_page(
-                space=self.space_key,
-                title=page_title,
-                body=page_body,
-                parent_id=self.parent_page_id,
-                type="page",
-                representation="storage",
-                editor="v2",
-                full_width=False
+            return False
+        page = self.get_indexed_page(page_title)
+        fingerprint = get_body_fingerprint(page_body)
+        if page is not None and page["fingerprint"] == fingerprint:
+            logging.debug(f"Skip the update of the unchanged page '{page_title}'")
+            return False
+        try:
+            if page is not None:
+                o = self.update_page(page_title, page_body, page)
+            else:
+                o = self.create_page(page_title, page_body)
+        except HTTPError as e:
+            # A version conflict or a title taken since the index was built
+            logging.warning(f"Unable to push the page '{page_title}', retry with the actual version: '{e}'")
+            metrics.add(retries=1)
+            page = self.refresh_indexed_page(page_title)
+            if page is not None:
+                o = self.update_page(page_title, page_body, page)
+            else:
+                o = self.create_page(page_title, page_body)
+        self.set_indexed_page(page_title, o, fingerprint)
+        metrics.add(bytes=len(page_body.encode("utf-8")))
+        return True
+
+    def get_attachment_digests(self, page_id: str):
+        # Attachment name -> SHA-256 of the content, for the attachments uploaded with the digest comment
+        digests = dict()
+        prefix, suffix = CONFLUENCE_ATTACHMENT_DIGEST_COMMENT.split("{digest}")
+        start = 0
+        while True:
+            response = self.client.get_attachments_from_content(
+                page_id,
+                start=start,
+                limit=CONFLUENCE_LISTING_LIMIT,
+                expand="version"
             )
+            results = response.get("results", list())
+            for attachment_dict in results:
+                comment = (
+                    attachment_dict.get("metadata", dict()).get("comment")
+                    or attachment_dict.get("extensions", dict()).get("comment")
+                    or ""
+                )
+                if comment.startswith(prefix) and comment.endswith(suffix):
+                    digests[attachment_dict["title"]] = comment[len(prefix):len(comment) - len(suffix)]
+            if len(results) == 0 or "next" not in response.get("_links", dict()):
+                break
+            start += len(results)
+        return digests
 
-    def push_blob(self, file_content: bytes, file_basename: str, page_title: str):
+    def push_blob(self, file_content: BinaryIO, file_basename: str, page_title: str, file_digest: str = None):
+        """
+        Upload the file as the attachment of the page, a new version if the page has the attachment of this name.
+        Unlike 'attach_content' of the client, which makes requests build the whole multipart body in memory,
+        the body is streamed from the file
+        """
         logging.debug(f"Upload attachment '{file_basename}' into created page '{page_title}'")
-        o = self.client.attach_content(
-            content=bytes(file_content),
-            name=file_basename,
-            page_id=self.client.get_page_id(self.space_key, page_title),
-            title=page_title,
-            space=self.space_key
+        size = file_content.seek(0, os.SEEK_END)
+        page_id = self.get_indexed_page(page_title)["id"]
+        path = f"rest/api/content/{page_id}/child/attachment"
+        response = self.client.get_attachments_from_content(page_id, filename=file_basename)
+        for attachment_dict in response.get("results", list()):
+            if attachment_dict["title"] == file_basename:
+                path = "{}/{}/data".format(path, attachment_dict["id"])
+                break
+        body = MultipartStream(
+            dict(
+                comment=CONFLUENCE_ATTACHMENT_DIGEST_COMMENT.format(digest=file_digest)
+                if file_digest else f"Uploaded {file_basename}.",
+                minorEdit="true",
+            ),
+            file_basename,
+            file_content,
         )
+        response = self.session.post(
+            self.client.url_joiner(self.client.url, path),
+            data=body,
+            headers={"X-Atlassian-Token": "no-check", "Accept": "application/json", "Content-Type": body.content_type},
+            timeout=self.client.timeout,
+            verify=self.client.verify_ssl,
+        )
+        self.client.raise_for_status(response)
+        metrics.add(bytes=size)
+
+    def push_blob_with_retries(self, file_content: BinaryIO, file_basename: str, page_title: str, **kwargs):
+        for retry in range(1, self.upload_retries + 1):
+            retry_after = None
+            try:
+                with self._upload_semaphore:
+                    self.push_blob(file_content, file_basename, page_title, **kwargs)
+                return
+            except HTTPError as e:
+                code = e.response.status_code if e.response is not None else None
+                if code not in RETRY_STATUS_CODES or retry == self.upload_retries:
+                    raise
+                logging.warning(f"Got response with status {code} for attachment '{file_basename}'")
+                retry_after = e.response.headers.get("Retry-After")
+            except (requests_exceptions.ConnectionError, requests_exceptions.Timeout) as e:
+                if retry == self.upload_retries:
+                    raise
+                logging.warning(f"Got network error for attachment '{file_basename}': '{e}'")
+            seconds = get_backoff_seconds(retry, retry_after)
+            logging.info(f"Wait {seconds:.1f} seconds before the next attempt")
+            metrics.add(retries=1)
+            sleep(seconds)
+
+    def push_attachments(self, page_title: str, page_attachments: list):
+        """
+        Upload the attachments concurrently, every one is retried on its own.
+        Returns the names of the uploaded attachments and the dict of the failed ones with reasons
+        """
+        succeeded = list()
+        failed = dict()
+        if len(page_attachments) == 0:
+            return succeeded, failed
+        url, stage = metrics.get_context()
+
+        def push(attachment_dict: dict):
+            # The requests of the pool threads are counted under the page being pushed
+            with metrics.bind(url, stage):
+                self.push_blob_with_retries(page_title=page_title, **attachment_dict)
+
+        with ThreadPoolExecutor(
+            max_workers=min(self.upload_workers, len(page_attachments)),
+            thread_name_prefix="push_blob"
+        ) as executor:
+            futures = [
+                (attachment_dict["file_basename"], executor.submit(push, attachment_dict))
+                for attachment_dict in page_attachments
+            ]
+        for file_basename, future in futures:
+            e = future.exception()
+            if e is None:
+                succeeded.append(file_basename)
+            else:
+                logging.error(f"Failed to upload attachment '{file_basename}' into page '{page_title}': '{e}'")
+                failed[file_basename] = str(e)
+        return succeeded, failed
 
     def push_page(self, page_title: str, page_body: str, page_attachments: list):
         logging.debug(f"Upload page {page_title} with {len(page_attachments)} attachments")
-        self.push_html(page_title, page_body)
+        # The same file may be linked many times, concurrent uploads of the same name would conflict
+        unique_attachments = dict()
         for attachment_dict in page_attachments:
-            self.push_blob(page_title=page_title, **attachment_dict)
-
+            unique_attachments.setdefault(attachment_dict["file_basename"], attachment_dict)
+        unique_attachments = list(unique_attachments.values())
+        skipped = list()
+        try:
+            self.ensure_connected()
+            is_new_page = self.get_indexed_page(page_title) is None
+            is_page_updated = self.push_html(page_title, page_body)
+            if not is_new_page and len(unique_attachments) > 0:
+                digests = self.get_attachment_digests(self.get_indexed_page(page_title)["id"])
+                changed_attachments = list()
+                for attachment_dict in unique_attachments:
+                    file_digest = attachment_dict.get("file_digest")
+                    if file_digest is not None and digests.get(attachment_dict["file_basename"]) == file_digest:
+                        skipped.append(attachment_dict["file_basename"])
+                    else:
+                        changed_attachments.append(attachment_dict)
+                if len(skipped) > 0:
+                    logging.debug(f"Skip {len(skipped)} unchanged attachments of page '{page_title}'")
+                unique_attachments = changed_attachments
+            succeeded, failed = self.push_attachments(page_title, unique_attachments)
+        finally:
+            for attachment_dict in page_attachments:
+                attachment_dict["file_content"].close()
+        if len(failed) > 0:
+            logging.warning(f"{len(failed)} of {len(unique_attachments)} attachments failed for page '{page_title}'")
+        page = self.get_indexed_page(page_title) or dict(id=None, version=None)
+        return dict(
+            succeeded=succeeded,
+            failed=failed,
+            skipped=skipped,
+            is_page_updated=is_page_updated,
+            page_id=page["id"],
+            page_version=page["version"],
+            # The digests of the attachments present on the page after the push
+            attachments={
+                i["file_basename"]: i.get("file_digest") for i in page_attachments
+                if i["file_basename"] in succeeded or i["file_basename"] in skipped
+            },
+        )
@@ -3,10 +3,55 @@ import os
 
 FILE_EXTENSIONS = ("sql", "docx", "pptx")
 WAIT_SECONDS = 3
+WAIT_SECONDS_LIMIT = 60
+# Statuses considered temporary, the request is retried after a delay
+RETRY_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+WIKI_REQUEST_TIMEOUT = (10, 120)  # Connect and read timeouts, seconds
+DOWNLOAD_CHUNK_SIZE = 1 << 16  # 64 KB
+ATTACHMENT_SPOOL_SIZE = 1 << 20  # 1 MB, larger attachments are kept in temporary files
+# The comment left in place of a link when the page is transformed apart from downloading of its attachments
+ATTACHMENT_MARKER = "wiki-export-attachment:{index}"
 LOGGING_TEMPLATE = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+LOGGING_LEVEL = "INFO"  # "DEBUG" logs every tag and every page body
 SECRET_JSON_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "secret.json")
 USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/113.0.0.0 Safari/537.36"
 CONFLUENCE_ATTACHMENT_SIZE_LIMIT = 30 << 20  # 30 MB
+CONFLUENCE_LISTING_LIMIT = 100  # Items per request when listing spaces and pages
+CONFLUENCE_UPLOAD_WORKERS = 4  # Concurrent attachment uploads of a page
+CONFLUENCE_UPLOAD_LIMIT = 8  # Concurrent attachment uploads of all pages
+CONFLUENCE_UPLOAD_RETRIES = 3
+CONFLUENCE_CONNECT_RETRIES = 5  # Attempts to connect on network errors, the others fail the run at once
+# The comment of an uploaded attachment keeps the SHA-256 of its content, so unchanged files are not uploaded again
+CONFLUENCE_ATTACHMENT_DIGEST_COMMENT = "sha256:{digest}"
+# The content property keeping the fingerprint of the pushed body, so unchanged pages are not updated again
+CONFLUENCE_FINGERPRINT_PROPERTY = "wiki-export-fingerprint"
+WIKI_CACHE_SIZE_LIMIT = 4 << 30  # 4 GB
+WIKI_API_BATCH_SIZE = 50  # Titles per MediaWiki API query, the limit for the regular users
+WIKI_SESSION_POOL_SIZE = 16  # Keep-alive sessions shared by the Wiki handlers, the limit of concurrent requests
+WIKI_HOST_CONCURRENCY = 8  # Concurrent requests to a single host
+
+# Adaptive limits of the requests to every host, the upper bounds while the server responds well
+RATE_LIMIT_RATE = 50.0  # Requests per second
+RATE_LIMIT_BURST = 10  # Requests sent at once after idling
+RATE_LIMIT_CONCURRENCY = 8  # Requests in flight
+RATE_LIMIT_LATENCY_TOLERANCE = 3.0  # The limits are decreased when the recent latency grows this many times
+
+# Concurrent pipeline: worker threads per stage and the capacity of queues between the stages
+PIPELINE_FETCH_WORKERS = 4
+PIPELINE_TRANSFORM_WORKERS = 2
+PIPELINE_UPLOAD_WORKERS = 2
+PIPELINE_TRANSFORM_PROCESSES = 0  # Worker processes of the transform stage, 0 to transform in the threads
+PIPELINE_QUEUE_SIZE = 8
+
+# Recompression of large images, see 'MediaHandler'
+MEDIA_SIZE_THRESHOLD = 2 << 20  # 2 MB, the smaller images are uploaded as they are
+MEDIA_MAX_DIMENSION = 2560  # Pixels, the larger images are downsampled to fit
+MEDIA_QUALITY = 85  # JPEG and WebP quality
+MEDIA_WORKERS = 4
+MEDIA_DOWNLOAD_SIZE_LIMIT = 256 << 20  # 256 MB, the images to reduce below Confluence limits
+
+PDF_EXTRACT_PROCESSES = 0  # Worker processes reading the page ranges of the PDF file, 0 to read it in place
+PDF_PAGES_PER_TASK = 100  # Pages of the PDF file read by a worker process at once
 
 # <ac:link>...</ac:link>
 # https://confluence.atlassian.com/conf710/confluence-storage-format-1031840114.html#ConfluenceStorageFormat-Links
@@ -35,4 +80,9 @@ TEMPLATE_SPOILED_IMAGE = """
 </ac:rich-text-body>
 """
 
+# <ac:structured-macro ac:name="toc" />
+# https://confluence.atlassian.com/doc/table-of-contents-macro-182682099.html
+TEMPLATE_TABLE_OF_CONTENTS = '<b id="toc">{header}</b><ac:structured-macro ac:name="toc" />'
+
 WIKI_ATTACHMENT_PAGE_PREFIXES = ("Медиа", "Файл")
+WIKI_FLASH_PLAYER_PATH = "/extensions/wikiFlvPlayer/player.swf"
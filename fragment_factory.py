@@ -0,0 +1,74 @@
+from threading import Lock
+from bs4 import BeautifulSoup
+from bs4.element import CData, Tag
+
+
+def fill_placeholders(s: str, kwargs: dict) -> str:
+    if "{" in s:
+        return s.format(**kwargs)
+    return s
+
+
+class FragmentFactory:
+    """
+    Creates the elements from Confluence storage format templates like 'TEMPLATE_HYPERLINK'.
+    Every template is parsed once into a skeleton with the placeholders like '{basename}' kept as is,
+    then each element is built from the skeleton with the placeholders filled in.
+    The values are set as text and attribute values, so they are escaped on serialization
+    and never parsed as markup.
+    """
+    def __init__(self):
+        self._skeletons = dict()
+        self._lock = Lock()
+
+    @staticmethod
+    def compile(node):
+        # The skeleton is a tree of tuples, building tags from it is cheaper than copying a parsed tree
+        if isinstance(node, Tag):
+            return node.name, dict(node.attrs), node.can_be_empty_element, [
+                FragmentFactory.compile(i) for i in node.children
+            ]
+        return type(node), str(node)
+
+    def parse(self, template: str):
+        # Not 'template', the HTML parser keeps the content of such element as a single string
+        return self.compile(BeautifulSoup(
+            f"<div>{template}</div>", "html.parser"  # Keeps elements like '<![CDATA[...]]>'
+        ).find("div"))
+
+    @staticmethod
+    def build_node(skeleton, kwargs: dict):
+        if len(skeleton) == 2:
+            string_class, s = skeleton
+            s = fill_placeholders(s, kwargs)
+            if string_class is CData:
+                # A value can not close the section
+                s = s.replace("]]>", "]]]]><![CDATA[>")
+            return string_class(s)
+        name, attrs, can_be_empty_element, children = skeleton
+        tag = Tag(
+            name=name,
+            attrs={k: fill_placeholders(v, kwargs) if isinstance(v, str) else list(v) for k, v in attrs.items()},
+            can_be_empty_element=can_be_empty_element
+        )
+        for child in children:
+            tag.append(FragmentFactory.build_node(child, kwargs))
+        return tag
+
+    def build(self, skeleton, name: str, attrs: dict, kwargs: dict):
+        tag = self.build_node(skeleton, kwargs)
+        tag.name = name
+        for key, value in attrs.items():
+            tag[key] = value
+        return tag
+
+    def get_skeleton(self, template: str):
+        skeleton = self._skeletons.get(template)
+        if skeleton is None:
+            skeleton = self.parse(template)
+            with self._lock:
+                skeleton = self._skeletons.setdefault(template, skeleton)
+        return skeleton
+
+    def create(self, name: str, template: str, attrs: dict = None, **kwargs):
+        return self.build(self.get_skeleton(template), name, attrs or dict(), kwargs)
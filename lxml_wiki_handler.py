@@ -0,0 +1,291 @@
+import logging
+from copy import deepcopy
+from lxml import etree
+from lxml import html as lxml_html
+from rule_engine import RuleEngine
+from fragment_factory import FragmentFactory, fill_placeholders
+from wiki_handler import WikiHandler
+from utils import process_string
+
+# The elements BeautifulSoup writes without the closing tag
+VOID_ELEMENTS = {
+    "area", "base", "basefont", "bgsound", "br", "col", "command", "embed", "frame", "hr", "image", "img",
+    "input", "isindex", "keygen", "link", "menuitem", "meta", "nextid", "param", "source", "spacer", "track", "wbr",
+}
+# Confluence storage format keeps the text of these elements as CDATA
+CDATA_ELEMENTS = ("ac:plain-text-body", "ac:plain-text-link-body")
+# BeautifulSoup does not count the content of these elements as text, so it is cleared like blank strings
+SCRIPT_ELEMENTS = ("script", "style")
+
+
+def is_blank(s) -> bool:
+    return s is not None and len(process_string(s)) == 0
+
+
+def escape_text(s: str) -> str:
+    return s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def quote_attribute(s: str) -> str:
+    s = escape_text(s)
+    if "\"" not in s:
+        return f"\"{s}\""
+    if "'" not in s:
+        return f"'{s}'"
+    return "\"{}\"".format(s.replace("\"", "&quot;"))
+
+
+def serialize_element(element, parts: list):
+    # The output follows the one of BeautifulSoup, so both backends produce the same storage format
+    if not isinstance(element.tag, str):
+        if element.tag is etree.Comment:
+            parts.append(f"<!--{element.text or ''}-->")
+    else:
+        name = element.tag
+        parts.append(f"<{name}")
+        for key, value in sorted(element.attrib.items()):
+            parts.append(f" {key}={quote_attribute(value)}")
+        if name in VOID_ELEMENTS:
+            parts.append("/>")
+        else:
+            parts.append(">")
+            if element.text is not None:
+                if name in CDATA_ELEMENTS:
+                    parts.append("<![CDATA[{}]]>".format(element.text.replace("]]>", "]]]]><![CDATA[>")))
+                elif name in SCRIPT_ELEMENTS:
+                    parts.append(element.text)
+                else:
+                    parts.append(escape_text(element.text))
+            for child in element:
+                serialize_element(child, parts)
+            parts.append(f"</{name}>")
+    if element.tail is not None:
+        parts.append(escape_text(element.tail))
+
+
+def create_element(name: str, attrs: dict = None):
+    # The HTML parser accepts the prefixed names like 'ac:link', unlike 'lxml.etree.Element'
+    return lxml_html.html_parser.makeelement(name, attrs if attrs is not None else dict())
+
+
+def convert_template_element(element, prefixes: dict):
+    def get_name(s: str):
+        qname = etree.QName(s)
+        if qname.namespace is None:
+            return qname.localname
+        return f"{prefixes[qname.namespace]}:{qname.localname}"
+
+    def normalize(s):
+        # Blank strings are reduced the same way as BeautifulSoup does
+        if is_blank(s):
+            return "\n" if "\n" in s else " "
+        return s
+
+    out = create_element(get_name(element.tag), {get_name(k): v for k, v in element.attrib.items()})
+    if out.tag in CDATA_ELEMENTS:
+        out.text = (element.text or "").strip()
+    elif element.text is not None:
+        out.text = normalize(element.text)
+    for child in element:
+        if isinstance(child.tag, str):
+            out.append(convert_template_element(child, prefixes))
+    if element.tail is not None:
+        out.tail = normalize(element.tail)
+    return out
+
+
+def parse_template(template: str):
+    """
+    Parse Confluence storage format template into the element named 'template',
+    the placeholders like '{basename}' are kept as is
+    """
+    prefixes = {f"urn:confluence:{i}": i for i in ("ac", "ri")}
+    root = etree.fromstring(
+        "<template {}>{}</template>".format(
+            " ".join(f"xmlns:{v}=\"{k}\"" for k, v in prefixes.items()),
+            template
+        ),
+        parser=etree.XMLParser(strip_cdata=False, resolve_entities=False)
+    )
+    return convert_template_element(root, prefixes)
+
+
+class LxmlRuleEngine(RuleEngine):
+    @staticmethod
+    def get_name(node):
+        if not isinstance(node.tag, str):  # Comments and processing instructions
+            return None
+        return node.tag
+
+    @staticmethod
+    def get_attribute(node, attribute: str):
+        value = node.get(attribute)
+        if value is not None and attribute == "class":
+            value = (value.split() or [None])[0]
+        return value
+
+    @staticmethod
+    def get_children(node):
+        return list(node)
+
+
+class LxmlFragmentFactory(FragmentFactory):
+    def parse(self, template: str):
+        return parse_template(template)
+
+    def build(self, skeleton, name: str, attrs: dict, kwargs: dict):
+        # CDATA and escaping are left to 'serialize_element'
+        element = deepcopy(skeleton)
+        element.tag = name
+        for key, value in attrs.items():
+            element.set(key, value)
+        for i in element.iter():
+            for key, value in i.attrib.items():
+                if "{" in value:
+                    i.set(key, fill_placeholders(value, kwargs))
+            if i.text is not None and "{" in i.text:
+                i.text = fill_placeholders(i.text, kwargs)
+            if i.tail is not None and "{" in i.tail:
+                i.tail = fill_placeholders(i.tail, kwargs)
+        return element
+
+
+class LxmlWikiHandler(WikiHandler):
+    """
+    The same page transformation as of 'WikiHandler', but parsed, rewritten and serialized with lxml,
+    without the object model of BeautifulSoup
+    """
+    rule_engine_class = LxmlRuleEngine
+    fragment_factory = LxmlFragmentFactory()
+
+    @staticmethod
+    def parse(content: bytes):
+        if len(content) == 0:
+            return None
+        return lxml_html.document_fromstring(content)
+
+    @staticmethod
+    def get_children(tag) -> list:
+        return list(tag)
+
+    @staticmethod
+    def serialize_children(tag) -> str:
+        parts = list()
+        if tag.text is not None and not is_blank(tag.text):
+            parts.append(escape_text(tag.text))
+        for child in tag:
+            serialize_element(child, parts)
+        return "".join(parts)
+
+    @staticmethod
+    def get_name(tag) -> str:
+        return tag.tag
+
+    @staticmethod
+    def find_tag(tag, name: str, attrs: dict):
+        for element in tag.iterdescendants(name):
+            is_found = True
+            for key, value in attrs.items():
+                actual = element.get(key)
+                if key == "class":
+                    is_found = actual is not None and value in actual.split()
+                else:
+                    is_found = actual == value
+                if not is_found:
+                    break
+            if is_found:
+                return element
+        return None
+
+    @staticmethod
+    def find_all_tags(tag, name: str) -> list:
+        return list(tag.iterdescendants(name))
+
+    @staticmethod
+    def get_attribute(tag, attribute: str) -> str:
+        value = LxmlRuleEngine.get_attribute(tag, attribute)
+        if value is None:
+            value = ""
+        return value
+
+    @staticmethod
+    def remove_attribute(tag, attribute: str):
+        tag.attrib.pop(attribute, None)
+
+    @staticmethod
+    def get_text(tag) -> str:
+        return tag.text_content()
+
+    @staticmethod
+    def get_own_text(tag) -> str:
+        return "".join(
+            [tag.text or ""]
+            + [i.tail or "" for i in tag]
+            + list(tag.attrib.values())
+        )
+
+    @staticmethod
+    def create_tag(name: str, text: str = "", attrs: dict = None):
+        element = create_element(name, attrs)
+        if len(text) > 0:
+            element.text = text
+        return element
+
+    @staticmethod
+    def create_marker(text: str):
+        return etree.Comment(text)
+
+    @staticmethod
+    def serialize_tag(tag) -> str:
+        parts = list()
+        tail = tag.tail
+        tag.tail = None
+        serialize_element(tag, parts)
+        tag.tail = tail
+        return "".join(parts)
+
+    @staticmethod
+    def replace_tag(tag, new_tag):
+        parent = tag.getparent()
+        if parent is None:
+            return
+        new_tag.tail = tag.tail
+        tag.tail = None
+        parent.replace(tag, new_tag)
+
+    @staticmethod
+    def remove_children(tag):
+        for child in list(tag):
+            tag.remove(child)
+        tag.text = None
+
+    @staticmethod
+    def remove_tag(tag):
+        logging.debug("Remove tag '%s'", tag.tag)
+        if tag.getparent() is not None:
+            tag.drop_tree()
+
+    @staticmethod
+    def unwrap_tag(tag):
+        logging.debug("Replace tag with forbidden class '%s'", tag.get("class"))
+        if tag.getparent() is not None:
+            tag.drop_tag()
+
+    @staticmethod
+    def clear_blank_strings(tag):
+        comments = list()
+        for element in tag.iter():
+            if not isinstance(element.tag, str):
+                comments.append(element)
+            elif element.tag in SCRIPT_ELEMENTS or is_blank(element.text):
+                element.text = None
+            if is_blank(element.tail):
+                element.tail = None
+        for comment in comments:
+            if comment.getparent() is not None:
+                comment.drop_tree()
+
+    def process_tag(self, tag) -> None:
+        self.clear_blank_strings(tag)
+        if isinstance(tag.tag, str):
+            self.rule_engine.apply(tag)
@@ -1,36 +1,353 @@
 
+import sys
 import logging
-from wiki_handler import WikiHandler
-from constants import LOGGING_TEMPLATE
-from pdf_file_handler import PdfFileHandler
-from confluence_handler import ConfluenceHandler
+import argparse
+from importlib import import_module
+from constants import (
+    LOGGING_LEVEL,
+    LOGGING_TEMPLATE,
+    PDF_EXTRACT_PROCESSES,
+    PIPELINE_FETCH_WORKERS,
+    PIPELINE_QUEUE_SIZE,
+    PIPELINE_TRANSFORM_PROCESSES,
+    PIPELINE_TRANSFORM_WORKERS,
+    PIPELINE_UPLOAD_WORKERS,
+)
 
+# The page transformation backends, see 'LxmlWikiHandler'.
+# The handler modules are imported on demand, so the commands not using them start without loading the parsers
+WIKI_HANDLERS = {
+    "bs4": ("wiki_handler", "WikiHandler"),
+    "lxml": ("lxml_wiki_handler", "LxmlWikiHandler"),
+}
+
+
+def get_wiki_handler_class(backend: str):
+    module_name, class_name = WIKI_HANDLERS[backend]
+    return getattr(import_module(module_name), class_name)
+
+
+def get_urls(urls=None, pdf_file: str = None, processes: int = None):
+    """
+    Return the given URLs, or the generator of the URLs of the PDF file ('pdf_file_full_path' of 'secret.json')
+    """
+    if urls is not None:
+        return urls
+    from pdf_file_handler import PdfFileHandler
+    p_handler = PdfFileHandler()
+    if pdf_file:
+        p_handler.file = pdf_file
+    else:
+        p_handler.read()
+    return p_handler.iter_urls(processes)
+
+
+def run(backend: str = "bs4", manifest_file: str = None, report_file: str = None, urls=None):
+    from metrics import metrics
+    from manifest_handler import ManifestHandler
+    from confluence_handler import ConfluenceHandler
 
-def run():
     logging.basicConfig(
-        level=logging.DEBUG,
+        level=LOGGING_LEVEL,
         format=LOGGING_TEMPLATE
     )
 
-    p_handler = PdfFileHandler()
-    p_handler.read()
-    w_handler = WikiHandler()
+    w_handler = get_wiki_handler_class(backend)()
     w_handler.connect()
+    # Connected by the first push
+    c_handler = ConfluenceHandler()
+
+    manifest = ManifestHandler(manifest_file) if manifest_file else None
+    for idx, url in enumerate(get_urls(urls)):
+        logging.info(f"Process URL {idx + 1}")
+        with metrics.measure("fetch", url):
+            content = w_handler.get_page(url)
+        content_digest = w_handler.get_content_digest(content)
+        if manifest is not None and manifest.is_done(url, content_digest):
+            logging.info(f"Skip the unchanged URL: '{url}'")
+            continue
+        try:
+            with metrics.measure("transform", url):
+                processed_page_dict = w_handler.process_content(content)
+            if "page_body" in processed_page_dict.keys():
+                with metrics.measure("upload", url):
+                    result = c_handler.push_page(**processed_page_dict)
+                if manifest is not None:
+                    if len(result["failed"]) > 0:
+                        manifest.set_failed(url, "attachments failed: {}".format(", ".join(result["failed"])))
+                    else:
+                        manifest.set_done(
+                            url,
+                            content_digest,
+                            processed_page_dict["page_title"],
+                            result["page_id"],
+                            result["page_version"],
+                            result["attachments"]
+                        )
+        except Exception as e:
+            if manifest is None:
+                raise
+            # The page is retried by the next run
+            logging.exception(f"Failed to process the URL '{url}': '{e}'")
+            manifest.set_failed(url, str(e))
+    w_handler.close_run_cache()
+    if report_file:
+        logging.info("Run report written: '{}'".format(metrics.write_report(report_file)))
+
+
+def run_pipeline(backend: str = "bs4", manifest_file: str = None, urls=None, **kwargs):
+    """
+    Same as 'run', but the fetch, transform and upload stages work concurrently.
+    Keyword arguments are passed to 'PipelineHandler', e.g. 'fetch_workers=8', 'source="api"',
+    'transform_processes=4' or 'report_file="report.json"'.
+    Return the lists of the succeeded URLs and the dict of the failed ones with reasons.
+    """
+    from pipeline_handler import PipelineHandler
+    from manifest_handler import ManifestHandler
+    from confluence_handler import ConfluenceHandler
+
+    logging.basicConfig(
+        level=LOGGING_LEVEL,
+        format=LOGGING_TEMPLATE
+    )
+
+    # Connected by the first push, while the first pages are fetched
+    c_handler = ConfluenceHandler()
+
+    pipeline = PipelineHandler(
+        c_handler,
+        wiki_handler_class=get_wiki_handler_class(backend),
+        manifest_handler=ManifestHandler(manifest_file) if manifest_file else None,
+        **kwargs
+    )
+    return pipeline.run(get_urls(urls))
+
+
+def export_bundle(bundle_path: str, backend: str = "bs4", manifest_file: str = None, urls=None, **kwargs):
+    """
+    Same as 'run_pipeline', but the processed pages are written to the local bundle instead of Confluence,
+    a directory or a ZIP file if the path ends with '.zip'.
+    The manifest of the export is kept apart from the ones of the uploads.
+    """
+    from pipeline_handler import PipelineHandler
+    from manifest_handler import ManifestHandler
+    from bundle_handler import BundleHandler
+
+    logging.basicConfig(
+        level=LOGGING_LEVEL,
+        format=LOGGING_TEMPLATE
+    )
+
+    with BundleHandler(bundle_path) as b_handler:
+        pipeline = PipelineHandler(
+            b_handler,
+            wiki_handler_class=get_wiki_handler_class(backend),
+            manifest_handler=ManifestHandler(manifest_file) if manifest_file else None,
+            **kwargs
+        )
+        return pipeline.run(get_urls(urls))
+
+
+def upload_bundle(bundle_path: str, report_file: str = None, **kwargs):
+    """
+    Upload the bundle written by 'export_bundle' into Confluence set in 'secret.json'.
+    Keyword arguments are passed to 'BundleHandler.upload', e.g. 'upload_workers=4'.
+    Return the lists of the succeeded and the failed titles.
+    """
+    from metrics import metrics
+    from bundle_handler import BundleHandler
+    from confluence_handler import ConfluenceHandler
+
+    logging.basicConfig(
+        level=LOGGING_LEVEL,
+        format=LOGGING_TEMPLATE
+    )
+
     c_handler = ConfluenceHandler()
-    c_handler.connect()
 
-    urls = p_handler.extract_urls()
-    urls = [
-        "https://wiki.appline.ru/index.php/%D0%A3%D1%80%D0%BE%D0%BA%D0%B8_%D0%BF%D0%BE_JMeter",
-    ]
-    for idx, url in enumerate(urls):
-        logging.info(f"Process URL {idx + 1} of {len(urls)}")
-        processed_page_dict = w_handler.process_page(url)
-        if "page_body" in processed_page_dict.keys():
-            c_handler.push_page(**processed_page_dict)
+    with BundleHandler(bundle_path) as b_handler:
+        succeeded, failed = b_handler.upload(c_handler, **kwargs)
+    if report_file:
+        report_file = metrics.write_report(report_file, summary=dict(succeeded=len(succeeded), failed=len(failed)))
+        logging.info(f"Run report written: '{report_file}'")
+    return succeeded, failed
+
+
+# Command line interface
+
+def read_url_list(file: str):
+    # One URL per line, '-' for stdin, the empty lines and the lines starting with '#' are skipped.
+    # The URLs are yielded as they are read, so the pipeline starts with the first ones
+    f = sys.stdin if file == "-" else open(file, encoding="utf-8")
+    try:
+        for line in f:
+            line = line.strip()
+            if len(line) > 0 and not line.startswith("#"):
+                yield line
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def get_argument_urls(args):
+    if len(args.urls) > 0:
+        return args.urls
+    if args.urls_file:
+        return read_url_list(args.urls_file)
+    return get_urls(pdf_file=args.pdf, processes=args.pdf_processes)
+
+
+def get_pipeline_kwargs(args):
+    return dict(
+        fetch_workers=args.fetch_workers,
+        transform_workers=args.transform_workers,
+        transform_processes=args.transform_processes,
+        upload_workers=args.upload_workers,
+        queue_size=args.queue_size,
+        source=args.source,
+        report_file=args.report,
+    )
+
+
+def command_extract_urls(args):
+    output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        for url in get_urls(pdf_file=args.pdf, processes=args.pdf_processes):
+            output.write(f"{url}\n")
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    return 0
+
+
+def command_convert(args):
+    succeeded, failed = export_bundle(
+        args.bundle,
+        backend=args.backend,
+        manifest_file=args.manifest,
+        urls=get_argument_urls(args),
+        **get_pipeline_kwargs(args)
+    )
+    return 1 if len(failed) > 0 else 0
+
+
+def command_upload(args):
+    succeeded, failed = upload_bundle(args.bundle, report_file=args.report, upload_workers=args.upload_workers)
+    return 1 if len(failed) > 0 else 0
+
+
+def command_sync(args):
+    succeeded, failed = run_pipeline(
+        backend=args.backend,
+        manifest_file=args.manifest,
+        urls=get_argument_urls(args),
+        **get_pipeline_kwargs(args)
+    )
+    return 1 if len(failed) > 0 else 0
+
+
+def command_status(args):
+    import os
+    from manifest_handler import ManifestHandler
+    if not os.path.isfile(args.manifest):
+        logging.error(f"The manifest does not exist: '{args.manifest}'")
+        return 1
+    manifest = ManifestHandler(args.manifest)
+    summary = manifest.get_summary()
+    for status, count in sorted(summary.items()):
+        print(f"{status}: {count}")
+    print(f"total: {sum(summary.values())}")
+    if args.failed:
+        for url, error in manifest.get_failed().items():
+            print(f"{url}\t{error}")
+    return 0
+
+
+def add_url_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("urls", nargs="*", help="Wiki page URLs, the URLs of the PDF file are used if none is given")
+    parser.add_argument("--urls-file", help="file with a URL per line, '-' for stdin")
+    add_pdf_arguments(parser)
+
+
+def add_pdf_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--pdf", help="PDF file to extract URLs from instead of 'pdf_file_full_path' of secret.json")
+    parser.add_argument(
+        "--pdf-processes",
+        type=int,
+        default=None,
+        help=f"processes reading the PDF file ({PDF_EXTRACT_PROCESSES} to read it in place)"
+    )
+
+
+def add_pipeline_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--backend", choices=sorted(WIKI_HANDLERS.keys()), default="bs4")
+    parser.add_argument("--source", choices=("html", "api"), default="html", help="scrape pages or use MediaWiki API")
+    parser.add_argument("--manifest", help="SQLite manifest to skip the unchanged pages and resume")
+    parser.add_argument("--report", help="run report file, JSON or Prometheus text if it ends with '.prom'")
+    parser.add_argument("--fetch-workers", type=int, default=PIPELINE_FETCH_WORKERS)
+    parser.add_argument("--transform-workers", type=int, default=PIPELINE_TRANSFORM_WORKERS)
+    parser.add_argument("--transform-processes", type=int, default=PIPELINE_TRANSFORM_PROCESSES)
+    parser.add_argument("--upload-workers", type=int, default=PIPELINE_UPLOAD_WORKERS)
+    parser.add_argument("--queue-size", type=int, default=PIPELINE_QUEUE_SIZE)
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description="Export Wiki pages to Confluence")
+    parser.add_argument("--logging-level", default=LOGGING_LEVEL)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparser = subparsers.add_parser("extract-urls", help="print the URLs of the PDF file")
+    add_pdf_arguments(subparser)
+    subparser.add_argument("--output", help="file to write the URLs to instead of stdout")
+    subparser.set_defaults(function=command_extract_urls)
+
+    subparser = subparsers.add_parser("convert", help="convert the Wiki pages into a local bundle")
+    subparser.add_argument("bundle", help="bundle directory, or ZIP file if it ends with '.zip'")
+    add_url_arguments(subparser)
+    add_pipeline_arguments(subparser)
+    subparser.set_defaults(function=command_convert)
+
+    subparser = subparsers.add_parser("upload", help="upload the bundle into Confluence")
+    subparser.add_argument("bundle", help="bundle directory or ZIP file written by 'convert'")
+    subparser.add_argument("--report", help="run report file, JSON or Prometheus text if it ends with '.prom'")
+    subparser.add_argument("--upload-workers", type=int, default=PIPELINE_UPLOAD_WORKERS)
+    subparser.set_defaults(function=command_upload)
+
+    subparser = subparsers.add_parser("sync", help="convert the Wiki pages and upload them into Confluence")
+    add_url_arguments(subparser)
+    add_pipeline_arguments(subparser)
+    subparser.set_defaults(function=command_sync)
+
+    subparser = subparsers.add_parser("status", help="print the page counts of the manifest")
+    subparser.add_argument("manifest", help="SQLite manifest of 'convert' or 'sync'")
+    subparser.add_argument("--failed", action="store_true", help="list the failed URLs with reasons")
+    subparser.set_defaults(function=command_status)
+    return parser
+
+
+def parse_args(argv: list = None):
+    parser = create_parser()
+    # argparse takes the positional URLs before the first option only, the ones after it are left unrecognized
+    args, extras = parser.parse_known_args(argv)
+    if hasattr(args, "urls"):
+        args.urls.extend(i for i in extras if not i.startswith("-"))
+        extras = [i for i in extras if i.startswith("-")]
+    if len(extras) > 0:
+        parser.error("unrecognized arguments: {}".format(" ".join(extras)))
+    return args
+
+
+def main(argv: list = None):
+    args = parse_args(argv)
+    logging.basicConfig(
+        level=args.logging_level,
+        format=LOGGING_TEMPLATE
+    )
+    return args.function(args)
 
 
 if __name__ == '__main__':
-    run()
+    sys.exit(main())
 
-# python main.py > main.log 2>&1
+# python main.py sync --manifest manifest.sqlite --report report.json > main.log 2>&1
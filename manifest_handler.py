@@ -0,0 +1,95 @@
+import os
+import json
+import logging
+import sqlite3
+from time import time
+from threading import Lock
+
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+
+class ManifestHandler:
+    """
+    Persistent record of the processed URLs: the digest of the source page, the Confluence page id and version,
+    the digests of the uploaded attachments and the status.
+    Every record is committed on its own, so the run may be interrupted at any point
+    and the next run skips the pages that are done and unchanged.
+    """
+    def __init__(self, file: str):
+        self.file = os.path.realpath(file)
+        self._lock = Lock()
+        os.makedirs(os.path.dirname(self.file), exist_ok=True)
+        self._db = sqlite3.connect(self.file, timeout=30, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS pages (
+                    url TEXT PRIMARY KEY,
+                    content_digest TEXT,
+                    page_title TEXT,
+                    page_id TEXT,
+                    page_version INTEGER,
+                    attachments TEXT,
+                    status TEXT NOT NULL,
+                    error TEXT,
+                    updated REAL NOT NULL
+                )
+            """)
+        logging.debug(f"Manifest opened: '{self.file}'")
+
+    def get(self, url: str):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT content_digest, page_title, page_id, page_version, attachments, status, error "
+                "FROM pages WHERE url = ?", (url,)
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(
+            content_digest=row[0],
+            page_title=row[1],
+            page_id=row[2],
+            page_version=row[3],
+            attachments=json.loads(row[4] or "{}"),
+            status=row[5],
+            error=row[6],
+        )
+
+    def is_done(self, url: str, content_digest: str):
+        entry = self.get(url)
+        return entry is not None and entry["status"] == STATUS_DONE and entry["content_digest"] == content_digest
+
+    def set_done(
+        self,
+        url: str,
+        content_digest: str,
+        page_title: str,
+        page_id: str,
+        page_version: int,
+        attachments: dict,
+    ):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, NULL, ?)",
+                (url, content_digest, page_title, page_id, page_version, json.dumps(attachments), STATUS_DONE, time())
+            )
+
+    def set_failed(self, url: str, error: str):
+        # The details of the last successful push are kept
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO pages (url, status, error, updated) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (url) DO UPDATE SET status = excluded.status, error = excluded.error, "
+                "updated = excluded.updated",
+                (url, STATUS_FAILED, str(error), time())
+            )
+
+    def get_summary(self):
+        with self._lock:
+            return dict(self._db.execute("SELECT status, COUNT(*) FROM pages GROUP BY status").fetchall())
+
+    def get_failed(self):
+        with self._lock:
+            return dict(self._db.execute(
+                "SELECT url, error FROM pages WHERE status = ? ORDER BY updated", (STATUS_FAILED,)
+            ).fetchall())
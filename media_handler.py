@@ -0,0 +1,158 @@
+import os
+import logging
+from threading import Lock
+from tempfile import SpooledTemporaryFile
+from concurrent.futures import ThreadPoolExecutor
+from metrics import metrics
+from constants import (
+    ATTACHMENT_SPOOL_SIZE,
+    CONFLUENCE_ATTACHMENT_SIZE_LIMIT,
+    MEDIA_DOWNLOAD_SIZE_LIMIT,
+    MEDIA_MAX_DIMENSION,
+    MEDIA_QUALITY,
+    MEDIA_SIZE_THRESHOLD,
+    MEDIA_WORKERS,
+)
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Optional, the images are uploaded as they are
+    Image = None
+
+# The formats written back as they are read, so the names of the attachments keep their extensions
+MEDIA_SAVE_OPTIONS = {
+    "JPEG": dict(optimize=True, progressive=True),
+    "PNG": dict(optimize=True),
+    "WEBP": dict(method=4),
+    "TIFF": dict(compression="tiff_deflate"),
+    "BMP": dict(),
+}
+# Every attempt to fit the image into Confluence limits reduces its dimensions this many times
+MEDIA_SCALE_STEP = 2
+MEDIA_SCALE_ATTEMPTS = 4
+
+
+class MediaHandler:
+    """
+    Downsamples and recompresses the raster images larger than the threshold before the upload.
+    The images are written in the format they are read, so the names of the attachments
+    and the references to them in the page body stay the same.
+    The images larger than Confluence limits are downloaded too, up to 'MEDIA_DOWNLOAD_SIZE_LIMIT',
+    if their format is written back, and reduced until they fit, otherwise they are not attached.
+    An image is kept as it is if the result is not smaller or fails to be read.
+    The work is done by a thread pool shared by all the handlers of the run, Pillow releases GIL while coding images.
+    """
+    _instances = dict()
+    _instances_lock = Lock()
+
+    def __init__(
+        self,
+        size_threshold: int = MEDIA_SIZE_THRESHOLD,
+        max_dimension: int = MEDIA_MAX_DIMENSION,
+        quality: int = MEDIA_QUALITY,
+        workers: int = MEDIA_WORKERS,
+    ):
+        self.size_threshold = max(0, int(size_threshold))
+        self.max_dimension = max(1, int(max_dimension))
+        self.quality = min(100, max(1, int(quality)))
+        self.download_size_limit = MEDIA_DOWNLOAD_SIZE_LIMIT
+        self.executor = ThreadPoolExecutor(max_workers=max(1, int(workers)), thread_name_prefix="media")
+
+    @classmethod
+    def get_instance(
+        cls,
+        size_threshold: int = MEDIA_SIZE_THRESHOLD,
+        max_dimension: int = MEDIA_MAX_DIMENSION,
+        quality: int = MEDIA_QUALITY,
+        workers: int = MEDIA_WORKERS,
+    ):
+        if Image is None:
+            logging.warning("Pillow is not installed, the images are uploaded as they are")
+            return None
+        key = (size_threshold, max_dimension, quality, workers)
+        with cls._instances_lock:
+            instance = cls._instances.get(key)
+            if instance is None:
+                instance = cls._instances[key] = cls(*key)
+            return instance
+
+    @staticmethod
+    def is_supported(file_basename: str):
+        # The format of a file not downloaded yet is guessed by its extension
+        image_format = Image.registered_extensions().get(os.path.splitext(file_basename)[1].lower())
+        return image_format in MEDIA_SAVE_OPTIONS
+
+    def get_save_options(self, image_format: str):
+        options = dict(MEDIA_SAVE_OPTIONS[image_format])
+        if image_format in ("JPEG", "WEBP"):
+            options["quality"] = self.quality
+        return options
+
+    @staticmethod
+    def convert_mode(image, image_format: str):
+        # JPEG keeps neither transparency nor palette
+        if image_format == "JPEG" and image.mode not in ("RGB", "L", "CMYK"):
+            return image.convert("RGB")
+        return image
+
+    def save(self, image, image_format: str, max_dimension: int):
+        resized = image.copy()
+        resized.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        file = SpooledTemporaryFile(max_size=ATTACHMENT_SPOOL_SIZE)
+        self.convert_mode(resized, image_format).save(file, image_format, **self.get_save_options(image_format))
+        return file
+
+    def recompress(self, file, file_basename: str = ""):
+        """
+        Return the recompressed copy of the image file object, or the same file object if it is kept as it is
+        """
+        size = file.seek(0, os.SEEK_END)
+        file.seek(0)
+        if size < self.size_threshold:
+            return file
+        try:
+            with Image.open(file) as image:
+                image_format = image.format
+                if image_format not in MEDIA_SAVE_OPTIONS or getattr(image, "is_animated", False):
+                    logging.debug(f"Keep the image as it is: '{file_basename}'")
+                    return file
+                # The orientation tag is not written back, so the pixels are rotated instead
+                image = ImageOps.exif_transpose(image)
+                max_dimension = self.max_dimension
+                for _ in range(MEDIA_SCALE_ATTEMPTS):
+                    new_file = self.save(image, image_format, max_dimension)
+                    new_size = new_file.tell()
+                    if new_size < CONFLUENCE_ATTACHMENT_SIZE_LIMIT:
+                        break
+                    new_file.close()
+                    new_file = None
+                    max_dimension = max(1, max_dimension // MEDIA_SCALE_STEP)
+        except Exception as e:
+            logging.warning(f"Unable to recompress the image '{file_basename}': '{e}'")
+            file.seek(0)
+            return file
+        if new_file is None:
+            logging.warning(f"Unable to reduce the image '{file_basename}' below Confluence limits")
+            file.seek(0)
+            return file
+        if new_size >= size:
+            new_file.close()
+            logging.debug(f"Recompression does not reduce the image: '{file_basename}'")
+            file.seek(0)
+            return file
+        logging.info(f"Recompressed the image '{file_basename}' from {size} to {new_size} bytes")
+        new_file.seek(0)
+        return new_file
+
+    def submit(self, file, file_basename: str = ""):
+        """
+        Recompress the image file object in the pool, the future results with the file object to upload
+        """
+        url, stage = metrics.get_context()
+
+        def recompress():
+            # Counted under the page of the caller
+            with metrics.measure("media", url):
+                return self.recompress(file, file_basename)
+
+        return self.executor.submit(recompress)
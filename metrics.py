@@ -0,0 +1,167 @@
+import os
+import json
+from time import monotonic, time
+from threading import Lock, local
+from contextlib import contextmanager
+
+COUNTERS = ("seconds", "bytes", "requests", "retries", "calls")
+# The stage of the counts made outside of any measured stage
+OTHER_STAGE = "other"
+PROMETHEUS_PREFIX = "wiki_export"
+
+
+class Metrics:
+    """
+    Counters of the run per URL and per stage (fetch, parse, transform, attachment_fetch, media, upload):
+    wall time, bytes, requests, retries and calls.
+    'measure' sets the stage of the calling thread, so the code deeper in the stack like 'WikiHandler.download'
+    adds its counts without knowing the URL. The time of a stage excludes the time of the stages nested in it,
+    e.g. the transform time excludes the attachment downloads made by the rules.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._local = local()
+        self._records = dict()
+        self.started = time()
+
+    def reset(self):
+        with self._lock:
+            self._records = dict()
+            self.started = time()
+
+    def _get_stack(self) -> list:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = list()
+        return stack
+
+    def get_context(self):
+        """
+        Return the URL and the stage of the calling thread
+        """
+        stack = self._get_stack()
+        if len(stack) == 0:
+            return None, None
+        return stack[-1]["url"], stack[-1]["stage"]
+
+    def _add(self, url: str, stage: str, **counters):
+        key = (url, stage or OTHER_STAGE)
+        with self._lock:
+            record = self._records.get(key)
+            if record is None:
+                record = self._records[key] = dict.fromkeys(COUNTERS, 0)
+            for name, value in counters.items():
+                record[name] += value
+
+    def add(self, **counters):
+        self._add(*self.get_context(), **counters)
+
+    @contextmanager
+    def measure(self, stage: str, url: str = None):
+        stack = self._get_stack()
+        if url is None and len(stack) > 0:
+            url = stack[-1]["url"]
+        frame = dict(url=url, stage=stage, nested=0.0)
+        stack.append(frame)
+        started = monotonic()
+        try:
+            yield
+        finally:
+            stack.pop()
+            seconds = monotonic() - started
+            if len(stack) > 0:
+                stack[-1]["nested"] += seconds
+            self._add(url, stage, seconds=max(0.0, seconds - frame["nested"]), calls=1)
+
+    @contextmanager
+    def bind(self, url: str, stage: str):
+        """
+        Count under the given URL and stage without timing, e.g. in the threads of a pool started by the stage
+        """
+        stack = self._get_stack()
+        stack.append(dict(url=url, stage=stage, nested=0.0))
+        try:
+            yield
+        finally:
+            stack.pop()
+
+    def get_records(self) -> dict:
+        with self._lock:
+            return {k: dict(v) for k, v in self._records.items()}
+
+    def merge(self, records: dict):
+        """
+        Add the records of another process, e.g. of a transform process, under the URL of the calling thread.
+        Their time is excluded from the time of the stage of the calling thread, as of a nested stage
+        """
+        stack = self._get_stack()
+        url = stack[-1]["url"] if len(stack) > 0 else None
+        for (_, stage), record in records.items():
+            self._add(url, stage, **record)
+            if len(stack) > 0:
+                stack[-1]["nested"] += record["seconds"]
+
+    def get_report(self):
+        records = self.get_records()
+        stages = dict()
+        pages = dict()
+        for (url, stage), record in sorted(records.items(), key=lambda x: (x[0][0] or "", x[0][1])):
+            record["seconds"] = round(record["seconds"], 3)
+            total = stages.setdefault(stage, dict.fromkeys(COUNTERS, 0))
+            for name, value in record.items():
+                total[name] += value
+            if url is not None:
+                pages.setdefault(url, dict())[stage] = record
+        for total in stages.values():
+            total["seconds"] = round(total["seconds"], 3)
+        return dict(
+            started=self.started,
+            finished=time(),
+            stages=stages,
+            pages=pages,
+        )
+
+    @staticmethod
+    def format_prometheus(report: dict):
+        lines = list()
+        for name in COUNTERS:
+            metric = f"{PROMETHEUS_PREFIX}_stage_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            for stage, total in report["stages"].items():
+                lines.append(f"{metric}{{stage=\"{stage}\"}} {total[name]}")
+        lines.append(f"# TYPE {PROMETHEUS_PREFIX}_run_seconds gauge")
+        lines.append("{}_run_seconds {:.3f}".format(PROMETHEUS_PREFIX, report["finished"] - report["started"]))
+        summary = report.get("summary", dict())
+        if len(summary) > 0:
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_pages gauge")
+            for status, value in summary.items():
+                lines.append(f"{PROMETHEUS_PREFIX}_pages{{status=\"{status}\"}} {value}")
+        for name in ("rate", "concurrency", "decreases"):
+            metric = f"{PROMETHEUS_PREFIX}_host_{name}"
+            lines.append(f"# TYPE {metric} gauge")
+            for host, limits in report.get("limits", dict()).items():
+                lines.append(f"{metric}{{host=\"{host}\"}} {limits[name]}")
+        return "\n".join(lines) + "\n"
+
+    def write_report(self, file: str, **extra):
+        """
+        Write the report as Prometheus text file if the name ends with '.prom', or as JSON otherwise.
+        The keyword arguments are added to the report, 'summary' and 'limits' are exported to Prometheus too
+        """
+        report = dict(self.get_report(), **extra)
+        if file.endswith(".prom"):
+            content = self.format_prometheus(report)
+        else:
+            content = json.dumps(report, ensure_ascii=False, indent=4)
+        file = os.path.realpath(file)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        # Replaced at once, as the collectors may read the file at any moment
+        temp_file = f"{file}.{os.getpid()}.tmp"
+        with open(temp_file, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(temp_file, file)
+        return file
+
+
+# Shared by all the handlers of the process
+metrics = Metrics()
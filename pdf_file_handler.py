@@ -1,10 +1,34 @@
-
 import os
+import json
 import logging
+import multiprocessing
 from pypdf import PdfReader
 from urllib.parse import unquote
-from utils import load_dict
-from constants import SECRET_JSON_PATH
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+from utils import get_file_digest, load_dict
+from constants import PDF_EXTRACT_PROCESSES, PDF_PAGES_PER_TASK, SECRET_JSON_PATH
+
+
+def get_urls(x):
+    # Yield the URLs of the link annotations of the page object in document order
+    if x is None:
+        return
+    if "/URI" in x.keys():
+        s = unquote(x["/URI"])
+        if "/Категория:" not in s:
+            yield s
+    if "/A" in x.keys():
+        yield from get_urls(x["/A"])
+    if "/Annots" in x.keys():
+        for i in x["/Annots"]:
+            yield from get_urls(i.get_object())
+
+
+def extract_page_range(file: str, start: int, stop: int):
+    # Runs in a worker process, so the file is opened there
+    reader = PdfReader(file)
+    return [url for idx in range(start, stop) for url in get_urls(reader.pages[idx].get_object())]
 
 
 class PdfFileHandler:
@@ -31,29 +55,82 @@ class PdfFileHandler:
     def read(self):
         self.file = self._secret_dict["pdf_file_full_path"]
 
-    def extract_urls(self):
-        if not self.is_valid:
-            return
-        reader = PdfReader(self.file)
+    def get_cache_file(self):
+        # The URLs are cached along with the Wiki content, unless a separate directory is set
+        cache_dir = self._secret_dict.get("pdf_cache_dir") or self._secret_dict.get("wiki_cache_dir") or ""
+        if len(cache_dir) == 0:
+            return None
+        with open(self.file, "rb") as f:
+            file_digest = get_file_digest(f)
+        return os.path.join(cache_dir, f"pdf_urls_{file_digest}.json")
 
-        out = set()
+    def load_cached_urls(self, cache_file: str):
+        if cache_file is None or not os.path.isfile(cache_file):
+            return None
+        try:
+            cached_dict = load_dict(cache_file)
+        except ValueError:
+            logging.warning(f"The cached URLs are invalid: '{cache_file}'")
+            return None
+        # The same content with another modification time is extracted anew
+        if cached_dict.get("mtime") != os.path.getmtime(self.file):
+            return None
+        return cached_dict["urls"]
 
-        def get_url(x):
-            if x is None:
-                return
-            if "/URI" in x.keys():
-                s = unquote(x["/URI"])
-                if "/Категория:" not in s:
-                    out.add(s)
-            if "/A" in x.keys():
-                get_url(x["/A"])
-            if "/Annots" in x.keys():
-                for i in x["/Annots"]:
-                    get_url(i.get_object())
+    def save_cached_urls(self, cache_file: str, urls: list):
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        temp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(temp_file, "w", encoding="utf-8") as f:
+            json.dump(dict(file=self.file, mtime=os.path.getmtime(self.file), urls=urls), f, ensure_ascii=False)
+        os.replace(temp_file, cache_file)
 
-        for page in reader.pages:
-            get_url(page.get_object())
+    def iter_page_urls(self, processes: int = PDF_EXTRACT_PROCESSES):
+        """
+        Yield the URLs of all the pages in document order, the duplicates included.
+        With processes, the page ranges of 'PDF_PAGES_PER_TASK' are read by a process pool,
+        and the URLs of a range are yielded once all the previous ranges are done
+        """
+        reader = PdfReader(self.file)
+        if processes <= 0:
+            for page in reader.pages:
+                yield from get_urls(page.get_object())
+            return
+        page_count = len(reader.pages)
+        starts = range(0, page_count, PDF_PAGES_PER_TASK)
+        stops = [min(i + PDF_PAGES_PER_TASK, page_count) for i in starts]
+        logging.info(f"Read {page_count} pages in {len(starts)} ranges by {processes} processes")
+        # The caller may be running threads, e.g. of the pipeline, so the workers are spawned rather than forked
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn")) as executor:
+            for urls in executor.map(extract_page_range, repeat(self.file), starts, stops):
+                yield from urls
 
-        logging.info(f"{len(out)} URLs were extracted")
-        return out
+    def iter_urls(self, processes: int = None):
+        """
+        Yield the unique URLs in document order as soon as their pages are read, so the processing may start
+        before the whole file is read. The URLs of a completely read file are cached by its SHA-256 digest
+        and modification time, the next call yields them without reading the file.
+        The processes are taken from 'pdf_extract_processes' of 'secret.json' unless given
+        """
+        if processes is None:
+            processes = self._secret_dict.get("pdf_extract_processes", PDF_EXTRACT_PROCESSES)
+        if not self.is_valid:
+            return
+        cache_file = self.get_cache_file()
+        urls = self.load_cached_urls(cache_file)
+        if urls is not None:
+            logging.info(f"{len(urls)} URLs were loaded from the cache: '{cache_file}'")
+            yield from urls
+            return
+        urls = dict()
+        for url in self.iter_page_urls(max(0, int(processes))):
+            if url not in urls:
+                urls[url] = None
+                yield url
+        logging.info(f"{len(urls)} URLs were extracted")
+        if cache_file is not None:
+            self.save_cached_urls(cache_file, list(urls.keys()))
 
+    def extract_urls(self, processes: int = None):
+        if not self.is_valid:
+            return
+        return list(self.iter_urls(processes))
@@ -0,0 +1,310 @@
+import logging
+import multiprocessing
+from typing import TYPE_CHECKING
+from queue import Queue
+from threading import Lock, Thread
+from concurrent.futures import ProcessPoolExecutor
+from wiki_handler import WikiHandler
+from manifest_handler import ManifestHandler
+from rate_limiter import RateLimiter
+from metrics import metrics
+from constants import (
+    PIPELINE_FETCH_WORKERS,
+    PIPELINE_QUEUE_SIZE,
+    PIPELINE_TRANSFORM_PROCESSES,
+    PIPELINE_TRANSFORM_WORKERS,
+    PIPELINE_UPLOAD_WORKERS,
+    WIKI_API_BATCH_SIZE,
+)
+
+if TYPE_CHECKING:  # The export to a bundle does not need Confluence client
+    from confluence_handler import ConfluenceHandler
+
+# Marks the end of a queue, every worker of the consuming stage gets its own copy
+_STOP = None
+# The Wiki handler of a transform worker process
+_process_handler = None
+
+
+def _init_transform_process(wiki_handler_class: type):
+    global _process_handler
+    _process_handler = wiki_handler_class()
+    _process_handler.configure()
+    _process_handler.is_deferred = True
+
+
+def _transform_in_process(content: bytes, source: str):
+    # The counts of the process, like the parse time, are returned along to be added under the page
+    metrics.reset()
+    if source == "api":
+        processed_page_dict = _process_handler.process_api_content(content)
+    else:
+        processed_page_dict = _process_handler.process_content(content)
+    return processed_page_dict, metrics.get_records()
+
+
+class PipelineHandler:
+    """
+    Runs pages through three stages connected with bounded queues:
+    fetch (download the page HTML), transform (rewrite it and download attachments)
+    and upload (push it into Confluence).
+    Every stage has its own pool of worker threads, a failed page is logged and skipped.
+    With the manifest, the pages pushed by the previous runs are skipped unless their content has changed.
+    With MediaWiki API source, the revision ids of all the pages are requested in batches before the start,
+    so the unchanged pages are skipped without fetching.
+    With transform processes, the pages are parsed and rewritten by a process pool,
+    while the transform threads only download the attachments the processes refer to.
+    With the report file, the time, bytes, requests and retries of every page and stage are written at the end.
+    """
+    def __init__(
+        self,
+        confluence_handler: "ConfluenceHandler",
+        fetch_workers: int = PIPELINE_FETCH_WORKERS,
+        transform_workers: int = PIPELINE_TRANSFORM_WORKERS,
+        upload_workers: int = PIPELINE_UPLOAD_WORKERS,
+        queue_size: int = PIPELINE_QUEUE_SIZE,
+        wiki_handler_class: type = WikiHandler,
+        manifest_handler: ManifestHandler = None,
+        source: str = "html",
+        transform_processes: int = PIPELINE_TRANSFORM_PROCESSES,
+        report_file: str = None,
+    ):
+        self.confluence_handler = confluence_handler
+        self.wiki_handler_class = wiki_handler_class
+        self.manifest_handler = manifest_handler
+        # "html" to scrape the pages, "api" to get the parsed content and the revision ids from MediaWiki API
+        self.source = source
+        # JSON, or Prometheus text file if the name ends with '.prom'
+        self.report_file = report_file
+        self._revisions = dict()
+        self.fetch_workers = max(1, int(fetch_workers))
+        self.transform_workers = max(1, int(transform_workers))
+        self.upload_workers = max(1, int(upload_workers))
+        self.transform_processes = max(0, int(transform_processes))
+        if self.transform_processes > 0:
+            # Every process gets a thread waiting for it and downloading the attachments
+            self.transform_workers = max(self.transform_workers, self.transform_processes)
+        self.queue_size = max(1, int(queue_size))
+        self.succeeded = list()
+        self.failed = dict()
+        self.skipped = list()
+        self._executor = None
+        self._lock = Lock()
+        self._total = 0
+
+    def create_wiki_handler(self):
+        # The Wiki handler keeps attachments of the page being processed, so it is not shared between threads
+        handler = self.wiki_handler_class()
+        handler.connect()
+        return handler
+
+    def _fail(self, url: str, stage: str, e: Exception):
+        logging.exception(f"Failed to {stage} the URL '{url}': '{e}'")
+        with self._lock:
+            self.failed[url] = f"{stage}: {e}"
+        if self.manifest_handler is not None:
+            self.manifest_handler.set_failed(url, self.failed[url])
+
+    def is_done(self, url: str, content_digest: str):
+        return self.manifest_handler is not None and self.manifest_handler.is_done(url, content_digest)
+
+    def _fetch(self, input_queue: Queue, output_queue: Queue, handler: WikiHandler):
+        while True:
+            item = input_queue.get()
+            if item is _STOP:
+                return
+            idx, url = item
+            logging.info("Fetch URL {} of {}".format(idx + 1, self._total or "unknown yet"))
+            try:
+                with metrics.measure("fetch", url):
+                    if self.source == "api":
+                        title, revision = self._revisions[url]
+                        if revision is None:
+                            raise ValueError(f"no revision of the page '{title}'")
+                        content_digest = f"revision:{revision}"
+                    else:
+                        content = handler.get_page(url)
+                        content_digest = handler.get_content_digest(content)
+                    if self.is_done(url, content_digest):
+                        logging.info(f"Skip the unchanged URL: '{url}'")
+                        with self._lock:
+                            self.skipped.append(url)
+                        continue
+                    if self.source == "api":
+                        content = handler.get_api_page(title, revision)
+                if len(content) == 0:
+                    raise ValueError("empty content")
+                output_queue.put((url, content_digest, content))
+            except Exception as e:
+                self._fail(url, "fetch", e)
+
+    def _transform(self, input_queue: Queue, output_queue: Queue, handler: WikiHandler):
+        while True:
+            item = input_queue.get()
+            if item is _STOP:
+                return
+            url, content_digest, content = item
+            try:
+                with metrics.measure("transform", url):
+                    if self._executor is not None:
+                        processed_page_dict, records = self._executor.submit(
+                            _transform_in_process, content, self.source
+                        ).result()
+                        metrics.merge(records)
+                        processed_page_dict = handler.complete_content(processed_page_dict)
+                    elif self.source == "api":
+                        processed_page_dict = handler.process_api_content(content)
+                    else:
+                        processed_page_dict = handler.process_content(content)
+                if "page_body" not in processed_page_dict.keys():
+                    raise ValueError("no page body")
+                output_queue.put((url, content_digest, processed_page_dict))
+            except Exception as e:
+                self._fail(url, "transform", e)
+
+    def _upload(self, input_queue: Queue, output_queue: Queue, handler: "ConfluenceHandler"):
+        while True:
+            item = input_queue.get()
+            if item is _STOP:
+                return
+            url, content_digest, processed_page_dict = item
+            try:
+                with metrics.measure("upload", url):
+                    result = handler.push_page(**processed_page_dict)
+                if len(result["failed"]) > 0:
+                    raise ValueError("attachments failed: {}".format(", ".join(result["failed"])))
+                if self.manifest_handler is not None:
+                    self.manifest_handler.set_done(
+                        url,
+                        content_digest,
+                        processed_page_dict["page_title"],
+                        result["page_id"],
+                        result["page_version"],
+                        result["attachments"]
+                    )
+                with self._lock:
+                    self.succeeded.append(url)
+            except Exception as e:
+                self._fail(url, "upload", e)
+
+    @staticmethod
+    def _start(target, handlers: list, input_queue: Queue, output_queue: Queue = None):
+        threads = [
+            Thread(target=target, args=(input_queue, output_queue, handler), name=f"{target.__name__}-{i}", daemon=True)
+            for i, handler in enumerate(handlers)
+        ]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    @staticmethod
+    def _stop(threads: list, input_queue: Queue):
+        for _ in threads:
+            input_queue.put(_STOP)
+        for thread in threads:
+            thread.join()
+
+    def query_revisions(self, urls: list):
+        """
+        Request the revision ids of the pages in batches of 'WIKI_API_BATCH_SIZE',
+        the pages of a failed batch are failed, return the URLs of the others
+        """
+        handler = self.create_wiki_handler()
+        titles = [(url, handler.get_title(url)) for url in urls]
+        self._revisions = dict()
+        for start in range(0, len(titles), WIKI_API_BATCH_SIZE):
+            batch = titles[start:start + WIKI_API_BATCH_SIZE]
+            try:
+                revisions = handler.get_revisions([title for url, title in batch])
+            except Exception as e:
+                for url, title in batch:
+                    self._fail(url, "fetch", e)
+                continue
+            self._revisions.update({url: (title, revisions.get(title)) for url, title in batch})
+        return [url for url in urls if url in self._revisions]
+
+    def run(self, urls):
+        """
+        Process the URLs of the iterable, e.g. the generator of 'PdfFileHandler.iter_urls',
+        the pages are fetched as soon as their URLs are yielded
+        """
+        self.succeeded = list()
+        self.failed = dict()
+        self.skipped = list()
+        metrics.reset()
+        if self.source == "api":
+            # The revisions of all the pages are requested before the start, the failed pages are counted in the total
+            urls = list(urls)
+            self._total = len(urls)
+            urls = self.query_revisions(urls)
+        else:
+            self._total = len(urls) if isinstance(urls, (list, tuple, set)) else None
+        url_queue = Queue(maxsize=self.queue_size)
+        fetched_queue = Queue(maxsize=self.queue_size)
+        processed_queue = Queue(maxsize=self.queue_size)
+        logging.info("Start pipeline with {} fetch, {} transform and {} upload workers, {} transform processes".format(
+            self.fetch_workers, self.transform_workers, self.upload_workers, self.transform_processes
+        ))
+        if self.transform_processes > 0:
+            # Forking the process running threads may copy a lock held by one of them, so the workers are spawned
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.transform_processes,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_transform_process,
+                initargs=(self.wiki_handler_class,)
+            )
+        fetchers = transformers = uploaders = list()
+        total = len(self.failed)
+        try:
+            fetchers = self._start(
+                self._fetch,
+                [self.create_wiki_handler() for _ in range(self.fetch_workers)],
+                url_queue,
+                fetched_queue
+            )
+            transformers = self._start(
+                self._transform,
+                [self.create_wiki_handler() for _ in range(self.transform_workers)],
+                fetched_queue,
+                processed_queue
+            )
+            # The Confluence handler keeps no per-page state, so the upload workers share it
+            uploaders = self._start(
+                self._upload,
+                [self.confluence_handler] * self.upload_workers,
+                processed_queue
+            )
+            for item in enumerate(urls):
+                url_queue.put(item)
+                total += 1
+        finally:
+            # Drain the stages one after another, so every queued page reaches the end, even if the URLs failed
+            self._stop(fetchers, url_queue)
+            self._stop(transformers, fetched_queue)
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+            self._stop(uploaders, processed_queue)
+            self.wiki_handler_class.close_run_cache()
+        self._total = total
+        logging.info("{} of {} pages were uploaded, {} skipped as unchanged, {} failed".format(
+            len(self.succeeded), self._total, len(self.skipped), len(self.failed)
+        ))
+        for url, reason in self.failed.items():
+            logging.warning(f"Failed URL '{url}': {reason}")
+        limits = RateLimiter.get_limits()
+        for host, host_limits in limits.items():
+            logging.info(f"Request limits for '{host}': {host_limits}")
+        if self.report_file:
+            report_file = metrics.write_report(
+                self.report_file,
+                summary=dict(
+                    total=self._total,
+                    succeeded=len(self.succeeded),
+                    skipped=len(self.skipped),
+                    failed=len(self.failed),
+                ),
+                limits=limits,
+            )
+            logging.info(f"Run report written: '{report_file}'")
+        return self.succeeded, self.failed
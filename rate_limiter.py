@@ -0,0 +1,177 @@
+import logging
+from time import monotonic
+from threading import Condition, Lock
+from urllib import parse as urlparse
+from requests.adapters import HTTPAdapter
+from utils import parse_retry_after
+from metrics import metrics
+from constants import (
+    DOWNLOAD_CHUNK_SIZE,
+    RATE_LIMIT_BURST,
+    RATE_LIMIT_CONCURRENCY,
+    RATE_LIMIT_LATENCY_TOLERANCE,
+    RATE_LIMIT_RATE,
+    RETRY_STATUS_CODES,
+    WAIT_SECONDS_LIMIT,
+)
+
+
+class RateLimiter:
+    """
+    Limits the requests to a single host by a token bucket and by the number of requests in flight.
+    Both limits follow AIMD: they are halved when the server responds with an overload status,
+    the request fails or the recent latency grows over the long-term one, and grow back by small steps
+    while the server responds well. 'Retry-After' pauses all the requests to the host for the given time.
+    The limiters are shared by all the clients of the run, one per host.
+    """
+    _instances = dict()
+    _instances_lock = Lock()
+
+    def __init__(
+        self,
+        host: str,
+        rate: float = RATE_LIMIT_RATE,
+        burst: int = RATE_LIMIT_BURST,
+        concurrency: int = RATE_LIMIT_CONCURRENCY,
+        latency_tolerance: float = RATE_LIMIT_LATENCY_TOLERANCE,
+    ):
+        self.host = host
+        self.max_rate = max(1.0, float(rate))
+        self.max_concurrency = max(1, int(concurrency))
+        self.burst = max(1, int(burst))
+        self.latency_tolerance = float(latency_tolerance)
+        self.rate = self.max_rate
+        self.concurrency = float(self.max_concurrency)
+        self.in_flight = 0
+        self.tokens = float(self.burst)
+        # Fast and slow moving averages of the latency, the first one growing over the second means the server load
+        self.latency = None
+        self.baseline_latency = None
+        self.decreases = 0
+        self._refilled = monotonic()
+        self._paused_until = 0.0
+        self._decreased = 0.0
+        self._condition = Condition()
+
+    @classmethod
+    def get_instance(cls, url: str):
+        host = urlparse.urlsplit(url).netloc
+        with cls._instances_lock:
+            instance = cls._instances.get(host)
+            if instance is None:
+                instance = cls._instances[host] = cls(host)
+            return instance
+
+    @classmethod
+    def get_limits(cls):
+        with cls._instances_lock:
+            instances = list(cls._instances.values())
+        return {i.host: i.get_stats() for i in instances}
+
+    def get_stats(self):
+        with self._condition:
+            return dict(
+                rate=round(self.rate, 2),
+                concurrency=int(self.concurrency),
+                in_flight=self.in_flight,
+                latency=None if self.latency is None else round(self.latency, 3),
+                baseline_latency=None if self.baseline_latency is None else round(self.baseline_latency, 3),
+                paused_seconds=round(max(0.0, self._paused_until - monotonic()), 1),
+                decreases=self.decreases,
+            )
+
+    def _refill(self, now: float):
+        self.tokens = min(float(self.burst), self.tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def acquire(self) -> float:
+        """
+        Wait for a free slot and a token, return the start time to pass to 'release'
+        """
+        with self._condition:
+            while True:
+                now = monotonic()
+                self._refill(now)
+                if now < self._paused_until:
+                    timeout = self._paused_until - now
+                elif self.in_flight >= int(self.concurrency):
+                    timeout = None  # Until a request is released
+                elif self.tokens < 1:
+                    timeout = (1 - self.tokens) / self.rate
+                else:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return now
+                self._condition.wait(timeout)
+
+    def _decrease(self, now: float, reason: str):
+        # The requests sent before the decrease report the same load, so it is counted once per round trip
+        if now - self._decreased < (self.latency or 0.0):
+            return
+        self._decreased = now
+        self.decreases += 1
+        self.concurrency = max(1.0, self.concurrency / 2)
+        self.rate = max(1.0, self.rate / 2)
+        logging.info("Decrease limits for '{}' due to {}: {} requests in flight, {:.1f} requests per second".format(
+            self.host, reason, int(self.concurrency), self.rate
+        ))
+
+    def _increase(self):
+        # About a step per round trip of all the requests in flight
+        self.concurrency = min(float(self.max_concurrency), self.concurrency + 1 / self.concurrency)
+        self.rate = min(self.max_rate, self.rate + 1 / self.concurrency)
+
+    def release(self, started: float, status_code: int = None, retry_after=None, is_timed: bool = True):
+        """
+        Count the finished request: 'status_code' is None for a failed one,
+        the latency is not counted unless 'is_timed'
+        """
+        with self._condition:
+            now = monotonic()
+            self.in_flight -= 1
+            seconds = parse_retry_after(retry_after)
+            if seconds is not None:
+                self._paused_until = max(self._paused_until, now + min(seconds, WAIT_SECONDS_LIMIT))
+                logging.info(f"Pause requests to '{self.host}' for {seconds:.1f} seconds as the server asked")
+            if status_code is None or status_code in RETRY_STATUS_CODES:
+                self._decrease(now, "network error" if status_code is None else f"status {status_code}")
+            elif is_timed:
+                latency = now - started
+                if self.latency is None:
+                    self.latency = self.baseline_latency = latency
+                else:
+                    self.latency += (latency - self.latency) * 0.3
+                    self.baseline_latency += (latency - self.baseline_latency) * 0.02
+                if self.latency > self.baseline_latency * self.latency_tolerance:
+                    self._decrease(now, f"latency of {self.latency:.2f} seconds")
+                else:
+                    self._increase()
+            self._condition.notify_all()
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """
+    Transport adapter passing every request of the session through the rate limiter of its host.
+    The slot is held until the response headers are received, the streamed body is not counted
+    """
+    def send(self, request, *args, **kwargs):
+        limiter = RateLimiter.get_instance(request.url)
+        started = limiter.acquire()
+        metrics.add(requests=1)
+        try:
+            response = super().send(request, *args, **kwargs)
+        except Exception:
+            limiter.release(started)
+            raise
+        # The latency of an upload depends on its size rather than on the server load
+        body = request.body
+        is_timed = body is None or (isinstance(body, (bytes, str)) and len(body) < DOWNLOAD_CHUNK_SIZE)
+        limiter.release(started, response.status_code, response.headers.get("Retry-After"), is_timed)
+        return response
+
+
+def mount_rate_limiter(session):
+    adapter = RateLimitedAdapter()
+    for prefix in ("http://", "https://"):
+        session.mount(prefix, adapter)
+    return session
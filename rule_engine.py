@@ -0,0 +1,102 @@
+from bs4.element import NavigableString, Tag
+
+# The name to register rules for text nodes, comments included
+TEXT = "#text"
+
+
+class RuleEngine:
+    """
+    Applies transformation rules to a BeautifulSoup tree in a single post-order traversal,
+    so the children are already processed when a rule gets their parent.
+
+    A rule is registered for a tag name, optionally narrowed to the first class or the id of the tag,
+    or for any tag if no name is given. The rules matching a node are called in the order of registration.
+    A rule returns the node to pass to the next rules, which may be a replacement of the original one,
+    or None to stop processing of the node.
+    """
+    def __init__(self, ignored_prefixes: tuple = ()):
+        self.ignored_prefixes = tuple(ignored_prefixes)
+        self._count = 0
+        self._any = list()
+        self._by_name = dict()
+        self._by_class = dict()
+        self._by_id = dict()
+        self._cache = dict()
+
+    def register(self, rule, name: str = None, class_name: str = None, id_name: str = None):
+        entry = (self._count, rule)
+        self._count += 1
+        self._cache = dict()
+        if name is None:
+            self._any.append(entry)
+        elif class_name is not None:
+            self._by_class.setdefault((name, class_name), list()).append(entry)
+        elif id_name is not None:
+            self._by_id.setdefault((name, id_name), list()).append(entry)
+        else:
+            self._by_name.setdefault(name, list()).append(entry)
+
+    @staticmethod
+    def get_name(node):
+        if isinstance(node, NavigableString):
+            return TEXT
+        return node.name
+
+    @staticmethod
+    def get_attribute(node, attribute: str):
+        value = node.get(attribute)
+        if isinstance(value, list):
+            value = value[0] if len(value) > 0 else None
+        return value
+
+    @staticmethod
+    def get_children(node):
+        if isinstance(node, Tag):
+            return list(node.children)
+        return list()
+
+    def get_rules(self, node) -> list:
+        name = self.get_name(node)
+        if name is None or (name != TEXT and name.startswith(self.ignored_prefixes)):
+            return list()
+        if name == TEXT:
+            class_name = id_name = None
+        else:
+            # Only the attributes having rules are a part of the key, so the cache stays small
+            class_name = self.get_attribute(node, "class")
+            if (name, class_name) not in self._by_class:
+                class_name = None
+            id_name = self.get_attribute(node, "id")
+            if (name, id_name) not in self._by_id:
+                id_name = None
+        key = (name, class_name, id_name)
+        rules = self._cache.get(key)
+        if rules is None:
+            rules = list(self._by_name.get(name, list()))
+            if name != TEXT:
+                rules.extend(self._any)
+            rules.extend(self._by_class.get((name, class_name), list()))
+            rules.extend(self._by_id.get((name, id_name), list()))
+            rules.sort(key=lambda x: x[0])
+            self._cache[key] = rules
+        return rules
+
+    def dispatch(self, node):
+        order = -1
+        while node is not None:
+            rules = [i for i in self.get_rules(node) if i[0] > order]
+            if len(rules) == 0:
+                return
+            order, rule = rules[0]
+            node = rule(node)
+
+    def apply(self, node):
+        # Iterative traversal, the children are listed before any of them is changed
+        stack = [(node, False)]
+        while len(stack) > 0:
+            node, is_expanded = stack.pop()
+            if is_expanded:
+                self.dispatch(node)
+                continue
+            stack.append((node, True))
+            stack.extend((i, False) for i in reversed(self.get_children(node)))
@@ -0,0 +1,91 @@
+import logging
+from queue import Empty, LifoQueue
+from threading import BoundedSemaphore, Lock
+from contextlib import contextmanager
+from urllib import parse as urlparse
+from requests import Session
+from requests_ntlm import HttpNtlmAuth
+from rate_limiter import mount_rate_limiter
+from constants import WIKI_HOST_CONCURRENCY, WIKI_SESSION_POOL_SIZE
+
+
+class SessionPool:
+    """
+    Keep-alive HTTP sessions with NTLM authentication, shared by all the Wiki handlers of the run.
+    NTLM authenticates a connection rather than a request, so a session is taken from the pool for a request
+    and put back with its connection open, and the next request over it skips the handshake.
+    The concurrent requests to a host are limited by a semaphore, the rest wait for a free slot.
+    """
+    _instances = dict()
+    _instances_lock = Lock()
+
+    def __init__(
+        self,
+        username: str,
+        password: str,
+        size: int = WIKI_SESSION_POOL_SIZE,
+        host_limit: int = WIKI_HOST_CONCURRENCY,
+    ):
+        self.username = username
+        self._password = password
+        self.size = max(1, int(size))
+        self.host_limit = max(1, int(host_limit))
+        # The last used session is the most likely to keep its connection alive
+        self._sessions = LifoQueue()
+        self._count = 0
+        self._host_semaphores = dict()
+        self._lock = Lock()
+
+    @classmethod
+    def get_instance(
+        cls,
+        username: str,
+        password: str,
+        size: int = WIKI_SESSION_POOL_SIZE,
+        host_limit: int = WIKI_HOST_CONCURRENCY,
+    ):
+        # The handlers of the same account share the instance, so they share the authenticated connections
+        with cls._instances_lock:
+            instance = cls._instances.get(username)
+            if instance is None or instance._password != password:
+                instance = cls(username, password, size, host_limit)
+                cls._instances[username] = instance
+            return instance
+
+    def create_session(self):
+        session = mount_rate_limiter(Session())
+        session.auth = HttpNtlmAuth(self.username, self._password)
+        logging.debug(f"Wiki session {self._count} of {self.size} created")
+        return session
+
+    def acquire(self):
+        try:
+            return self._sessions.get_nowait()
+        except Empty:
+            pass
+        with self._lock:
+            if self._count < self.size:
+                self._count += 1
+                return self.create_session()
+        return self._sessions.get()
+
+    def release(self, session: Session):
+        self._sessions.put(session)
+
+    def get_host_semaphore(self, url: str):
+        host = urlparse.urlsplit(url).netloc
+        with self._lock:
+            semaphore = self._host_semaphores.get(host)
+            if semaphore is None:
+                semaphore = self._host_semaphores[host] = BoundedSemaphore(self.host_limit)
+            return semaphore
+
+    @contextmanager
+    def session(self, url: str):
+        # The host slot is taken first, so a request waiting for it does not hold a session
+        with self.get_host_semaphore(url):
+            session = self.acquire()
+            try:
+                yield session
+            finally:
+                self.release(session)
@@ -0,0 +1,66 @@
+import os
+import sys
+from threading import Thread
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS_DIR), "benchmark"))
+
+from connection_handler import ConnectionHandler  # noqa: E402
+from wiki_handler import WikiHandler  # noqa: E402
+
+
+@pytest.fixture
+def secret(monkeypatch, tmp_path):
+    """
+    The dict read by all the handlers instead of 'secret.json', the test fills it before creating them.
+    The run of the Wiki handlers ends with the test
+    """
+    secret_dict = dict(
+        wiki_ntlm_username="domain\\user",
+        wiki_ntlm_password="password",
+        confluence_table_of_contents_header="Table of Contents",
+        wiki_cache_dir=str(tmp_path / "cache"),
+    )
+
+    def update_secret(self, file: str = None):
+        self._secret_dict.update(secret_dict)
+
+    monkeypatch.setattr(ConnectionHandler, "update_secret", update_secret)
+    yield secret_dict
+    WikiHandler.close_run_cache()
+
+
+class RecordingHandler(BaseHTTPRequestHandler):
+    """
+    Records the path of every GET request and answers it with the 'respond' function of the server
+    """
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requested.append(self.path)
+        code, content_type, content = self.server.respond(self.path)
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+@pytest.fixture
+def http_server():
+    """
+    A local server for the Wiki handlers, the test sets its 'respond' function,
+    which returns the status, the content type and the content for a requested path
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RecordingHandler)
+    server.requested = list()
+    server.respond = lambda path: (404, "text/plain", b"Not found")
+    server.url = "http://127.0.0.1:{}/".format(server.server_port)
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
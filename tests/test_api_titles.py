@@ -0,0 +1,71 @@
+import json
+from urllib import parse as urlparse
+import pytest
+import wiki_handler
+from wiki_handler import WikiHandler
+
+TITLES = ["C++", "Q&A", "50% rule", "A|B", "Plain title", "a=b?c#d"]
+
+
+def respond(path):
+    query = {k: v[0] for k, v in urlparse.parse_qs(urlparse.urlsplit(path).query).items()}
+    titles = query.get("titles", "").split("|")
+    if query.get("prop") == "imageinfo":
+        pages = [dict(title=i, imageinfo=[dict(url=f"/images/{i}", size=1, sha1="")]) for i in titles]
+    else:
+        pages = [dict(title=i, revisions=[dict(revid=idx + 1)]) for idx, i in enumerate(titles)]
+    content = json.dumps(dict(query=dict(pages=pages))).encode("utf-8")
+    if any("Broken" in i for i in titles):
+        content = b"<html>Internal error</html>"
+    return 200, "application/json", content
+
+
+@pytest.fixture
+def api_url(secret, http_server):
+    http_server.respond = respond
+    secret.update(wiki_root_url=http_server.url)
+    return http_server
+
+
+def requested_titles(server) -> list:
+    """
+    The titles of all the API requests in their order
+    """
+    titles = list()
+    for path in server.requested:
+        query = urlparse.parse_qs(urlparse.urlsplit(path).query)
+        titles.extend(query.get("titles", [""])[0].split("|"))
+    return titles
+
+
+def test_titles_with_reserved_characters(secret, api_url):
+    handler = WikiHandler()
+    handler.connect()
+    # The '|' of a title splits it as in MediaWiki itself, the others must reach the API as they are
+    titles = [i for i in TITLES if "|" not in i]
+    revisions = handler.get_revisions(titles)
+    assert requested_titles(api_url) == titles
+    assert all(revisions[i] is not None for i in titles)
+
+
+def test_title_with_separator(secret, api_url):
+    handler = WikiHandler()
+    handler.connect()
+    revisions = handler.get_revisions(["A|B", "Q&A"])
+    assert requested_titles(api_url) == ["A", "B", "Q&A"]
+    assert revisions["Q&A"] is not None
+
+
+def test_failed_file_batch(secret, api_url, monkeypatch):
+    monkeypatch.setattr(wiki_handler, "WIKI_API_BATCH_SIZE", 1)
+    handler = WikiHandler()
+    handler.connect()
+    # Only the files of the failed batch are left to scraping
+    file_infos = handler.resolve_files(["Файл:Broken.png", "Файл:Good.png"])
+    assert file_infos["Файл:Broken.png"] is None
+    assert file_infos["Файл:Good.png"]["url"] == "/images/Файл:Good.png"
+    assert handler.resolve_files(["Файл:Other.png"])["Файл:Other.png"] is not None
+    # The next run queries the failed batch again
+    WikiHandler.close_run_cache()
+    assert handler.resolve_files(["Файл:Broken.png"]) == {"Файл:Broken.png": None}
+    assert requested_titles(api_url).count("Файл:Broken.png") == 2
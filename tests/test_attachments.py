@@ -0,0 +1,58 @@
+import io
+import pytest
+from hashlib import sha256
+from email.parser import BytesParser
+from stub_server import StubServer
+from confluence_handler import ConfluenceHandler, MultipartStream
+
+
+class ChunkedFile(io.BytesIO):
+    """
+    Records the sizes read from the file
+    """
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.read_sizes = list()
+
+    def read(self, size: int = -1):
+        self.read_sizes.append(size)
+        return super().read(size)
+
+
+def test_multipart_stream():
+    content = bytes(range(256)) * 1024
+    file = ChunkedFile(content)
+    body = MultipartStream(dict(comment="sha256:abc", minorEdit="true"), "Logo.png", file)
+    data = b"".join(iter(body))
+    assert len(data) == len(body)
+    # The file is read by chunks, never at once
+    assert all(0 < i < len(content) for i in file.read_sizes)
+    message = BytesParser().parsebytes(f"Content-Type: {body.content_type}\r\n\r\n".encode("utf-8") + data)
+    parts = {i.get_param("name", header="content-disposition"): i for i in message.get_payload()}
+    assert parts["comment"].get_payload() == "sha256:abc"
+    assert parts["file"].get_filename() == "Logo.png"
+    assert parts["file"].get_payload(decode=True) == content
+
+
+@pytest.fixture
+def stub(secret):
+    stub = StubServer(pages=1).start()
+    secret.update(stub.get_secret())
+    yield stub
+    stub.stop()
+
+
+def test_attachment_upload_and_update(stub):
+    c_handler = ConfluenceHandler()
+    c_handler.connect()
+    for content in (b"first" * 1000, b"second" * 1000):
+        result = c_handler.push_page("Page", "<p>Body</p>", [dict(
+            file_content=io.BytesIO(content),
+            file_basename="Logo.png",
+            file_digest=sha256(content).hexdigest(),
+        )])
+        assert result["failed"] == dict()
+        attachments = stub.attachments[result["page_id"]]
+        assert list(attachments.keys()) == ["Logo.png"]
+        assert attachments["Logo.png"]["digest"] == sha256(content).hexdigest()
+        assert attachments["Logo.png"]["comment"] == "sha256:{}".format(sha256(content).hexdigest())
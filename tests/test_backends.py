@@ -0,0 +1,44 @@
+import re
+import pytest
+from stub_server import StubServer
+from wiki_handler import WikiHandler
+from lxml_wiki_handler import LxmlWikiHandler
+
+
+@pytest.fixture
+def stub(secret):
+    stub = StubServer(pages=2, file_size=1 << 10, large_file_size=64 << 10).start()
+    secret.update({k: v for k, v in stub.get_secret().items() if k != "wiki_cache_dir"})
+    yield stub
+    stub.stop()
+
+
+def process_pages(handler_class: type, urls: list, source: str):
+    handler = handler_class()
+    handler.connect()
+    results = list()
+    for url in urls:
+        if source == "api":
+            processed_page_dict = handler.process_api_page(url)
+        else:
+            processed_page_dict = handler.process_page(url)
+        results.append(dict(
+            page_title=processed_page_dict["page_title"],
+            # The backends may differ in the whitespace between tags only
+            page_body=re.sub(r">\s+<", "><", processed_page_dict["page_body"]),
+            page_attachments=[(i["file_basename"], i["file_digest"]) for i in processed_page_dict["page_attachments"]],
+        ))
+    return results
+
+
+@pytest.mark.parametrize("source", ["html", "api"])
+def test_backends_produce_same_output(stub, source):
+    urls = stub.get_page_urls()
+    expected = process_pages(WikiHandler, urls, source)
+    actual = process_pages(LxmlWikiHandler, urls, source)
+    # The fixtures have tables, the flash player, images and file links, so the rules of all of them are compared
+    page_bodies = "".join(i["page_body"] for i in expected)
+    for fragment in ("<table", "<ac:image", "ac:name=\"toc\"", "ri:filename=\"Template.docx\""):
+        assert fragment in page_bodies
+    assert all(len(i["page_attachments"]) > 0 for i in expected)
+    assert actual == expected
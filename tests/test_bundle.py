@@ -0,0 +1,35 @@
+import io
+import zipfile
+import pytest
+from bundle_handler import BundleHandler
+
+
+def get_page_dict(page_title: str, page_body: str, attachment: bytes):
+    return dict(
+        page_title=page_title,
+        page_body=page_body,
+        page_attachments=[dict(file_content=io.BytesIO(attachment), file_basename="Logo.png")],
+    )
+
+
+@pytest.mark.parametrize("name", ["bundle", "bundle.zip"])
+def test_next_export_keeps_pages(tmp_path, name):
+    path = str(tmp_path / name)
+    with BundleHandler(path) as b_handler:
+        b_handler.push_page(**get_page_dict("First", "<p>1</p>", b"logo"))
+        b_handler.push_page(**get_page_dict("Second", "<p>2</p>", b"logo"))
+    # The next export with the manifest pushes the changed pages only
+    with BundleHandler(path) as b_handler:
+        b_handler.push_page(**get_page_dict("Second", "<p>2 changed</p>", b"logo"))
+        b_handler.push_page(**get_page_dict("Third", "<p>3</p>", b"logo"))
+    with BundleHandler(path) as b_handler:
+        page_dicts = [b_handler.read_page(i) for i in b_handler.list_pages()]
+    for page_dict in page_dicts:
+        assert page_dict["page_attachments"][0]["file_content"].read() == b"logo"
+        page_dict["page_attachments"][0]["file_content"].close()
+    assert sorted((i["page_title"], i["page_body"]) for i in page_dicts) == [
+        ("First", "<p>1</p>"), ("Second", "<p>2 changed</p>"), ("Third", "<p>3</p>")
+    ]
+    if name.endswith(".zip"):
+        with zipfile.ZipFile(path) as f:
+            assert len([i for i in f.namelist() if i.startswith("blobs/")]) == 1
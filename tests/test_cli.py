@@ -0,0 +1,28 @@
+import pytest
+from main import parse_args
+
+
+@pytest.mark.parametrize("argv", [
+    ["convert", "export.zip", "--manifest", "manifest.sqlite", "URL1", "URL2"],
+    ["convert", "export.zip", "URL1", "--manifest", "manifest.sqlite", "URL2"],
+    ["convert", "--manifest", "manifest.sqlite", "export.zip", "URL1", "URL2"],
+])
+def test_convert_urls_mixed_with_options(argv):
+    args = parse_args(argv)
+    assert args.bundle == "export.zip"
+    assert args.manifest == "manifest.sqlite"
+    assert args.urls == ["URL1", "URL2"]
+
+
+def test_sync_urls_mixed_with_options():
+    args = parse_args(["sync", "URL1", "--manifest", "manifest.sqlite", "URL2", "--fetch-workers", "8", "URL3"])
+    assert args.urls == ["URL1", "URL2", "URL3"]
+    assert args.manifest == "manifest.sqlite"
+    assert args.fetch_workers == 8
+
+
+def test_unknown_arguments_are_rejected():
+    with pytest.raises(SystemExit):
+        parse_args(["sync", "URL1", "--unknown", "URL2"])
+    with pytest.raises(SystemExit):
+        parse_args(["status", "manifest.sqlite", "extra"])
@@ -0,0 +1,107 @@
+import io
+import pytest
+from requests import HTTPError, Response
+from requests import exceptions as requests_exceptions
+import confluence_handler
+from stub_server import StubServer
+from confluence_handler import ConfluenceHandler
+
+
+def get_http_error(code: int):
+    response = Response()
+    response.status_code = code
+    return HTTPError(f"Status {code}", response=response)
+
+
+@pytest.fixture
+def connect_errors(secret, monkeypatch):
+    """
+    The errors raised by the following connection attempts, the attempts after them succeed
+    """
+    errors = list()
+    calls = list()
+
+    def connect(self):
+        calls.append(self)
+        if len(errors) > 0:
+            raise errors.pop(0)
+        self.is_connected = True
+
+    monkeypatch.setattr(ConfluenceHandler, "connect", connect)
+    monkeypatch.setattr(confluence_handler, "sleep", lambda seconds: None)
+    return errors, calls
+
+
+def test_wrong_credentials_are_kept(connect_errors):
+    errors, calls = connect_errors
+    errors.append(get_http_error(401))
+    c_handler = ConfluenceHandler()
+    files = [io.BytesIO(b"content") for _ in range(3)]
+    for file in files:
+        with pytest.raises(Exception, match="Status 401"):
+            c_handler.push_page("Title", "<p>Body</p>", [dict(file_content=file, file_basename="Logo.png")])
+    assert len(calls) == 1
+    assert all(i.closed for i in files)
+
+
+def test_network_errors_are_retried(connect_errors):
+    errors, calls = connect_errors
+    errors.extend([requests_exceptions.ConnectionError("Reset"), get_http_error(503)])
+    c_handler = ConfluenceHandler()
+    c_handler.ensure_connected()
+    assert c_handler.is_connected
+    assert len(calls) == 3
+
+
+def test_network_failure_is_not_kept(connect_errors):
+    errors, calls = connect_errors
+    errors.extend([requests_exceptions.Timeout("Timeout")] * confluence_handler.CONFLUENCE_CONNECT_RETRIES)
+    c_handler = ConfluenceHandler()
+    with pytest.raises(requests_exceptions.Timeout):
+        c_handler.ensure_connected()
+    # The next push connects again
+    c_handler.ensure_connected()
+    assert c_handler.is_connected
+
+
+def test_upload_limits_from_secret(secret):
+    secret.update(confluence_upload_workers=2, confluence_upload_limit=3, confluence_upload_retries=5)
+    c_handler = ConfluenceHandler()
+    assert (c_handler.upload_workers, c_handler.upload_retries) == (2, 5)
+    assert c_handler._upload_semaphore._initial_value == 3
+    assert ConfluenceHandler(upload_workers=1).upload_workers == 1
+
+
+@pytest.fixture
+def stub(secret):
+    stub = StubServer(pages=1).start()
+    secret.update(stub.get_secret())
+    yield stub
+    stub.stop()
+
+
+def test_unchanged_page_is_skipped(stub):
+    c_handler = ConfluenceHandler()
+    c_handler.connect()
+    assert c_handler.push_page("Page", "<p>Body</p>", list())["is_page_updated"]
+    assert not c_handler.push_page("Page", "<p>Body</p>", list())["is_page_updated"]
+    # The fingerprint is kept with the page for the next runs
+    c_handler = ConfluenceHandler()
+    c_handler.connect()
+    result = c_handler.push_page("Page", "<p>Body</p>", list())
+    assert not result["is_page_updated"]
+    assert result["page_version"] == stub.confluence_pages["Page"]["version"] == 1
+    assert c_handler.push_page("Page", "<p>Changed body</p>", list())["is_page_updated"]
+    assert stub.confluence_pages["Page"]["version"] == 2
+
+
+def test_edited_page_is_updated(stub):
+    c_handler = ConfluenceHandler()
+    c_handler.connect()
+    c_handler.push_page("Page", "<p>Body</p>", list())
+    # The page edited in Confluence has a newer version than its fingerprint
+    stub.confluence_pages["Page"]["version"] += 1
+    c_handler = ConfluenceHandler()
+    c_handler.connect()
+    assert c_handler.push_page("Page", "<p>Body</p>", list())["is_page_updated"]
+    assert stub.confluence_pages["Page"]["version"] == 3
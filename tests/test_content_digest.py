@@ -0,0 +1,21 @@
+from wiki_handler import WikiHandler
+
+PAGE = """<!DOCTYPE html><html><head><script>RLCONF={{"wgRequestId":"{request_id}","wgCurRevisionId":7}};</script></head>
+<body><div id="content"><h1 id="firstHeading">Title</h1><div class="mw-parser-output"><p>{text}</p>
+<!-- NewPP limit report
+Cached time: {timestamp}
+--></div><div class="printfooter">Retrieved at {timestamp}</div></div></body></html>"""
+
+
+def get_page(text: str = "Text", request_id: str = "a1", timestamp: str = "20240101000000"):
+    return PAGE.format(text=text, request_id=request_id, timestamp=timestamp).encode("utf-8")
+
+
+def test_per_request_values_are_ignored():
+    assert WikiHandler.get_content_digest(get_page()) == WikiHandler.get_content_digest(
+        get_page(request_id="b2", timestamp="20240202000000")
+    )
+
+
+def test_changed_content_is_detected():
+    assert WikiHandler.get_content_digest(get_page()) != WikiHandler.get_content_digest(get_page(text="Changed"))
@@ -0,0 +1,33 @@
+from bs4 import BeautifulSoup
+from fragment_factory import FragmentFactory
+from constants import TEMPLATE_HYPERLINK, TEMPLATE_SPOILED_IMAGE, TEMPLATE_TABLE_OF_CONTENTS
+
+VALUE = "a<b>&\"c\"{d}"
+
+
+def test_values_are_escaped():
+    factory = FragmentFactory()
+    tag = factory.create("ac:structured-macro", TEMPLATE_SPOILED_IMAGE, {"ac:name": "expand"}, basename=VALUE, filename=VALUE)
+    html = str(tag)
+    assert "a&lt;b&gt;&amp;" in html and "<b>" not in html
+    # The markup parsed back has the values as they are
+    tag = BeautifulSoup(html, "html.parser").find("ac:structured-macro")
+    assert tag["ac:name"] == "expand"
+    assert tag.find("ac:parameter").string == VALUE
+    assert tag.find("ri:attachment")["ri:filename"] == VALUE
+
+
+def test_value_in_cdata():
+    factory = FragmentFactory()
+    tag = factory.create("ac:link", TEMPLATE_HYPERLINK, basename="Logo.png", link_text="x]]><b>y</b>")
+    # The value can not close the section to inject markup
+    assert "<![CDATA[x]]]]><![CDATA[><b>y</b>]]>" in str(tag)
+
+
+def test_skeleton_is_reused():
+    factory = FragmentFactory()
+    first = factory.create("div", TEMPLATE_TABLE_OF_CONTENTS, header="First")
+    second = factory.create("div", TEMPLATE_TABLE_OF_CONTENTS, header="<Second>")
+    assert len(factory._skeletons) == 1
+    assert str(first).startswith('<div><b id="toc">First</b><ac:structured-macro ac:name="toc">')
+    assert str(second).startswith('<div><b id="toc">&lt;Second&gt;</b><ac:structured-macro ac:name="toc">')
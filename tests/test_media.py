@@ -0,0 +1,59 @@
+import os
+import io
+import pytest
+import media_handler
+import wiki_handler
+from media_handler import MediaHandler
+from wiki_handler import WikiHandler
+
+Image = pytest.importorskip("PIL.Image")
+SIZE_LIMIT = 64 << 10
+
+
+def get_image_content(image_format: str, frames: int = 1):
+    # The noise is not compressible, so the file size follows the dimensions
+    images = [Image.frombytes("RGB", (256, 256), os.urandom(256 * 256 * 3)) for _ in range(frames)]
+    with io.BytesIO() as f:
+        images[0].save(f, image_format, save_all=frames > 1, append_images=images[1:])
+        return f.getvalue()
+
+
+@pytest.fixture
+def handler(secret, monkeypatch):
+    monkeypatch.setattr(wiki_handler, "CONFLUENCE_ATTACHMENT_SIZE_LIMIT", SIZE_LIMIT)
+    monkeypatch.setattr(media_handler, "CONFLUENCE_ATTACHMENT_SIZE_LIMIT", SIZE_LIMIT)
+    handler = WikiHandler()
+    handler.media = MediaHandler(size_threshold=0, max_dimension=256, quality=85, workers=1)
+    handler.requested = list()
+
+    def download(url, file, size_limit=SIZE_LIMIT, **kwargs):
+        handler.requested.append(url)
+        content = handler.contents[os.path.basename(url)]
+        if len(content) >= size_limit:
+            return False
+        file.write(content)
+        return True
+
+    handler.download = download
+    return handler
+
+
+def test_oversized_image_is_reduced(handler):
+    handler.contents = {"Photo.png": get_image_content("PNG")}
+    assert len(handler.contents["Photo.png"]) >= SIZE_LIMIT
+    assert handler.add_attachment("http://wiki/images/Photo.png")
+    file = handler.attachments[0]["file_content"]
+    assert file.seek(0, os.SEEK_END) < SIZE_LIMIT
+    assert handler.media_futures == list()
+
+
+def test_oversized_animation_is_not_added(handler):
+    handler.contents = {"Movie.png": get_image_content("PNG", frames=3)}
+    assert not handler.add_attachment("http://wiki/images/Movie.png")
+    assert handler.attachments == list()
+
+
+def test_oversized_gif_is_not_downloaded(handler):
+    handler.contents = {"Movie.gif": get_image_content("GIF", frames=3)}
+    assert not handler.add_attachment("http://wiki/images/Movie.gif", size=SIZE_LIMIT)
+    assert handler.requested == list()
@@ -0,0 +1,89 @@
+import pytest
+import pipeline_handler
+from stub_server import StubServer
+from wiki_handler import WikiHandler
+from manifest_handler import ManifestHandler
+from pipeline_handler import PipelineHandler
+
+
+class FakeConfluenceHandler:
+    """
+    Keeps the pushed pages instead of uploading them
+    """
+    def __init__(self, failing_titles: tuple = ()):
+        self.pages = dict()
+        self.failing_titles = failing_titles
+
+    def push_page(self, page_title: str, page_body: str, page_attachments: list):
+        for attachment_dict in page_attachments:
+            attachment_dict["file_content"].close()
+        if page_title in self.failing_titles:
+            raise ValueError("Unable to upload the page")
+        self.pages[page_title] = page_body
+        return dict(failed=dict(), page_id=page_title, page_version=1, attachments=dict())
+
+
+@pytest.fixture
+def stub(secret):
+    stub = StubServer(pages=4, file_size=1 << 10, large_file_size=4 << 10).start()
+    secret.update({k: v for k, v in stub.get_secret().items() if k != "wiki_cache_dir"})
+    yield stub
+    stub.stop()
+
+
+def test_failed_revision_batch(stub, monkeypatch, tmp_path):
+    monkeypatch.setattr(pipeline_handler, "WIKI_API_BATCH_SIZE", 2)
+    get_revisions = WikiHandler.get_revisions
+
+    def get_failing_revisions(self, titles: list):
+        if "Benchmark page 3" in titles:
+            raise ValueError("Unable to query revisions")
+        return get_revisions(self, titles)
+
+    monkeypatch.setattr(WikiHandler, "get_revisions", get_failing_revisions)
+    urls = stub.get_page_urls()
+    manifest = ManifestHandler(str(tmp_path / "manifest.sqlite"))
+    pipeline = PipelineHandler(FakeConfluenceHandler(), manifest_handler=manifest, source="api")
+    succeeded, failed = pipeline.run(urls)
+    # Only the pages of the failed batch fail, and the manifest has them to be retried
+    assert sorted(succeeded) == sorted(urls[:2])
+    assert sorted(failed.keys()) == sorted(urls[2:])
+    assert sorted(manifest.get_failed().keys()) == sorted(urls[2:])
+    assert pipeline._total == len(urls)
+
+
+@pytest.mark.parametrize("source", ["html", "api"])
+def test_failed_page_is_isolated(stub, source):
+    urls = stub.get_page_urls()
+    missing_url = urls[0].replace("Benchmark_page_0", "Missing_page")
+    confluence = FakeConfluenceHandler(failing_titles=("Benchmark page 1",))
+    pipeline = PipelineHandler(confluence, source=source, fetch_workers=2, upload_workers=2)
+    succeeded, failed = pipeline.run([missing_url] + urls)
+    # A page failed in any stage fails alone, the other pages are uploaded
+    assert sorted(failed.keys()) == sorted([missing_url, urls[1]])
+    assert failed[missing_url].startswith("fetch: ")
+    assert failed[urls[1]].startswith("upload: ")
+    assert sorted(succeeded) == sorted([urls[0]] + urls[2:])
+    assert sorted(confluence.pages.keys()) == ["Benchmark page 0", "Benchmark page 2", "Benchmark page 3"]
+
+
+@pytest.mark.parametrize("source", ["html", "api"])
+def test_manifest_skips_unchanged_pages(stub, tmp_path, source):
+    urls = stub.get_page_urls()
+    manifest = ManifestHandler(str(tmp_path / "manifest.sqlite"))
+    confluence = FakeConfluenceHandler(failing_titles=("Benchmark page 1",))
+    PipelineHandler(confluence, manifest_handler=manifest, source=source).run(urls)
+    # The next run uploads only the page failed before, the others are unchanged
+    confluence = FakeConfluenceHandler()
+    pipeline = PipelineHandler(confluence, manifest_handler=manifest, source=source)
+    succeeded, failed = pipeline.run(urls)
+    assert succeeded == [urls[1]]
+    assert failed == dict()
+    assert sorted(pipeline.skipped) == sorted(urls[:1] + urls[2:])
+    assert list(confluence.pages.keys()) == ["Benchmark page 1"]
+    assert manifest.get_failed() == dict()
+    # And then all of them are skipped
+    confluence = FakeConfluenceHandler()
+    succeeded, failed = PipelineHandler(confluence, manifest_handler=manifest, source=source).run(urls)
+    assert succeeded == [] and failed == dict()
+    assert confluence.pages == dict()
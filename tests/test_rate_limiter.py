@@ -0,0 +1,71 @@
+import pytest
+import rate_limiter
+from rate_limiter import RateLimiter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limiter, "monotonic", clock)
+    return clock
+
+
+def request(limiter: RateLimiter, clock: Clock, status_code=200, latency: float = 0.1, retry_after=None):
+    started = limiter.acquire()
+    clock.now += latency
+    limiter.release(started, status_code, retry_after)
+
+
+@pytest.mark.parametrize("status_code", [429, 503, None])
+def test_overload_halves_limits(clock, status_code):
+    limiter = RateLimiter("wiki", rate=40, burst=100, concurrency=8)
+    request(limiter, clock)
+    request(limiter, clock, status_code)
+    assert (limiter.rate, limiter.concurrency, limiter.decreases) == (20, 4, 1)
+    # The responses to the requests sent before the decrease are counted once
+    request(limiter, clock, status_code, latency=0.01)
+    assert limiter.decreases == 1
+    clock.now += 1
+    request(limiter, clock, status_code)
+    assert (limiter.rate, limiter.concurrency, limiter.decreases) == (10, 2, 2)
+
+
+def test_success_restores_limits_by_steps(clock):
+    limiter = RateLimiter("wiki", rate=40, burst=1000, concurrency=8)
+    request(limiter, clock)
+    request(limiter, clock, 503)
+    rate, concurrency = limiter.rate, limiter.concurrency
+    request(limiter, clock)
+    # The increase is additive, a fraction of a request per response
+    assert concurrency < limiter.concurrency <= concurrency + 1
+    assert rate < limiter.rate <= rate + 1
+    for _ in range(500):
+        request(limiter, clock)
+    assert (limiter.rate, limiter.concurrency) == (40, 8)
+
+
+def test_latency_growth_decreases_limits(clock):
+    limiter = RateLimiter("wiki", rate=40, burst=1000, concurrency=8, latency_tolerance=3.0)
+    for _ in range(20):
+        request(limiter, clock, latency=0.1)
+    assert limiter.decreases == 0
+    for _ in range(5):
+        request(limiter, clock, latency=2.0)
+    assert limiter.decreases > 0
+    assert limiter.concurrency < 8
+
+
+def test_retry_after_pauses_requests(clock):
+    limiter = RateLimiter("wiki", rate=40, burst=100, concurrency=8)
+    request(limiter, clock, 429, retry_after="5")
+    assert limiter.get_stats()["paused_seconds"] == 5.0
+    clock.now += 5
+    assert limiter.get_stats()["paused_seconds"] == 0.0
@@ -0,0 +1,66 @@
+from bs4 import BeautifulSoup
+from rule_engine import RuleEngine, TEXT
+
+
+def get_recorder(calls: list, label: str, result=None):
+    def rule(node):
+        calls.append((label, RuleEngine.get_name(node)))
+        return node if result is None else result(node)
+    return rule
+
+
+def test_rules_order():
+    soup = BeautifulSoup('<div class="box main" id="top"><p>Text</p></div>', "html.parser")
+    calls = list()
+    engine = RuleEngine()
+    engine.register(get_recorder(calls, "id"), "div", id_name="top")
+    engine.register(get_recorder(calls, "name"), "div")
+    engine.register(get_recorder(calls, "any"))
+    engine.register(get_recorder(calls, "class"), "div", class_name="box")
+    engine.register(get_recorder(calls, "other class"), "div", class_name="main")
+    engine.register(get_recorder(calls, "text"), TEXT)
+    engine.apply(soup.contents[0])
+    # The children come before their parents, the rules of a node in the order of registration,
+    # the rules for any tag skip the text, and only the first class of a tag counts
+    assert calls == [
+        ("text", TEXT),
+        ("any", "p"),
+        ("id", "div"),
+        ("name", "div"),
+        ("any", "div"),
+        ("class", "div"),
+    ]
+
+
+def test_replaced_and_removed_nodes():
+    soup = BeautifulSoup("<p><b>Bold</b><i>Italic</i></p>", "html.parser")
+    calls = list()
+
+    def replace(node):
+        new_node = soup.new_tag("strong")
+        new_node.string = node.get_text()
+        node.replace_with(new_node)
+        return new_node
+
+    def remove(node):
+        node.decompose()
+        return None
+
+    engine = RuleEngine()
+    engine.register(get_recorder(calls, "strong"), "strong")
+    engine.register(replace, "b")
+    engine.register(remove, "i")
+    engine.register(get_recorder(calls, "after"))
+    engine.apply(soup.contents[0])
+    # The replacement gets only the rules registered after the replacing one, the removed node gets none
+    assert calls == [("after", "strong"), ("after", "p")]
+    assert str(soup) == "<p><strong>Bold</strong></p>"
+
+
+def test_ignored_prefixes():
+    soup = BeautifulSoup("<p><ac:image>Image</ac:image></p>", "html.parser")
+    calls = list()
+    engine = RuleEngine(ignored_prefixes=("ac:",))
+    engine.register(get_recorder(calls, "any"))
+    engine.apply(soup.contents[0])
+    assert calls == [("any", "p")]
@@ -0,0 +1,50 @@
+import os
+import pytest
+from wiki_handler import WikiHandler
+
+
+def respond(path):
+    return (404, "text/plain", b"Not found") if "missing" in path else (200, "text/plain", b"Content")
+
+
+@pytest.fixture
+def server(http_server):
+    http_server.respond = respond
+    return http_server
+
+
+@pytest.fixture
+def handler(secret, server):
+    secret.update(wiki_root_url=server.url, wiki_cache_dir="")
+    handler = WikiHandler()
+    handler.connect()
+    return handler
+
+
+def test_missing_url_is_requested_once(handler, server):
+    for _ in range(3):
+        assert handler.get_page(handler.root_url + "images/missing.pptx") == b""
+        assert handler.get_page(handler.root_url + "images/Logo.png") == b"Content"
+    assert server.requested == ["/images/missing.pptx", "/images/Logo.png"]
+
+
+def test_run_cache_is_removed(handler):
+    cache_dir = handler.cache.directory
+    assert os.path.isdir(cache_dir)
+    WikiHandler.close_run_cache()
+    assert not os.path.exists(cache_dir)
+    handler = WikiHandler()
+    handler.connect()
+    assert handler.cache.directory != cache_dir
+
+
+def test_next_run_revalidates(secret, server, tmp_path):
+    secret.update(wiki_root_url=server.url, wiki_cache_dir=str(tmp_path))
+    for _ in range(2):
+        handler = WikiHandler()
+        handler.connect()
+        for _ in range(2):
+            handler.get_page(handler.root_url + "images/missing.pptx")
+            handler.get_page(handler.root_url + "images/Logo.png")
+        WikiHandler.close_run_cache()
+    assert server.requested == ["/images/missing.pptx", "/images/Logo.png"] * 2
@@ -2,8 +2,6 @@
 import os
 import re
 import logging
-from bs4.element import Tag
-from bs4 import BeautifulSoup
 
 
 def process_string(s: str):
@@ -23,21 +21,18 @@ def load_dict(file: str):
     return loads(load_string(file))
 
 
-def create_tag(tag: str, value: str = "", attrs: dict = None) -> Tag:
-    tag = str(tag)
+def create_tag(tag: str, value: str = "", attrs: dict = None):
+    # BeautifulSoup is imported on demand, so the commands not parsing pages start faster
+    from bs4.element import NavigableString, Tag
+    # The value is a text, it is escaped on serialization instead of being parsed as markup
+    new_tag = Tag(name=str(tag), attrs=dict(attrs) if isinstance(attrs, dict) else None)
     value = str(value)
-    open_tag = f"<{tag}>"
-    if attrs is not None and isinstance(attrs, dict):
-        open_tag = "<{} {}>".format(
-            tag,
-            " ".join(f"{k}=\"{v}\"" for k, v in attrs.items())
-        )
-    return BeautifulSoup(
-        open_tag + value + f"</{tag}>", "html.parser"  # Keeps elements like '<![CDATA[...]]>'
-    ).find(f"{tag}")
-
-
-def remove_tag_children(tag: Tag):
+    if len(value) > 0:
+        new_tag.append(NavigableString(value))
+    return new_tag
+
+
+def remove_tag_children(tag):
     if hasattr(tag, "children"):
         children = list(tag.children)
         if len(children) > 0:
@@ -48,15 +43,16 @@ def remove_tag_children(tag: Tag):
                     child.replace_with("")
 
 
-def get_tag_attribute(tag: Tag, attribute: str) -> str:
-    logging.debug(f"Get attribute '{attribute}' from tag {str(tag)}'")
+def get_tag_attribute(tag, attribute: str) -> str:
+    # Called for every tag, so the messages are formatted only if they are logged
+    logging.debug("Get attribute '%s' from tag '%s'", attribute, tag.name)
     value = tag.get(attribute)
     if value is None:
         value = ""
     if isinstance(value, list):
         value = value[0]
     if len(value) > 0:
-        logging.debug(f"The attribute value is '{value}'")
+        logging.debug("The attribute value is '%s'", value)
     return value
 
 
@@ -66,17 +62,60 @@ def is_file_url(s: str) -> bool:
     return any(s.endswith(f".{i}") for i in FILE_EXTENSIONS)
 
 
-def is_valid_size(x):
+def is_valid_size(x, limit: int = None):
     from constants import CONFLUENCE_ATTACHMENT_SIZE_LIMIT
     z = int(x)
-    o = z < CONFLUENCE_ATTACHMENT_SIZE_LIMIT
+    o = z < (CONFLUENCE_ATTACHMENT_SIZE_LIMIT if limit is None else limit)
     if o:
-        logging.debug(f"The object size does not exceed Confluence limits: {z}")
+        logging.debug("The object size does not exceed Confluence limits: %s", z)
     else:
         logging.warning(f"The object size exceeds Confluence limits: {z}")
     return o
 
 
+def parse_retry_after(s) -> float:
+    # The 'Retry-After' header contains either seconds or HTTP date
+    from email.utils import parsedate_to_datetime
+    from datetime import datetime, timezone
+    if s is None:
+        return None
+    s = str(s).strip()
+    if s.isdigit():
+        return float(s)
+    try:
+        return max(0.0, (parsedate_to_datetime(s) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def get_backoff_seconds(attempt: int, retry_after=None) -> float:
+    # Exponential backoff with full jitter, unless the server asks for the specific delay
+    from random import uniform
+    from constants import WAIT_SECONDS, WAIT_SECONDS_LIMIT
+    seconds = parse_retry_after(retry_after)
+    if seconds is not None:
+        return min(seconds, WAIT_SECONDS_LIMIT)
+    return uniform(0, min(WAIT_SECONDS * 2 ** (attempt - 1), WAIT_SECONDS_LIMIT))
+
+
+def get_file_digest(file) -> str:
+    # SHA-256 of the whole content of the binary file object, the file is left at the beginning
+    from hashlib import sha256
+    from constants import DOWNLOAD_CHUNK_SIZE
+    hasher = sha256()
+    file.seek(0)
+    for chunk in iter(lambda: file.read(DOWNLOAD_CHUNK_SIZE), b""):
+        hasher.update(chunk)
+    file.seek(0)
+    return hasher.hexdigest()
+
+
+def get_body_fingerprint(body: str) -> str:
+    # The whitespace between tags does not change the rendered page
+    from hashlib import sha256
+    return sha256(re.sub(r">\s+<", "><", body.strip()).encode("utf-8")).hexdigest()
+
+
 def filename_only(s: str):
     return os.path.splitext(os.path.basename(s))[0]
 
@@ -86,7 +125,7 @@ def is_attachment(s: str):
     bn = s.split("/")[-1]
     o = any(bn.startswith(f"{i}:") for i in WIKI_ATTACHMENT_PAGE_PREFIXES)
     if o:
-        logging.debug(f"Attachment found: '{s}'")
+        logging.debug("Attachment found: '%s'", s)
     return o
 
 
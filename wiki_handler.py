@@ -1,25 +1,52 @@
 
 import os
 import re
+import json
 import lxml
 import logging
+from io import BytesIO
+from hashlib import sha256
 from time import sleep
-from requests import Session
+from requests import exceptions as requests_exceptions
 from bs4 import BeautifulSoup
 from mimetypes import guess_type
+from tempfile import SpooledTemporaryFile, TemporaryDirectory
+from threading import Lock
 from urllib import parse as urlparse
-from requests_ntlm import HttpNtlmAuth
-from bs4.element import Tag, NavigableString
+from bs4.element import Comment, NavigableString
+from cache_handler import CacheHandler
+from rule_engine import RuleEngine, TEXT
+from fragment_factory import FragmentFactory
 from connection_handler import ConnectionHandler
+from session_pool import SessionPool
+from media_handler import MediaHandler
+from metrics import metrics
 from constants import (
+    ATTACHMENT_MARKER,
+    ATTACHMENT_SPOOL_SIZE,
+    CONFLUENCE_ATTACHMENT_SIZE_LIMIT,
+    DOWNLOAD_CHUNK_SIZE,
+    MEDIA_MAX_DIMENSION,
+    MEDIA_QUALITY,
+    MEDIA_SIZE_THRESHOLD,
+    MEDIA_WORKERS,
+    RETRY_STATUS_CODES,
     TEMPLATE_HYPERLINK,
     TEMPLATE_SPOILED_IMAGE,
+    TEMPLATE_TABLE_OF_CONTENTS,
     USER_AGENT,
-    WAIT_SECONDS,
+    WIKI_API_BATCH_SIZE,
+    WIKI_CACHE_SIZE_LIMIT,
+    WIKI_FLASH_PLAYER_PATH,
+    WIKI_HOST_CONCURRENCY,
+    WIKI_REQUEST_TIMEOUT,
+    WIKI_SESSION_POOL_SIZE,
 )
 from utils import (
     create_tag,
     filename_only,
+    get_backoff_seconds,
+    get_file_digest,
     get_tag_attribute,
     is_attachment,
     is_file_url,
@@ -35,28 +62,89 @@ from utils import (
 
 
 class WikiHandler(ConnectionHandler):
+    rule_engine_class = RuleEngine
+    # The parsed templates are shared by all instances
+    fragment_factory = FragmentFactory()
+    # Keeps the content fetched in this run if the persistent cache is not set, removed by 'close_run_cache'
+    _run_cache_dir = None
+    _run_cache_lock = Lock()
+    # File title -> dict(url=..., size=..., sha1=...) resolved by MediaWiki API, cleared by 'close_run_cache'
+    _file_infos = dict()
+    _file_infos_lock = Lock()
+
     def __init__(self):
         super().__init__()
         self.root_url = ""
         self.table_of_contents_header = ""
         self.attachments = list()
+        self.rule_engine = self.create_rule_engine()
+        self.cache = None
+        self.is_offline = False
+        # In the deferred mode the links are replaced with markers and no requests are made,
+        # so the page may be processed in another process
+        self.is_deferred = False
+        self.attachment_references = list()
+        # Recompresses the large images if 'media_recompress' is set, the pending results are in 'media_futures'
+        self.media = None
+        self.media_futures = list()
+
+    @classmethod
+    def get_run_cache_dir(cls):
+        with cls._run_cache_lock:
+            if cls._run_cache_dir is None:
+                cls._run_cache_dir = TemporaryDirectory(prefix="wiki_cache_", ignore_cleanup_errors=True)
+            return cls._run_cache_dir.name
+
+    @classmethod
+    def close_run_cache(cls):
+        """
+        End the run of the cache: the URLs of the persistent cache are revalidated by the next run,
+        and the temporary cache is removed, the next handler to connect gets a new one.
+        The file URLs are resolved anew too, including the ones of the failed MediaWiki API batches
+        """
+        CacheHandler.reset_instances()
+        with WikiHandler._file_infos_lock:
+            WikiHandler._file_infos.clear()
+        with cls._run_cache_lock:
+            if cls._run_cache_dir is None:
+                return
+            CacheHandler.close_instance(cls._run_cache_dir.name)
+            cls._run_cache_dir.cleanup()
+            cls._run_cache_dir = None
+
+    def connect_cache(self):
+        cache_dir = self._secret_dict.get("wiki_cache_dir", "")
+        if self.cache is None:
+            self.cache = CacheHandler.get_instance(
+                cache_dir if len(cache_dir) > 0 else self.get_run_cache_dir(),
+                self._secret_dict.get("wiki_cache_size_limit", WIKI_CACHE_SIZE_LIMIT)
+            )
+        # Serve the cached content only, without any requests to Wiki
+        self.is_offline = len(cache_dir) > 0 and bool(self._secret_dict.get("wiki_cache_offline", False))
+
+    def configure(self):
+        self.root_url = self._secret_dict["wiki_root_url"]
+        self.table_of_contents_header = self._secret_dict["confluence_table_of_contents_header"]
 
     def connect(self):
-        self.is_connected = False
-        while not self.is_connected:
-            try:
-                del self.client
-                self.client = Session()
-                self.client.auth = HttpNtlmAuth(
-                    self._secret_dict["wiki_ntlm_username"],
-                    self._secret_dict["wiki_ntlm_password"],
-                )
-                self.root_url = self._secret_dict["wiki_root_url"]
-                self.table_of_contents_header = self._secret_dict["confluence_table_of_contents_header"]
-                logging.debug("Wiki client connected")
-                super().connect()
-            except KeyError:  # Auth failure
-                pass
+        self.connect_cache()
+        # The sessions are not rebuilt on reconnection, so their authenticated connections are kept
+        self.client = SessionPool.get_instance(
+            self._secret_dict["wiki_ntlm_username"],
+            self._secret_dict["wiki_ntlm_password"],
+            self._secret_dict.get("wiki_session_pool_size", WIKI_SESSION_POOL_SIZE),
+            self._secret_dict.get("wiki_host_concurrency", WIKI_HOST_CONCURRENCY),
+        )
+        if self._secret_dict.get("media_recompress", False):
+            self.media = MediaHandler.get_instance(
+                self._secret_dict.get("media_size_threshold", MEDIA_SIZE_THRESHOLD),
+                self._secret_dict.get("media_max_dimension", MEDIA_MAX_DIMENSION),
+                self._secret_dict.get("media_quality", MEDIA_QUALITY),
+                self._secret_dict.get("media_workers", MEDIA_WORKERS),
+            )
+        self.configure()
+        logging.debug("Wiki client connected")
+        super().connect()
 
     def import_url(self, s: str):
         s = s.strip()
@@ -75,189 +163,584 @@ class WikiHandler(ConnectionHandler):
             )
         )
         if o:
-            logging.debug(f"File URL found: '{s}'")
+            logging.debug("File URL found: '%s'", s)
         return o
 
-    def get_page(self, url: str, empty_content_retries: int = 5):
-        url = self.import_url(url)
+    def download(
+        self,
+        url: str,
+        file,
+        empty_content_retries: int = 5,
+        is_immutable: bool = False,
+        size_limit: int = CONFLUENCE_ATTACHMENT_SIZE_LIMIT,
+        is_encoded: bool = False,
+    ):
+        """
+        Stream the URL content into the writable binary file object.
+        Return True if non-empty content was written.
+        The cached content of an immutable URL is used without requests.
+        The content of 'size_limit' bytes or larger is skipped.
+        The encoded URL like of 'get_api_url' is requested as it is, unquoting would break '&', '+' or '%' of its query.
+        """
+        if not is_encoded:
+            url = self.import_url(url)
+        cached = None
+        if self.cache is not None:
+            if (is_immutable or self.cache.is_fresh(url)) and self.cache.read_into(url, file):
+                logging.debug(f"Already fetched in this run, use the cached content for '{url}'")
+                return True
+            if self.cache.is_missing(url):
+                logging.debug(f"Already found missing in this run: '{url}'")
+                return False
+            cached = self.cache.get(url)
+            if self.is_offline:
+                if not self.cache.read_into(url, file):
+                    logging.warning(f"The URL is not cached: '{url}'")
+                    return False
+                return True
         for retry in range(1, empty_content_retries + 1):
-            logging.debug("Fetch the URL '{}' for attempt {} of {}".format(
-                url, retry, empty_content_retries
-            ))
+            logging.debug("Fetch the URL '%s' for attempt %s of %s", url, retry, empty_content_retries)
+            if retry > 1:
+                metrics.add(retries=1)
+            file.seek(0)
+            file.truncate()
+            headers = {"User-Agent": USER_AGENT}
+            if cached is not None:
+                headers.update(self.cache.get_conditional_headers(cached))
+            retry_after = None
             try:
-                head = self.client.head(url, allow_redirects=True)
-                code = head.status_code
-                if code != 200:
-                    logging.warning(f"Got response with status {code} for '{url}'")
-                    if code >= 500:
-                        logging.info(f"Wait {WAIT_SECONDS} seconds due to server error")
-                        sleep(WAIT_SECONDS)
-                        self.connect()
-                    continue
-                logging.debug(f"Check size for '{url}'")
-                if not is_valid_size(head.headers.get("content-length", -1)):
-                    logging.warning(f"Skip the URL due to excess file size: '{url}'")
-                    return b""
-                response = self.client.get(
-                    url,
-                    headers={
-                        "User-Agent": USER_AGENT
-                    }
-                )
-                content = response.content
-                if len(content) > 0:
-                    return content
+                with self.client.session(url) as session, session.get(
+                    url, headers=headers, stream=True, timeout=WIKI_REQUEST_TIMEOUT
+                ) as response:
+                    code = response.status_code
+                    if code == 304 and cached is not None:
+                        if self.cache.read_into(url, file):
+                            logging.debug(f"Not modified, use the cached content for '{url}'")
+                            self.cache.set_fresh(url)
+                            return True
+                        cached = None
+                        continue
+                    if code == 200:
+                        if not self.read_response(response, file, size_limit):
+                            logging.warning(f"Skip the URL due to excess file size: '{url}'")
+                            return False
+                        if file.tell() > 0:
+                            metrics.add(bytes=file.tell())
+                            if self.cache is not None:
+                                self.cache.put(url, file, response.headers)
+                            return True
+                        logging.warning(f"Got empty content for '{url}'")
+                    elif code == 401:
+                        # Only the connections of the session are dropped, the next attempt authenticates anew
+                        logging.warning(f"Authentication failed for '{url}', reconnect")
+                        session.close()
+                    elif code in RETRY_STATUS_CODES:
+                        logging.warning(f"Got response with status {code} for '{url}'")
+                        retry_after = response.headers.get("Retry-After")
+                    else:
+                        logging.warning(f"Skip the URL due to response status {code}: '{url}'")
+                        if self.cache is not None:
+                            self.cache.set_missing(url)
+                        return False
+            except (
+                requests_exceptions.ConnectionError,
+                requests_exceptions.Timeout,
+                requests_exceptions.ChunkedEncodingError,
+            ) as e:
+                logging.warning(f"Got network error for '{url}': '{e}'")
             except Exception as e:
                 logging.exception(f"Got exception: '{e}'")
-                sleep(WAIT_SECONDS)
-                self.connect()
+            if retry < empty_content_retries:
+                seconds = get_backoff_seconds(retry, retry_after)
+                logging.info(f"Wait {seconds:.1f} seconds before the next attempt")
+                sleep(seconds)
         logging.critical("Exceeded empty content retries count for the URL: '{}'".format(url))
+        return False
+
+    @staticmethod
+    def read_response(response, file, size_limit: int = CONFLUENCE_ATTACHMENT_SIZE_LIMIT):
+        # Stop reading as soon as the size is known to exceed Confluence limits
+        if not is_valid_size(response.headers.get("content-length", -1), size_limit):
+            return False
+        size = 0
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size >= size_limit:
+                logging.warning(f"The object size exceeds Confluence limits: {size}")
+                return False
+            file.write(chunk)
+        return True
+
+    def get_page(self, *args, **kwargs):
+        with BytesIO() as f:
+            if self.download(*args, file=f, **kwargs):
+                return f.getvalue()
         return b""
 
     def get_soup(self, *args, **kwargs):
-        return BeautifulSoup(
-            self.get_page(*args, **kwargs),
-            features="lxml"
-        )
+        return self.parse(self.get_page(*args, **kwargs))
 
-    def add_attachment(self, url: str):
+    def add_attachment(self, url: str, size: int = None):
         url = self.import_url(url)
         logging.debug(f"Add attachment: '{url}'")
-        content = self.get_page(url)
-        if len(content) > 0:
-            self.attachments.append(dict(
-                file_content=content,
-                file_basename=os.path.basename(url),
-            ))
+        # The images exceeding Confluence limits are reduced before the upload, if their format is written back
+        is_recompressed = self.media is not None and is_image(url)
+        size_limit = CONFLUENCE_ATTACHMENT_SIZE_LIMIT
+        if is_recompressed and self.media.is_supported(url):
+            size_limit = self.media.download_size_limit
+        # The size is known if the file was resolved by MediaWiki API
+        if size is not None and not is_valid_size(size, size_limit):
+            logging.debug(f"The attachment was not added: '{url}'")
+            return False
+        # Small files stay in memory, the larger ones are spilled to disk
+        file = SpooledTemporaryFile(max_size=ATTACHMENT_SPOOL_SIZE)
+        with metrics.measure("attachment_fetch"):
+            is_downloaded = self.download(url, file, size_limit=size_limit)
+        if is_downloaded and is_recompressed and file.seek(0, os.SEEK_END) >= CONFLUENCE_ATTACHMENT_SIZE_LIMIT:
+            # The upload would fail, so the image is reduced right away and is not added unless it fits
+            with metrics.measure("media"):
+                new_file = self.media.recompress(file, os.path.basename(url))
+            file.close()
+            if new_file is file:
+                logging.warning(f"The attachment was not added, it exceeds Confluence limits: '{url}'")
+                return False
+            file = new_file
+            is_recompressed = False
+        if is_downloaded:
+            attachment_dict = dict(file_content=file, file_basename=os.path.basename(url))
+            if is_recompressed:
+                # The digest is taken once the image is recompressed, see 'complete_attachments'
+                self.media_futures.append((attachment_dict, self.media.submit(file, attachment_dict["file_basename"])))
+            else:
+                attachment_dict["file_digest"] = get_file_digest(file)
+            self.attachments.append(attachment_dict)
             return True
+        file.close()
         logging.debug(f"The attachment was not added: '{url}'")
         return False
 
+    def complete_attachments(self):
+        # Wait for the images being recompressed, while they were the next attachments of the page were downloaded
+        for attachment_dict, future in self.media_futures:
+            file = future.result()
+            if file is not attachment_dict["file_content"]:
+                attachment_dict["file_content"].close()
+                attachment_dict["file_content"] = file
+            attachment_dict["file_digest"] = get_file_digest(file)
+        self.media_futures = list()
+
+    # Document primitives, the rules below use only them, so another parser backend overrides only these methods
+
+    @staticmethod
+    def parse(content: bytes):
+        return BeautifulSoup(content, features="lxml")
+
+    @staticmethod
+    def get_children(tag) -> list:
+        return tag.contents
+
+    @staticmethod
+    def serialize_children(tag) -> str:
+        # Unlike the nested ones, a top level comment is converted to its bare text by 'str'
+        return "".join(i.output_ready() if isinstance(i, Comment) else str(i) for i in tag.contents)
+
+    @staticmethod
+    def get_name(tag) -> str:
+        return tag.name
+
+    @staticmethod
+    def find_tag(tag, name: str, attrs: dict):
+        return tag.find(name, attrs)
+
+    @staticmethod
+    def find_all_tags(tag, name: str) -> list:
+        return tag.find_all(name)
+
+    @staticmethod
+    def get_attribute(tag, attribute: str) -> str:
+        return get_tag_attribute(tag, attribute)
+
+    @staticmethod
+    def remove_attribute(tag, attribute: str):
+        del tag[attribute]
+
+    @staticmethod
+    def get_text(tag) -> str:
+        return tag.text
+
+    @staticmethod
+    def get_own_text(tag) -> str:
+        # The text nodes that are direct children of the tag, and the attribute values
+        return "".join(
+            [str(i) for i in tag.children if isinstance(i, NavigableString)]
+            + [" ".join(i) if isinstance(i, list) else str(i) for i in tag.attrs.values()]
+        )
+
+    @staticmethod
+    def create_tag(name: str, text: str = "", attrs: dict = None):
+        return create_tag(name, text, attrs)
+
+    @staticmethod
+    def create_marker(text: str):
+        return Comment(text)
+
+    @staticmethod
+    def serialize_tag(tag) -> str:
+        return str(tag)
+
+    def create_fragment(self, name: str, template: str, attrs: dict = None, **kwargs):
+        return self.fragment_factory.create(name, template, attrs, **kwargs)
+
+    @staticmethod
+    def replace_tag(tag, new_tag):
+        tag.replace_with(new_tag)
+
+    @staticmethod
+    def remove_children(tag):
+        remove_tag_children(tag)
+
+    @staticmethod
+    def remove_tag(tag):
+        logging.debug("Remove tag '%s'", tag.name)
+        remove_tag_children(tag)
+        tag.decompose()
+
+    @staticmethod
+    def unwrap_tag(tag):
+        logging.debug("Replace tag with forbidden class '%s'", tag.get("class"))
+        tag.replace_with_children()
+
+    def create_rule_engine(self):
+        engine = self.rule_engine_class(ignored_prefixes=("ac:",))
+        engine.register(self.clear_blank_string, TEXT)
+        engine.register(self.clear_style)
+        engine.register(self.replace_table_of_contents, "div", id_name="toc")
+        for _class in ("wikiFlvPlayer", "magnify"):
+            engine.register(self.remove_tag, "div", class_name=_class)
+        for _class in ("thumbinner", "thumb"):
+            engine.register(self.unwrap_tag, "div", class_name=_class)
+        engine.register(self.replace_caption, "div", class_name="thumbcaption")
+        engine.register(self.remove_flash_script, "script")
+        engine.register(self.replace_flash)
+        for header_number in range(1, 7):
+            engine.register(self.replace_header, f"h{header_number}")
+        engine.register(self.replace_link, "a")
+        for name in ("img", "script"):
+            engine.register(self.remove_tag, name)
+        return engine
+
     def extract_flash(self, s: str):
         video = re.findall("so\.addVariable\(\"file\",\"([^\"]+)\"\)", s)
         if len(video) > 0:
             video = video[0]
             logging.debug(f"Found Adobe Flash video: '{video}'")
-            return create_tag("a", filename_only(video), {"href": video})
-        return create_tag("p", "")
-
-    def process_tag(self, tag: Tag) -> None:
-        if isinstance(tag, NavigableString):
-            text = process_string(tag.text)
-            if len(text) == 0:
-                # Stub
-                tag.replace_with("")
-        if hasattr(tag, "children"):
-            children = list(tag.children)
-            if len(children) > 0:
-                for child in children:
-                    self.process_tag(child)
-        if not hasattr(tag, "name") or tag.name is None or tag.name.startswith("ac:"):
-            logging.debug(f"Not to be processed: '{str(tag)}'")
+            return self.create_tag("a", filename_only(video), {"href": video})
+        return self.create_tag("p", "")
+
+    @staticmethod
+    def clear_blank_string(tag: NavigableString):
+        text = process_string(tag.text)
+        if len(text) == 0:
+            # Stub
+            tag.replace_with("")
+
+    def clear_style(self, tag):
+        if len(self.get_attribute(tag, "style")) > 0:
+            logging.debug("Clear style")
+            self.remove_attribute(tag, "style")
+        return tag
+
+    def replace_table_of_contents(self, tag):
+        # Reflect Table of Contents by Confluence macro
+        logging.debug("Table of contents found")
+        self.replace_tag(
+            tag,
+            self.create_fragment("p", TEMPLATE_TABLE_OF_CONTENTS, header=self.table_of_contents_header)
+        )
+
+    def replace_caption(self, tag):
+        self.remove_children(tag)
+        self.replace_tag(tag, self.create_tag("p", self.get_text(tag)))
+
+    def remove_flash_script(self, tag):
+        if (
+            self.get_attribute(tag, "type") == "text/javascript"
+            and "wikiFlvPlayer" in self.get_attribute(tag, "src")
+        ):
+            self.remove_tag(tag)
             return
-        logging.debug(f"Process as '{str(tag.name)}': '{str(tag)}'")
-        if len(get_tag_attribute(tag, "style")) > 0:
-            logging.debug(f"Clear style")
-            del tag["style"]
-        if str(tag.name) == "div":
-            try:
-                # Reflect Table of Contents by Confluence macro
-                if get_tag_attribute(tag, "id") == "toc":
-                    logging.debug("Table of contents found")
-                    tag.replace_with(
-                        create_tag(
-                            "p",
-                            f"<b id=\"toc\">{self.table_of_contents_header}</b>"
-                            "<ac:structured-macro ac:name=\"toc\" />",
-                        )
-                    )
-                _class = get_tag_attribute(tag, "class")
-                if _class in ("wikiFlvPlayer", "magnify"):
-                    remove_tag_children(tag)
-                    logging.debug(f"Remove tag with class '{_class}'")
-                    tag.decompose()
-                if _class in ("thumbinner", "thumb"):
-                    logging.debug(f"Replace tag with forbidden class '{_class}'")
-                    tag.replace_with_children()
-                if _class == "thumbcaption":
-                    remove_tag_children(tag)
-                    tag.replace_with(create_tag("p", tag.text))
-            except KeyError:
-                pass
-        if str(tag.name) == "script" and get_tag_attribute(tag, "type") == "text/javascript":
-            if "wikiFlvPlayer" in get_tag_attribute(tag, "src"):
-                remove_tag_children(tag)
-                tag.decompose()
-                return
-        if "/extensions/wikiFlvPlayer/player.swf" in str(tag):
-            t = self.extract_flash(tag)
-            remove_tag_children(tag)
-            tag.replace_with(t)
-            tag = t
-        if str(tag.name).startswith("h"):
-            header_number = re.findall("h([0-9]+)", str(tag.name))
-            if len(header_number) == 1:
-                header_number = int(header_number[0])
-                text = tag.find("span", {"class": "mw-headline"})
-                if text is not None:
-                    tag.replace_with(create_tag(f"h{header_number}", text.text))
-        if str(tag.name) == "a":
-            url = get_tag_attribute(tag, "href")
-            if url.startswith("#"):  # Internal URL
-                return
-            url = self.import_url(url)
-            if self.is_valid_file_url(url):
-                if is_attachment(url):
-                    soup = self.get_soup(url)
-                    if len(soup) > 0:
-                        a = soup.find("a", {"class": "internal"})
-                        url_2 = self.import_url(get_tag_attribute(a, "href"))
-                        if url_2 is not None:
-                            url = url_2
-                    else:
-                        logging.debug(f"Unable to parse URL as web page: '{url}'")
-                if self.add_attachment(url):
-                    if is_image(url):
-                        logging.debug(f"Image URL found: '{url}'")
-                        basename = os.path.basename(url)
-                        body = TEMPLATE_SPOILED_IMAGE.format(
-                            basename=basename,
-                            filename=filename_only(url),
-                        )
-                        tag.replace_with(create_tag("ac:structured-macro", body, {"ac:name": "expand"}))
-                    else:
-                        logging.debug(f"Non-image URL found: '{url}'")
-                        text = tag.text
-                        basename = os.path.basename(url)
-                        if is_attachment(text):
-                            text = " {} ".format(basename)
-                        body = TEMPLATE_HYPERLINK.format(
-                            basename=basename,
-                            link_text=text
-                        )
-                        tag.replace_with(create_tag("ac:link", body))
-                else:
-                    tag.replace_with(create_tag("p", " [Not available] "))
-                remove_tag_children(tag)
-        if str(tag.name) in ("img", "script"):
-            remove_tag_children(tag)
-            tag.decompose()
+        return tag
 
-    def process_page(self, url: str):
+    def replace_flash(self, tag):
+        # The children are already processed, so only the own text and attributes of the tag are checked
+        source = self.get_own_text(tag)
+        if WIKI_FLASH_PLAYER_PATH not in source:
+            return tag
+        t = self.extract_flash(source)
+        self.remove_children(tag)
+        self.replace_tag(tag, t)
+        return t
+
+    def replace_header(self, tag):
+        text = self.find_tag(tag, "span", {"class": "mw-headline"})
+        if text is not None:
+            self.replace_tag(tag, self.create_tag(self.get_name(tag), self.get_text(text)))
+
+    def replace_link(self, tag):
+        url = self.get_attribute(tag, "href")
+        if url.startswith("#"):  # Internal URL
+            return
         url = self.import_url(url)
-        soup = self.get_soup(url).find("div", {"id": "content"})
+        if not self.is_valid_file_url(url):
+            return
+        link_text = self.get_text(tag)
+        if self.is_deferred:
+            # The network part is left to 'complete_content'
+            new_tag = self.create_marker(ATTACHMENT_MARKER.format(index=len(self.attachment_references)))
+            self.attachment_references.append(dict(url=url, link_text=link_text))
+        else:
+            new_tag = self.create_link(url, link_text)
+        self.replace_tag(tag, new_tag)
+        self.remove_children(tag)
+
+    def resolve_file_url(self, url: str):
+        """
+        Return the URL of the file itself for the URL of its description page, and the file size if known
+        """
+        file_info = None
+        if is_attachment(url):
+            file_info = self.resolve_files([self.get_title(url)])[self.get_title(url)]
+        if file_info is not None:
+            logging.debug(f"Resolved file URL: '{file_info['url']}'")
+            return self.import_url(file_info["url"]), file_info["size"]
+        if is_attachment(url):
+            soup = self.get_soup(url)
+            a = None
+            if soup is not None and len(soup) > 0:
+                a = self.find_tag(soup, "a", {"class": "internal"})
+            if a is not None:
+                url_2 = self.import_url(self.get_attribute(a, "href"))
+                if url_2 is not None:
+                    url = url_2
+            else:
+                logging.debug(f"Unable to parse URL as web page: '{url}'")
+        return url, None
+
+    def create_link(self, url: str, link_text: str):
+        url, size = self.resolve_file_url(url)
+        if not self.add_attachment(url, size):
+            return self.create_tag("p", " [Not available] ")
+        basename = os.path.basename(url)
+        if is_image(url):
+            logging.debug(f"Image URL found: '{url}'")
+            return self.create_fragment(
+                "ac:structured-macro",
+                TEMPLATE_SPOILED_IMAGE,
+                {"ac:name": "expand"},
+                basename=basename,
+                filename=filename_only(url),
+            )
+        logging.debug(f"Non-image URL found: '{url}'")
+        if is_attachment(link_text):
+            link_text = " {} ".format(basename)
+        return self.create_fragment(
+            "ac:link",
+            TEMPLATE_HYPERLINK,
+            basename=basename,
+            link_text=link_text
+        )
+
+    def process_tag(self, tag) -> None:
+        self.rule_engine.apply(tag)
+
+    def process_content(self, content: bytes):
+        with metrics.measure("parse"):
+            soup = self.find_tag(self.parse(content), "div", {"id": "content"})
+
+        first_heading = self.get_text(self.find_tag(soup, "h1", {"id": "firstHeading"}))
+        container = self.find_tag(soup, "div", {"class": "mw-parser-output"})
+        return self.process_container(first_heading, container)
+
+    def process_api_content(self, content: bytes):
+        """
+        Same as 'process_content', but for the response of MediaWiki API 'action=parse'
+        """
+        with metrics.measure("parse"):
+            parsed_dict = json.loads(content)["parse"]
+            # The fragments are parsed as decoded strings, they have no charset declaration unlike the pages
+            page_title = parsed_dict["title"]
+            if len(parsed_dict.get("displaytitle", "")) > 0:
+                page_title = self.get_text(self.parse(parsed_dict["displaytitle"]))
+            container = self.find_tag(self.parse(parsed_dict["text"]), "div", {"class": "mw-parser-output"})
+        return self.process_container(page_title, container)
 
-        first_heading = soup.find("h1", {"id": "firstHeading"}).text
-        contents = soup.find("div", {"class": "mw-parser-output"}).contents
+    def process_container(self, page_title: str, container):
         self.attachments = list()
-        for parent in contents:
+        self.attachment_references = list()
+        self.media_futures = list()
+        if not self.is_deferred:
+            self.resolve_page_files(container)
+        # Iterate a copy, as the rules remove and replace the children
+        for parent in list(self.get_children(container)):
             self.process_tag(parent)
+        self.complete_attachments()
 
-        content_body = "".join(str(i) for i in contents)
-        logging.debug("Processed content body to be uploaded is below")
-        logging.debug(content_body)
-        return dict(
-            page_title=first_heading,
+        content_body = self.serialize_children(container)
+        logging.debug("Processed content body to be uploaded is below:\n%s", content_body)
+        processed_page_dict = dict(
+            page_title=page_title,
             page_body=content_body,
             page_attachments=list(self.attachments),
         )
+        if self.is_deferred:
+            processed_page_dict["attachment_references"] = list(self.attachment_references)
+        return processed_page_dict
+
+    def complete_content(self, processed_page_dict: dict):
+        """
+        Download the attachments referenced by the page processed in the deferred mode,
+        and put the resulting fragments in place of the markers
+        """
+        references = processed_page_dict["attachment_references"]
+        self.attachments = list()
+        self.media_futures = list()
+        self.resolve_files([self.get_title(i["url"]) for i in references if is_attachment(i["url"])])
+        fragments = [self.serialize_tag(self.create_link(i["url"], i["link_text"])) for i in references]
+        self.complete_attachments()
+        pattern = "<!--{}-->".format(re.escape(ATTACHMENT_MARKER).replace(re.escape("{index}"), r"(\d+)"))
+        page_body = re.sub(pattern, lambda m: fragments[int(m.group(1))], processed_page_dict["page_body"])
+        return dict(
+            page_title=processed_page_dict["page_title"],
+            page_body=page_body,
+            page_attachments=list(self.attachments),
+        )
+
+    def process_page(self, url: str):
+        return self.process_content(self.get_page(url))
+
+    @staticmethod
+    def get_content_digest(content: bytes) -> str:
+        """
+        Return SHA-256 of the parser output of the page HTML without the comments like the parser report,
+        as the skin around it changes with every request, e.g. 'wgRequestId' and the timestamps
+        """
+        start = content.find(b"mw-parser-output")
+        if start >= 0:
+            stop = content.find(b"printfooter", start)
+            content = content[start:stop] if stop >= 0 else content[start:]
+        return sha256(re.sub(rb"<!--.*?-->", b"", content, flags=re.DOTALL)).hexdigest()
+
+    # MediaWiki API source: the parsed content of pages without the skin, and the revision ids of many pages at once
+
+    def get_api_url(self, params: dict):
+        # The URL is encoded, so it is downloaded with 'is_encoded'
+        api_url = self._secret_dict.get("wiki_api_url") or urlparse.urljoin(self.root_url, "api.php")
+        return "{}?{}".format(api_url, urlparse.urlencode(dict(params, format="json", formatversion=2)))
+
+    def get_title(self, url: str):
+        # Both 'index.php?title=Title' and 'index.php/Title' forms are used
+        parts = urlparse.urlsplit(self.import_url(url))
+        title = urlparse.parse_qs(parts.query).get("title", [""])[0]
+        if len(title) == 0:
+            for marker in ("/index.php/", "/wiki/"):
+                if marker in parts.path:
+                    title = parts.path.split(marker, 1)[1]
+                    break
+            else:
+                title = parts.path.rsplit("/", 1)[-1]
+        return title.replace("_", " ").strip()
+
+    def query_pages(self, titles: list, params: dict):
+        """
+        Return the dict of the given titles to the page dicts of MediaWiki API 'action=query', None for the missing pages.
+        The titles are requested in batches of 'WIKI_API_BATCH_SIZE'.
+        Raise ValueError if the API does not respond
+        """
+        pages = dict()
+        titles = list(dict.fromkeys(titles))
+        for start in range(0, len(titles), WIKI_API_BATCH_SIZE):
+            batch = titles[start:start + WIKI_API_BATCH_SIZE]
+            logging.debug(f"Query {params.get('prop')} of {len(batch)} pages")
+            content = self.get_page(
+                self.get_api_url(dict(params, action="query", redirects=1, titles="|".join(batch))),
+                is_encoded=True
+            )
+            try:
+                query_dict = json.loads(content)["query"]
+            except (ValueError, KeyError):
+                raise ValueError(f"Unable to query {params.get('prop')} of {len(batch)} pages")
+            # The requested titles are normalized and redirected to the actual ones
+            aliases = dict()
+            for key in ("normalized", "redirects"):
+                for alias_dict in query_dict.get(key, list()):
+                    aliases[alias_dict["from"]] = alias_dict["to"]
+            found = {
+                page_dict["title"]: page_dict
+                for page_dict in query_dict.get("pages", list())
+                if not page_dict.get("missing", False)
+            }
+            for title in batch:
+                actual = title
+                while actual in aliases and aliases[actual] != actual:
+                    actual = aliases[actual]
+                pages[title] = found.get(actual)
+        return pages
+
+    def get_revisions(self, titles: list):
+        """
+        Return the dict of the given titles to the ids of their last revisions, None for the missing pages
+        """
+        revisions = dict()
+        for title, page_dict in self.query_pages(titles, dict(prop="revisions", rvprop="ids")).items():
+            revisions[title] = None
+            if page_dict is not None and len(page_dict.get("revisions", list())) > 0:
+                revisions[title] = page_dict["revisions"][0]["revid"]
+        return revisions
+
+    def resolve_files(self, titles: list):
+        """
+        Return the dict of the given file titles like 'Файл:Name.png' to the dicts with the direct URL, the size
+        and the SHA-1 of the file, None for the missing files.
+        The results are kept for the whole run, only the new titles are requested.
+        The description pages of the files of a failed batch are scraped, the other batches are not affected
+        """
+        titles = list(dict.fromkeys(titles))
+        with self._file_infos_lock:
+            missing = [i for i in titles if i not in self._file_infos]
+        for start in range(0, len(missing), WIKI_API_BATCH_SIZE):
+            batch = missing[start:start + WIKI_API_BATCH_SIZE]
+            try:
+                pages = self.query_pages(batch, dict(prop="imageinfo", iiprop="url|size|sha1"))
+            except ValueError as e:
+                logging.warning(f"File URLs are resolved by scraping: '{e}'")
+                pages = dict.fromkeys(batch)
+            with self._file_infos_lock:
+                for title, page_dict in pages.items():
+                    file_info = None
+                    if page_dict is not None and len(page_dict.get("imageinfo", list())) > 0:
+                        file_info = {k: page_dict["imageinfo"][0].get(k) for k in ("url", "size", "sha1")}
+                    self._file_infos[title] = file_info
+        with self._file_infos_lock:
+            return {i: self._file_infos.get(i) for i in titles}
+
+    def resolve_page_files(self, container):
+        # All the file links of the page are resolved at once before the rules get them one by one
+        titles = list()
+        for tag in self.find_all_tags(container, "a"):
+            url = self.import_url(self.get_attribute(tag, "href"))
+            if is_attachment(url):
+                titles.append(self.get_title(url))
+        if len(titles) > 0:
+            self.resolve_files(titles)
+
+    def get_api_page(self, title: str, revision: int = None):
+        params = dict(action="parse", prop="text|displaytitle|revid", disableeditsection=1, disablelimitreport=1)
+        if revision is not None:
+            params["oldid"] = revision
+        else:
+            params.update(page=title, redirects=1)
+        # A revision never changes, so its cached content is used without revalidation
+        return self.get_page(self.get_api_url(params), is_immutable=revision is not None, is_encoded=True)
+
+    def process_api_page(self, url: str):
+        return self.process_api_content(self.get_api_page(self.get_title(url)))